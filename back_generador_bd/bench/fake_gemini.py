@@ -0,0 +1,129 @@
+"""
+Servidor HTTP mínimo que imita generateContent / streamGenerateContent
+de Gemini con latencia configurable, para medir sin red ni cuota.
+
+    python -m bench.fake_gemini --port 8765 --latency 0.8 --jitter 0.2
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_TEXT = json.dumps({
+    "classes": [
+        {"id": "c1", "name": "Bench", "attributes": [{"name": "id", "type": "int"}], "methods": []},
+    ],
+    "relationships": [],
+})
+
+
+class FakeGemini:
+    """Responde cada POST después de `latency` ± `jitter` segundos."""
+
+    def __init__(self, latency=0.5, jitter=0.0, error_rate=0.0, text=DEFAULT_TEXT, chunks=4):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.text = text
+        self.chunks = chunks
+        self.stats = {"requests": 0, "errors": 0, "streams": 0}
+        self.port = None
+        self._server = None
+
+    def _delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    async def _handle(self, reader, writer):
+        try:
+            # HTTP/1.1 keep-alive: httpx reutiliza la conexión
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                _, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get("content-length", 0)))
+                await self._respond(writer, target)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, target):
+        self.stats["requests"] += 1
+        await asyncio.sleep(self._delay())
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            body = b'{"error": {"code": 503, "message": "fake overload"}}'
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n"
+                         b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            await writer.drain()
+            return
+
+        query = parse_qs(urlsplit(target).query)
+        if query.get("alt") == ["sse"]:
+            self.stats["streams"] += 1
+            size = max(1, len(self.text) // self.chunks + 1)
+            events = b"".join(
+                b"data: " + json.dumps(_candidate(self.text[i:i + size])).encode() + b"\r\n\r\n"
+                for i in range(0, len(self.text), size)
+            )
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Content-Length: %d\r\n\r\n%s" % (len(events), events))
+        else:
+            body = json.dumps(_candidate(self.text)).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                         b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+        await writer.drain()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def url(self, stream=False):
+        method = "streamGenerateContent" if stream else "generateContent"
+        return f"http://127.0.0.1:{self.port}/v1beta/models/fake:{method}"
+
+    def start_in_thread(self):
+        """Corre en su propio loop para no competir con el loop medido."""
+        ready = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name="fake-gemini", daemon=True).start()
+        ready.wait()
+        return self
+
+
+def _candidate(text):
+    return {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    async def serve():
+        fake = await FakeGemini(args.latency, args.jitter, args.error_rate).start(port=args.port)
+        print(f"Gemini falso en {fake.url()}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
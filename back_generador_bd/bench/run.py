@@ -0,0 +1,431 @@
+"""
+Benchmarks de back_generador_bd.
+
+Levanta la app ASGI en proceso (channel layer en memoria o Redis local,
+sqlite o Postgres) y mide:
+
+  fanout  N salas x M peers mandando broadcast/signal por ws/canvas/
+  backup  throughput de escritura de set_backup_uml (y del write-behind)
+  llm     latencia de /api/chatbot/ contra un Gemini falso con latencia fija
+
+    python -m bench.run --rooms 10 --peers 8 --messages 50
+    python -m bench.run --scenario llm --llm-latency 0.8 --requests 64 --concurrency 16
+    python -m bench.run --scenario all --layer redis --db postgres --output bench.json
+    python -m bench.run --scenario fanout --layer sharded --shards a=redis://...,b=redis://... --node a
+
+Para el escalado con varios procesos y shards ver bench.shards.
+
+Imprime un JSON con p50/p95/p99 (ms), mensajes por segundo y memoria por
+conexión, para comparar corridas entre commits.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+SCENARIOS = ("fanout", "backup", "llm")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--layer", choices=("memory", "redis", "sharded"), default="memory")
+    parser.add_argument("--redis-url", default="redis://127.0.0.1:6379/0")
+    parser.add_argument("--shards", default="", help='--layer sharded: "a=redis://...,b=redis://..."')
+    parser.add_argument("--node", default="", help="--layer sharded: nodo de este proceso (solo sus salas)")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--database-url", default=None, help="URL de Postgres para --db postgres")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="archivo JSON de salida (stdout si no se indica)")
+
+    fanout = parser.add_argument_group("fanout")
+    fanout.add_argument("--rooms", type=int, default=4)
+    fanout.add_argument("--peers", type=int, default=8, help="peers por sala")
+    fanout.add_argument("--messages", type=int, default=50, help="mensajes por peer")
+    fanout.add_argument("--rate", type=float, default=30.0, help="mensajes por segundo por peer")
+    fanout.add_argument("--signal-ratio", type=float, default=0.1, help="fracción de mensajes que son signal")
+    fanout.add_argument("--batch", action="store_true", help="clientes con ?batch=1")
+    fanout.add_argument("--drain-timeout", type=float, default=30.0)
+
+    backup = parser.add_argument_group("backup")
+    backup.add_argument("--writes", type=int, default=500)
+    backup.add_argument("--backup-rooms", type=int, default=50)
+    backup.add_argument("--classes", type=int, default=20, help="clases por diagrama guardado")
+    backup.add_argument("--write-through", action="store_true", help="desactiva BACKUP_WRITE_BEHIND")
+
+    llm = parser.add_argument_group("llm")
+    llm.add_argument("--requests", type=int, default=32)
+    llm.add_argument("--concurrency", type=int, default=8)
+    llm.add_argument("--llm-latency", type=float, default=0.5, help="segundos del Gemini falso")
+    llm.add_argument("--llm-jitter", type=float, default=0.1)
+    llm.add_argument("--llm-error-rate", type=float, default=0.0)
+    llm.add_argument("--stream", action="store_true", help="usa el modo SSE de /api/chatbot/")
+    return parser.parse_args(argv)
+
+
+def configure(args, fake=None):
+    """Fija el entorno de bench.settings antes de django.setup()."""
+    os.environ["DJANGO_SETTINGS_MODULE"] = "bench.settings"
+    os.environ["BENCH_LAYER"] = args.layer
+    os.environ["BENCH_REDIS_URL"] = args.redis_url
+    if args.layer == "sharded":
+        os.environ["CANVAS_SHARDS"] = args.shards
+        os.environ["CANVAS_SHARD_NODE"] = args.node
+    os.environ["BENCH_DB"] = args.db
+    if args.database_url:
+        os.environ["BENCH_DATABASE_URL"] = args.database_url
+    if args.db == "sqlite":
+        os.environ["BENCH_SQLITE_PATH"] = os.path.join(tempfile.gettempdir(), f"uml_bench_{os.getpid()}.sqlite3")
+    if args.write_through:
+        os.environ["BACKUP_WRITE_BEHIND"] = "false"
+    if fake is not None:
+        os.environ["BENCH_GEMINI_URL"] = fake.url()
+        os.environ["BENCH_GEMINI_STREAM_URL"] = fake.url(stream=True)
+
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    call_command("migrate", verbosity=0, interactive=False)
+
+
+def summarize(samples):
+    """Percentiles en ms de una lista de latencias en segundos."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50": pct(50),
+        "p95": pct(95),
+        "p99": pct(99),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+# ---------- fanout ----------
+class Peer:
+    def __init__(self, room, communicator):
+        self.room = room
+        self.communicator = communicator
+        self.name = None
+        self.latencies = {"broadcast": [], "signal": []}
+        self.received = 0
+        self.received_bytes = 0
+        self.last_received = None
+        self._reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f"No se pudo conectar a la sala {self.room}")
+        # El primer mensaje es el roster con nuestro nombre de canal
+        roster = json.loads(await self.communicator.receive_from(5))
+        self.name = roster["self"]
+
+    def start_reading(self):
+        self._reader = asyncio.get_running_loop().create_task(self._read())
+
+    async def _read(self):
+        # Se lee directo de la cola: receive_output() cancela la app al vencer
+        queue = self.communicator.output_queue
+        while True:
+            message = await queue.get()
+            if message["type"] != "websocket.send":
+                return
+            text = message.get("text") or message.get("bytes")
+            now = time.perf_counter()
+            data = json.loads(text)
+            self.received_bytes += len(text)
+            items = data["items"] if data.get("type") == "batch" else [data]
+            for item in items:
+                payload = item.get("payload")
+                if isinstance(payload, dict) and "bench_ts" in payload:
+                    self.latencies[item["type"]].append(now - payload["bench_ts"])
+                    self.received += 1
+                    self.last_received = now
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        await self.communicator.disconnect()
+
+
+async def _send_traffic(peer, room_peers, args, rng, counters):
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    for seq in range(args.messages):
+        payload = {"type": "bench", "seq": seq, "bench_ts": time.perf_counter()}
+        others = [p for p in room_peers if p is not peer]
+        if others and rng.random() < args.signal_ratio:
+            target = rng.choice(others)
+            await peer.communicator.send_to(text_data=json.dumps({"type": "signal", "to": target.name, "payload": payload}))
+            counters["signal"] += 1
+        else:
+            await peer.communicator.send_to(text_data=json.dumps({"type": "broadcast", "payload": payload}))
+            counters["broadcast"] += 1
+            counters["expected"] += len(room_peers)
+        if interval:
+            await asyncio.sleep(interval * rng.uniform(0.5, 1.5))
+
+
+def _rooms(args):
+    """Salas del benchmark; con --node solo las que el anillo ubica en ese nodo."""
+    from uml_api.sharding import get_ring
+
+    rooms = []
+    while len(rooms) < args.rooms:
+        room = str(uuid.uuid4())
+        if not args.node or get_ring().node_for(room) == args.node:
+            rooms.append(room)
+    return rooms
+
+
+async def bench_fanout(args):
+    from channels.testing import WebsocketCommunicator
+    from diagramador_uml.asgi import application
+
+    rng = random.Random(args.seed)
+    # Roster y presence_diff (clientes nuevos); --batch agrega frames batch
+    query = "?presence=diff&batch=1" if args.batch else "?presence=diff"
+    rooms = {room: [] for room in _rooms(args)}
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    connect_times = []
+    for room, peers in rooms.items():
+        for _ in range(args.peers):
+            peer = Peer(room, WebsocketCommunicator(application, f"/ws/canvas/{room}/{query}"))
+            start = time.perf_counter()
+            await peer.connect()
+            connect_times.append(time.perf_counter() - start)
+            peers.append(peer)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    total_peers = args.rooms * args.peers
+
+    all_peers = [peer for peers in rooms.values() for peer in peers]
+    for peer in all_peers:
+        peer.start_reading()
+    # Que lleguen los presence_diff de la conexión antes de medir
+    await asyncio.sleep(0.5)
+
+    counters = {"broadcast": 0, "signal": 0, "expected": 0}
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        _send_traffic(peer, peers, args, random.Random(rng.random()), counters)
+        for peers in rooms.values() for peer in peers
+    ])
+    sent_elapsed = time.perf_counter() - start
+
+    expected = counters["expected"] + counters["signal"]
+    deadline = time.perf_counter() + args.drain_timeout
+    while sum(p.received for p in all_peers) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+    received = sum(p.received for p in all_peers)
+    last = max((p.last_received for p in all_peers if p.last_received), default=start)
+    elapsed = max(last - start, 1e-9)
+    broadcast = [x for p in all_peers for x in p.latencies["broadcast"]]
+    signal = [x for p in all_peers for x in p.latencies["signal"]]
+
+    for peer in all_peers:
+        await peer.close()
+
+    return {
+        "rooms": args.rooms,
+        "peers_per_room": args.peers,
+        "connections": total_peers,
+        "sent": {"broadcast": counters["broadcast"], "signal": counters["signal"]},
+        "sent_per_sec": round((counters["broadcast"] + counters["signal"]) / max(sent_elapsed, 1e-9), 1),
+        "delivered": received,
+        "expected": expected,
+        "lost": max(0, expected - received),
+        "delivered_per_sec": round(received / elapsed, 1),
+        "received_bytes": sum(p.received_bytes for p in all_peers),
+        "latency_ms": {"broadcast": summarize(broadcast), "signal": summarize(signal)},
+        "connect_ms": summarize(connect_times),
+        "memory_per_connection_bytes": int((after - before) / max(1, total_peers)),
+    }
+
+
+# ---------- backup ----------
+def _diagram(rng, classes):
+    ids = [str(uuid.uuid4()) for _ in range(classes)]
+    return {
+        "classes": [
+            {
+                "id": class_id,
+                "name": f"Clase{i}",
+                "position": {"x": rng.randint(0, 2000), "y": rng.randint(0, 2000)},
+                "attributes": [{"name": f"a{j}", "type": "String"} for j in range(4)],
+                "methods": [{"name": f"m{j}", "parameters": "", "returnType": "void"} for j in range(2)],
+            }
+            for i, class_id in enumerate(ids)
+        ],
+        "relationships": [
+            {"id": str(uuid.uuid4()), "type": "association", "sourceId": a, "targetId": b, "labels": ["1", "*"]}
+            for a, b in zip(ids, ids[1:])
+        ],
+    }
+
+
+async def bench_backup(args):
+    from asgiref.sync import sync_to_async
+    from django.conf import settings
+    from django.test import AsyncClient
+    from uml_api.persistence import get_writer
+
+    rng = random.Random(args.seed)
+    client = AsyncClient()
+    rooms = [uuid.uuid4() for _ in range(args.backup_rooms)]
+    bodies = [json.dumps(_diagram(rng, args.classes)) for _ in range(min(args.writes, 20))]
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def write(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(
+                f"/api/set_backup_uml/{rooms[i % len(rooms)]}/",
+                bodies[i % len(bodies)],
+                content_type="application/json",
+            )
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[write(i) for i in range(args.writes)])
+    elapsed = time.perf_counter() - start
+
+    # Lo que quedó en el write-behind se escribe ahora y se mide aparte
+    flush_start = time.perf_counter()
+    await sync_to_async(get_writer().flush_all)()
+    flush_elapsed = time.perf_counter() - flush_start
+
+    return {
+        "write_behind": bool(getattr(settings, "BACKUP_WRITE_BEHIND", True)),
+        "database": settings.DATABASES["default"]["ENGINE"].rsplit(".", 1)[-1],
+        "writes": args.writes,
+        "rooms": len(rooms),
+        "payload_bytes": len(bodies[0]),
+        "errors": errors,
+        "writes_per_sec": round(args.writes / max(elapsed, 1e-9), 1),
+        "latency_ms": summarize(latencies),
+        "final_flush_ms": round(flush_elapsed * 1000, 3),
+        "writer": get_writer().snapshot(),
+    }
+
+
+# ---------- llm ----------
+async def bench_llm(args, fake):
+    from django.test import AsyncClient
+
+    client = AsyncClient()
+    latencies = []
+    first_chunk = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    requests_before = fake.stats["requests"]
+
+    async def call(i):
+        # Prompt distinto en cada llamada para no medir la caché
+        body = {"prompt": f"Genera un sistema de biblioteca con préstamos, variante {i} {uuid.uuid4().hex[:8]}"}
+        if args.stream:
+            body["stream"] = True
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/api/chatbot/", json.dumps(body), content_type="application/json")
+            if args.stream and response.status_code == 200:
+                first = None
+                async for _ in response.streaming_content:
+                    if first is None:
+                        first = time.perf_counter() - start
+                        first_chunk.append(first)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(args.requests)])
+    elapsed = time.perf_counter() - start
+
+    latency = summarize(latencies)
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "stream": args.stream,
+        "fake_latency_ms": round(args.llm_latency * 1000, 1),
+        "upstream_calls": fake.stats["requests"] - requests_before,
+        "status": {str(k): v for k, v in sorted(statuses.items())},
+        "requests_per_sec": round(args.requests / max(elapsed, 1e-9), 2),
+        "latency_ms": latency,
+        "first_chunk_ms": summarize(first_chunk) if args.stream else None,
+        # Lo que agrega el servidor encima de la latencia del upstream
+        "overhead_p50_ms": round(latency["p50"] - args.llm_latency * 1000, 3) if latency.get("count") else None,
+    }
+
+
+async def run(args, fake):
+    selected = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = {}
+    for name in selected:
+        if name == "fanout":
+            results[name] = await bench_fanout(args)
+        elif name == "backup":
+            results[name] = await bench_backup(args)
+        elif name == "llm":
+            results[name] = await bench_llm(args, fake)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+
+    fake = None
+    if args.scenario in ("llm", "all"):
+        from bench.fake_gemini import FakeGemini
+        fake = FakeGemini(args.llm_latency, args.llm_jitter, args.llm_error_rate).start_in_thread()
+    configure(args, fake)
+
+    started = time.time()
+    results = asyncio.run(run(args, fake))
+    report = {
+        "started_at": started,
+        "duration_s": round(time.time() - started, 3),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.db == "sqlite":
+        try:
+            os.remove(os.environ["BENCH_SQLITE_PATH"])
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    main()
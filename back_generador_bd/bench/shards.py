@@ -0,0 +1,97 @@
+"""
+Escalado del canvas con sharding de salas, en varios procesos.
+
+Para cada cantidad de shards k = 1..N levanta k procesos de bench.run
+(fanout) a la vez, uno por nodo, con CANVAS_SHARDS = los primeros k Redis.
+Cada proceso hace de grupo de workers de su nodo y solo abre las salas que
+el anillo le asigna, como haría el proxy con /api/shards/. Suma lo
+entregado por segundo y lo compara con k x (resultado de k=1).
+
+    docker compose -f bench/docker-compose.shards.yml up -d
+    python -m bench.shards --redis redis://127.0.0.1:6381/0 redis://127.0.0.1:6382/0 \\
+        redis://127.0.0.1:6383/0 redis://127.0.0.1:6384/0 --rooms 8 --peers 8
+
+Con un núcleo libre por proceso la eficiencia debería quedar cerca de 1.0:
+las salas no comparten ni event loop ni Redis entre nodos.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", nargs="+", required=True, help="URL de cada shard, en orden")
+    parser.add_argument("--rooms", type=int, default=8, help="salas por nodo")
+    parser.add_argument("--peers", type=int, default=8, help="peers por sala")
+    parser.add_argument("--messages", type=int, default=100, help="mensajes por peer")
+    parser.add_argument("--rate", type=float, default=0, help="mensajes por segundo por peer (0 = sin pausa)")
+    parser.add_argument("--signal-ratio", type=float, default=0.0)
+    parser.add_argument("--batch", action="store_true", help="clientes con ?batch=1")
+    parser.add_argument("--output", default=None, help="archivo JSON de salida (stdout si no se indica)")
+    return parser.parse_args(argv)
+
+
+def run_step(args, count):
+    """k procesos en paralelo, uno por nodo de los primeros `count` shards."""
+    nodes = {f"n{i}": url for i, url in enumerate(args.redis[:count])}
+    spec = ",".join(f"{name}={url}" for name, url in nodes.items())
+    procs = []
+    for name in nodes:
+        output = os.path.join(tempfile.gettempdir(), f"uml_shards_{os.getpid()}_{count}_{name}.json")
+        cmd = [
+            sys.executable, "-m", "bench.run", "--scenario", "fanout",
+            "--layer", "sharded", "--shards", spec, "--node", name,
+            "--rooms", str(args.rooms), "--peers", str(args.peers),
+            "--messages", str(args.messages), "--rate", str(args.rate),
+            "--signal-ratio", str(args.signal_ratio), "--output", output,
+        ]
+        if args.batch:
+            cmd.append("--batch")
+        procs.append((name, output, subprocess.Popen(cmd)))
+
+    results = {}
+    for name, output, proc in procs:
+        if proc.wait() != 0:
+            raise RuntimeError(f"bench.run del nodo {name} terminó con {proc.returncode}")
+        with open(output, encoding="utf-8") as f:
+            results[name] = json.load(f)["results"]["fanout"]
+        os.remove(output)
+
+    return {
+        "shards": count,
+        "delivered_per_sec": round(sum(r["delivered_per_sec"] for r in results.values()), 1),
+        "lost": sum(r["lost"] for r in results.values()),
+        "broadcast_p99_ms": max(r["latency_ms"]["broadcast"].get("p99", 0) for r in results.values()),
+        "nodes": {name: r["delivered_per_sec"] for name, r in results.items()},
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.time()
+    steps = [run_step(args, count) for count in range(1, len(args.redis) + 1)]
+    base = steps[0]["delivered_per_sec"] or 1e-9
+    for step in steps:
+        # 1.0 = escalado lineal respecto de un solo shard
+        step["efficiency"] = round(step["delivered_per_sec"] / (base * step["shards"]), 3)
+
+    output = json.dumps({
+        "started_at": started,
+        "duration_s": round(time.time() - started, 3),
+        "config": vars(args),
+        "steps": steps,
+    }, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
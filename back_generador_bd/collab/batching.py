@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from uml_api import metrics
+
+from .catchup import get_room_log
+from .codecs import encode_frames
+
+logger = logging.getLogger(__name__)
+
+# Mensajes que reemplazan al anterior del mismo peer sobre el mismo
+# elemento (solo importa la última posición) y su clase de tick.
+SUPERSEDING = {
+    "move": "drag",
+    "resize": "drag",
+    "update_vertices": "drag",
+    "move_label": "drag",
+    "cursor": "cursor",
+    "pointer": "cursor",
+}
+
+DEFAULT_TICKS = {"cursor": 50, "drag": 33, "default": 16}
+
+
+def classify(sender, payload):
+    """(clase de tick, clave de fusión o None si no se fusiona)."""
+    if not isinstance(payload, dict):
+        return "default", None
+    kind = payload.get("t") or payload.get("type")
+    tick_class = SUPERSEDING.get(kind)
+    if tick_class is None:
+        return "default", None
+    target = payload.get("id") or payload.get("linkId")
+    return tick_class, (sender, kind, target, payload.get("index"))
+
+
+class RoomBatcher:
+    """
+    Etapa de salida por sala: junta los broadcast durante un tick,
+    fusiona los que se reemplazan y los manda en un solo group_send con
+    cada mensaje ya serializado.
+
+    El lote sale cuando vence el tick más corto de lo pendiente, así un
+    mensaje normal (16 ms) arrastra los cursores acumulados y se conserva
+    el orden entre mensajes del mismo peer.
+    """
+
+    def __init__(self, channel_layer, group, ticks=None):
+        self.channel_layer = channel_layer
+        self.group = group
+        self.ticks = dict(DEFAULT_TICKS, **(ticks or {}))
+        self.pending = OrderedDict()
+        self.deadline = None
+        self._timer = None
+        self._seq = itertools.count()
+        self.stats = {"received": 0, "merged": 0, "batches": 0}
+
+    def add(self, sender, payload):
+        self.stats["received"] += 1
+        tick_class, key = classify(sender, payload)
+        if key is None:
+            key = ("seq", next(self._seq))
+        elif key in self.pending:
+            self.stats["merged"] += 1
+            # La actualización nueva sustituye a la vieja y pasa al final
+            self.pending.move_to_end(key)
+        self.pending[key] = (sender, payload)
+        self._schedule(time.monotonic() + self.ticks.get(tick_class, self.ticks["default"]) / 1000.0)
+
+    def _schedule(self, deadline):
+        if self.deadline is not None and self.deadline <= deadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self.deadline = deadline
+        self._timer = asyncio.get_running_loop().create_task(self._flush_at(deadline))
+
+    async def _flush_at(self, deadline):
+        await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+        self._timer = None
+        self.deadline = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Error enviando lote a %s", self.group)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        items = [
+            {"type": "broadcast", "from": sender, "payload": payload}
+            for sender, payload in self.pending.values()
+        ]
+        self.pending.clear()
+        self.stats["batches"] += 1
+        # Cada mensaje sale con su seq del log de la sala (catch-up al reconectar)
+        await get_room_log().append(self.group, items)
+        # Se serializa una vez aquí y viaja una sola representación (los
+        # mensajes); el frame del lote lo arma cada consumer pegando bytes
+        await metrics.timed_group_send(self.channel_layer, self.group, {
+            "type": "broadcast_batch",
+            "item_frames": [encode_frames(item) for item in items],
+        })
+
+
+# Un batcher por grupo en este worker
+_batchers = {}
+
+
+def batch_ticks():
+    return getattr(settings, "CANVAS_BATCH_TICKS", DEFAULT_TICKS)
+
+
+def get_batcher(channel_layer, group):
+    batcher = _batchers.get(group)
+    if batcher is None:
+        batcher = RoomBatcher(channel_layer, group, batch_ticks())
+        _batchers[group] = batcher
+    return batcher
+
+
+async def drop_batcher(group):
+    """Al salir el último peer del worker se vacía lo pendiente."""
+    batcher = _batchers.pop(group, None)
+    if batcher is not None:
+        if batcher._timer is not None:
+            batcher._timer.cancel()
+        await batcher.flush()
@@ -0,0 +1,226 @@
+import re
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .codecs import JSON
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Subprotocolo binario opcional para ws/canvas/<sala>/.
+#
+# Cada frame es un arreglo [defs, body]: `body` es el mensaje con los
+# UUIDs e ids de peer reemplazados por referencias a enteros chicos y
+# `defs` trae {entero: texto} solo para las referencias que esa conexión
+# todavía no conoce. La numeración es de la sala en el worker, así el
+# body se codifica una vez y se comparte; lo único por conexión es el
+# (pequeño) `defs`. Las variantes ".deflate" anteponen un byte: 0 frame
+# tal cual, 1 frame comprimido con deflate.
+#
+# La tabla de la sala se vacía al pasar CANVAS_INTERN_MAX_STRINGS; el
+# siguiente frame de cada conexión trae en `defs` la tabla completa y la
+# clave RESET_DEF (-1, con la nueva generación) para que el cliente
+# descarte los índices que tenía antes de aplicar esos defs.
+
+UUID_RE = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+PEER_KEYS = ("from", "peer", "to")
+
+MSGPACK_REF = 1
+CBOR_REF = 40000
+RESET_DEF = -1
+
+
+class MsgpackFormat:
+    array2 = b"\x92"
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def ref(self, index):
+        return msgpack.ExtType(MSGPACK_REF, msgpack.packb(index))
+
+    def loads(self, data, resolve):
+        def ext_hook(code, payload):
+            if code == MSGPACK_REF:
+                return resolve(msgpack.unpackb(payload))
+            return msgpack.ExtType(code, payload)
+        return msgpack.unpackb(data, raw=False, ext_hook=ext_hook, strict_map_key=False)
+
+
+class CborFormat:
+    array2 = b"\x82"
+
+    def dumps(self, obj):
+        return cbor2.dumps(obj)
+
+    def ref(self, index):
+        return cbor2.CBORTag(CBOR_REF, index)
+
+    def loads(self, data, resolve):
+        def tag_hook(decoder, tag):
+            if tag.tag == CBOR_REF:
+                return resolve(tag.value)
+            return tag
+        return cbor2.loads(data, tag_hook=tag_hook)
+
+
+FORMATS = {}
+if msgpack is not None:
+    FORMATS["msgpack"] = MsgpackFormat()
+if cbor2 is not None:
+    FORMATS["cbor"] = CborFormat()
+
+SUBPROTOCOLS = {}
+for _name in FORMATS:
+    SUBPROTOCOLS[f"uml.{_name}.v1"] = (_name, False)
+    SUBPROTOCOLS[f"uml.{_name}.deflate.v1"] = (_name, True)
+
+
+class RoomInterner:
+    """Numeración de ids de una sala en este worker + caché de bodies."""
+
+    def __init__(self, max_bodies=256, max_strings=10000):
+        self.ids = {}
+        self.strings = []
+        self.max_bodies = max_bodies
+        self.max_strings = max_strings
+        self.generation = 0
+        self._bodies = OrderedDict()
+
+    def reset(self):
+        # Los bodies cacheados usan los índices viejos: se descartan también
+        self.ids.clear()
+        self.strings = []
+        self._bodies.clear()
+        self.generation += 1
+
+    def intern(self, value):
+        index = self.ids.get(value)
+        if index is None:
+            index = len(self.strings)
+            self.ids[value] = index
+            self.strings.append(value)
+        return index
+
+    def lookup(self, index):
+        try:
+            return self.strings[index]
+        except (IndexError, TypeError):
+            raise ValueError(f"Referencia desconocida: {index}")
+
+    def _replace(self, value, fmt, used, peer=False):
+        if isinstance(value, dict):
+            return {k: self._replace(v, fmt, used, k in PEER_KEYS) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._replace(v, fmt, used) for v in value]
+        if isinstance(value, str) and (peer or UUID_RE.match(value)):
+            index = self.intern(value)
+            used.add(index)
+            return fmt.ref(index)
+        return value
+
+    def body(self, fmt_name, json_frame):
+        """(body codificado, refs usadas) del frame JSON; se cachea por texto."""
+        key = (fmt_name, json_frame)
+        cached = self._bodies.get(key)
+        if cached is not None:
+            self._bodies.move_to_end(key)
+            return cached
+        if len(self.strings) >= self.max_strings:
+            self.reset()
+        fmt = FORMATS[fmt_name]
+        used = set()
+        body = fmt.dumps(self._replace(JSON.loads(json_frame), fmt, used))
+        cached = (body, used)
+        self._bodies[key] = cached
+        while len(self._bodies) > self.max_bodies:
+            self._bodies.popitem(last=False)
+        return cached
+
+
+_interners = {}
+
+
+def get_interner(group):
+    interner = _interners.get(group)
+    if interner is None:
+        interner = RoomInterner(max_strings=getattr(settings, "CANVAS_INTERN_MAX_STRINGS", 10000))
+        _interners[group] = interner
+    return interner
+
+
+def drop_interner(group):
+    _interners.pop(group, None)
+
+
+class BinaryProtocol:
+    """Estado por conexión: qué referencias conoce ya el cliente."""
+
+    binary = True
+
+    def __init__(self, subprotocol, group):
+        self.subprotocol = subprotocol
+        self.name, self.deflate = SUBPROTOCOLS[subprotocol]
+        self.format = FORMATS[self.name]
+        self.interner = get_interner(group)
+        self.known = set()
+        self.generation = self.interner.generation
+        self.deflate_min = getattr(settings, "CANVAS_DEFLATE_MIN_BYTES", 256)
+
+    def _frame(self, body, used):
+        if self.generation != self.interner.generation:
+            # La tabla se reinició: se manda completa junto con la marca
+            self.generation = self.interner.generation
+            strings = self.interner.strings
+            defs = dict(enumerate(strings))
+            defs[RESET_DEF] = self.generation
+            self.known = set(range(len(strings)))
+        else:
+            new = used - self.known
+            defs = {index: self.interner.strings[index] for index in new}
+            self.known |= new
+        frame = self.format.array2 + self.format.dumps(defs) + body
+        if not self.deflate:
+            return frame
+        if len(frame) < self.deflate_min:
+            return b"\x00" + frame
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        return b"\x01" + compressor.compress(frame) + compressor.flush()
+
+    def encode_frames(self, frames):
+        body, used = self.interner.body(self.name, frames[JSON.name])
+        return self._frame(body, used)
+
+    def dumps(self, message):
+        # Mensajes directos a esta conexión (snapshot, op_rejected...)
+        return self.encode_frames({JSON.name: JSON.dumps(message)})
+
+    def loads(self, data):
+        if isinstance(data, str):
+            return JSON.loads(data)
+        if self.deflate:
+            flag, data = data[:1], data[1:]
+            if flag == b"\x01":
+                data = zlib.decompress(data, -15)
+        message = self.format.loads(data, self.interner.lookup)
+        # El cliente puede mandar [defs, body] o el mensaje solo
+        if isinstance(message, list) and len(message) == 2 and isinstance(message[0], dict):
+            return message[1]
+        return message
+
+
+def negotiate(scope, group):
+    """Primer subprotocolo ofrecido por el cliente que el servidor soporta."""
+    for subprotocol in scope.get("subprotocols") or []:
+        if subprotocol in SUBPROTOCOLS:
+            return BinaryProtocol(subprotocol, group)
+    return None
@@ -0,0 +1,192 @@
+import logging
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from uml_api.redis_conn import get_redis
+
+from .codecs import JSON
+
+logger = logging.getLogger(__name__)
+
+# Log de broadcasts por sala para que un peer que se reconecta reciba solo
+# lo que se perdió. Cada mensaje lleva un "seq" creciente por sala; el
+# cliente manda el último que vio en {"type": "resume", "seq": N}.
+#
+# En Redis es un Stream con ids "<seq>-0" recortado a CANVAS_CATCHUP_MAXLEN
+# más un contador; el script reserva los seq y agrega los mensajes de un
+# lote en una sola ida, así dos workers no pueden intercalar ids. Con
+# CANVAS_SHARDS el log vive en el Redis del nodo dueño de la sala.
+APPEND_SCRIPT = """
+local count = #ARGV - 2
+local first = redis.call("incrby", KEYS[2], count) - count + 1
+for i = 1, count do
+    redis.call("xadd", KEYS[1], "MAXLEN", "~", ARGV[1], (first + i - 1) .. "-0", "m", ARGV[i + 2])
+end
+redis.call("expire", KEYS[1], ARGV[2])
+redis.call("expire", KEYS[2], ARGV[2])
+return first
+"""
+
+
+class MemoryLogBackend:
+    """Ring buffer por sala dentro del proceso, para cuando no hay Redis."""
+
+    def __init__(self, maxlen, ttl):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        # sala -> [último seq, deque de (seq, mensaje), última escritura]
+        self.rooms = OrderedDict()
+
+    def _expire(self, now):
+        while self.rooms:
+            room, log = next(iter(self.rooms.items()))
+            if now - log[2] < self.ttl:
+                break
+            del self.rooms[room]
+
+    async def append(self, room, messages):
+        now = time.monotonic()
+        self._expire(now)
+        log = self.rooms.get(room)
+        if log is None:
+            log = self.rooms[room] = [0, deque(maxlen=self.maxlen), now]
+        self.rooms.move_to_end(room)
+        first = log[0] + 1
+        for message in messages:
+            log[0] += 1
+            log[1].append((log[0], message))
+        log[2] = now
+        return first
+
+    async def head(self, room):
+        log = self.rooms.get(room)
+        return log[0] if log is not None else 0
+
+    async def since(self, room, seq, limit):
+        log = self.rooms.get(room)
+        if log is None:
+            return 0, []
+        # Los seq del deque son consecutivos: el primero que falta se ubica directo
+        entries = log[1]
+        start = max(seq + 1 - entries[0][0], 0) if entries else 0
+        return log[0], [entries[i] for i in range(start, min(len(entries), start + limit))]
+
+
+class RedisLogBackend:
+    prefix = "catchup:"
+
+    def __init__(self, maxlen, ttl):
+        self.maxlen = maxlen
+        self.ttl = ttl
+
+    def _keys(self, room):
+        return (f"{self.prefix}log:{room}", f"{self.prefix}seq:{room}")
+
+    async def append(self, room, messages):
+        payloads = [JSON.dumps(message) for message in messages]
+        return int(await get_redis(room).eval(APPEND_SCRIPT, 2, *self._keys(room), self.maxlen, self.ttl, *payloads))
+
+    async def head(self, room):
+        return int(await get_redis(room).get(self._keys(room)[1]) or 0)
+
+    async def since(self, room, seq, limit):
+        stream, counter = self._keys(room)
+        # Contador y rango en la misma transacción: el head corresponde a lo leído
+        async with get_redis(room).pipeline(transaction=True) as pipe:
+            pipe.get(counter)
+            pipe.xrange(stream, min=f"{seq + 1}-0", max="+", count=limit)
+            head, entries = await pipe.execute()
+        return int(head or 0), [
+            (int(entry_id.split(b"-")[0]), JSON.loads(fields[b"m"])) for entry_id, fields in entries
+        ]
+
+
+class RoomLog:
+    """
+    Asigna los seq de los broadcast y resuelve los resume: los mensajes
+    perdidos si siguen en el log, o None si hay que mandar un snapshot
+    (hueco recortado, demasiados mensajes o log reiniciado).
+    """
+
+    def __init__(self):
+        self.enabled = getattr(settings, "CANVAS_CATCHUP", True)
+        self.use_redis = getattr(settings, "CANVAS_CATCHUP_REDIS", True)
+        self.max_replay = getattr(settings, "CANVAS_CATCHUP_MAX_REPLAY", 500)
+        maxlen = getattr(settings, "CANVAS_CATCHUP_MAXLEN", 1000)
+        ttl = getattr(settings, "CANVAS_CATCHUP_TTL", 3600)
+        self.memory = MemoryLogBackend(maxlen, ttl)
+        self.redis = RedisLogBackend(maxlen, ttl)
+        self.stats = {"appended": 0, "resumes": 0, "replayed": 0, "snapshots": 0, "redis_errors": 0}
+
+    def _backend(self):
+        # Sin caída a memoria si Redis falla: serían otros seq para la misma sala
+        if self.use_redis and get_redis() is not None:
+            return self.redis
+        return self.memory
+
+    async def append(self, room, messages):
+        """Agrega los mensajes al log y les pone su seq; sin log salen sin seq."""
+        if not self.enabled or not messages:
+            return
+        try:
+            first = await self._backend().append(room, messages)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning("No se pudo registrar el broadcast de %s: %s", room, e)
+            return
+        for offset, message in enumerate(messages):
+            message["seq"] = first + offset
+        self.stats["appended"] += len(messages)
+
+    async def head(self, room):
+        """Último seq de la sala (0 si no hay log)."""
+        if not self.enabled:
+            return None
+        try:
+            return await self._backend().head(room)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning("No se pudo leer el log de %s: %s", room, e)
+            return None
+
+    async def replay(self, room, seq):
+        """(head, mensajes con seq > `seq`) o (head, None) si no se puede."""
+        self.stats["resumes"] += 1
+        if not self.enabled or not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+            self.stats["snapshots"] += 1
+            return await self.head(room), None
+        try:
+            head, entries = await self._backend().since(room, seq, self.max_replay + 1)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            self.stats["snapshots"] += 1
+            logger.warning("No se pudo leer el log de %s: %s", room, e)
+            return None, None
+
+        missing = head - seq
+        if missing < 0 or missing > self.max_replay or (missing and (not entries or entries[0][0] != seq + 1)):
+            self.stats["snapshots"] += 1
+            return head, None
+        messages = [dict(message, seq=entry_seq) for entry_seq, message in entries[:missing]]
+        self.stats["replayed"] += len(messages)
+        return head, messages
+
+    def snapshot(self):
+        return dict(
+            self.stats,
+            enabled=bool(self.enabled),
+            redis_enabled=bool(self.use_redis),
+            memory_rooms=len(self.memory.rooms),
+        )
+
+
+_log = None
+
+
+def get_room_log():
+    global _log
+    if _log is None:
+        _log = RoomLog()
+    return _log
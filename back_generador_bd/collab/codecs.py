@@ -0,0 +1,123 @@
+import json
+from collections import Counter, OrderedDict
+from urllib.parse import parse_qs
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: se usa json de la stdlib
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """JSON en frames de texto; orjson si está instalado."""
+
+    name = "json"
+    binary = False
+
+    def dumps(self, message):
+        if orjson is not None:
+            return orjson.dumps(message).decode("utf-8")
+        return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+    def loads(self, data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def join_batch(self, parts):
+        return '{"type":"batch","items":[' + ",".join(parts) + "]}"
+
+
+class MsgpackCodec:
+    """MessagePack en frames binarios."""
+
+    name = "msgpack"
+    binary = True
+
+    def dumps(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def loads(self, data):
+        if isinstance(data, str):
+            # Un cliente msgpack puede mandar igual algún frame de texto JSON
+            return JSON.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+    def join_batch(self, parts):
+        packer = msgpack.Packer(use_bin_type=True)
+        header = (
+            packer.pack_map_header(2) + packer.pack("type") + packer.pack("batch")
+            + packer.pack("items") + packer.pack_array_header(len(parts))
+        )
+        return header + b"".join(parts)
+
+
+JSON = JsonCodec()
+CODECS = {JSON.name: JSON}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+# Conexiones abiertas por codec en este worker: solo se pre-codifica en
+# los formatos que alguien está usando
+_active = Counter()
+
+# Frames llegados de otro worker sin el formato de este: se convierten una
+# vez por worker y no una por destinatario
+MAX_CONVERTED = 256
+_converted = OrderedDict()
+
+
+def negotiate(scope):
+    """Codec pedido en ?codec=...; JSON si no se pide o no está disponible."""
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    name = query.get("codec", [JSON.name])[0]
+    return CODECS.get(name, JSON)
+
+
+def register(codec):
+    _active[codec.name] += 1
+
+
+def unregister(codec):
+    _active[codec.name] -= 1
+    if _active[codec.name] <= 0:
+        del _active[codec.name]
+
+
+def encode_frames(message):
+    """
+    Codifica el mensaje una sola vez por formato en uso. El resultado viaja
+    en el evento del grupo y cada consumer reenvía los mismos bytes.
+    """
+    frames = {JSON.name: JSON.dumps(message)}
+    for name in _active:
+        if name not in frames:
+            frames[name] = CODECS[name].dumps(message)
+    return frames
+
+
+def frame_for(frames, codec):
+    frame = frames.get(codec.name)
+    if frame is None:
+        # El emisor estaba en otro worker sin conexiones con este codec
+        key = (codec.name, frames[JSON.name])
+        frame = _converted.get(key)
+        if frame is None:
+            frame = codec.dumps(JSON.loads(frames[JSON.name]))
+            _converted[key] = frame
+            while len(_converted) > MAX_CONVERTED:
+                _converted.popitem(last=False)
+    return frame
+
+
+def batch_frames(item_frames, codec):
+    """
+    Frame {"type": "batch", "items": [...]} en el formato de `codec`, armado
+    pegando los frames ya codificados de cada mensaje (sin re-serializar).
+    """
+    return {codec.name: codec.join_batch([frame_for(frames, codec) for frames in item_frames])}
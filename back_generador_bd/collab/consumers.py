@@ -1,59 +1,139 @@
 import json
+from urllib.parse import parse_qs
+
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
-from uml_api.services import call_gemini_analysis
-import re
+from uml_api.services import (
+    analyze_uml, astream_uml_analysis, local_uml_analysis, strip_markdown, validation_needs_llm,
+)
+from uml_api import metrics
+from uml_api.incremental import get_validation_store
+from uml_api.ratelimit import RateLimited, rate_scope, scope_client
+from uml_api.sharding import owns_room
+from . import binary, codecs
+from .batching import drop_batcher, get_batcher
+from .catchup import get_room_log
+from .presence import get_presence
+from .room_state import OpError, get_room_state, join_room, leave_room, merge_result, room_key, schedule_save
+
+# Tipos de mensaje entrantes que se cuentan con su nombre en las métricas
+INBOUND_TYPES = ("broadcast", "signal", "op", "sync", "resume")
+
+
 class CanvasConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        print("[CanvasConsumer.connect] scope:", self.scope)
-        print("[CanvasConsumer.connect] url_route:", self.scope.get("url_route"))
-        self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
+        # Misma clave que usan merge_target/invalidate_room aunque la URL
+        # traiga el uuid en mayúsculas o sin guiones
+        self.room_name = room_key(self.scope["url_route"]["kwargs"]["room_name"])
         self.room_group_name = f"canvas_{self.room_name}"
+        # ?batch=1: el cliente acepta frames {"type": "batch", "items": [...]}
+        query = parse_qs(self.scope.get("query_string", b"").decode("latin-1"))
+        self.batch_frames = query.get("batch", ["0"])[0] in ("1", "true")
+        # ?presence=diff: roster al entrar y presence_diff agrupados; sin él,
+        # los presence join/leave de siempre (el p2p saca de ahí su localId)
+        self.presence_diff = query.get("presence", [""])[0] == "diff"
+        # Subprotocolo binario (uml.msgpack.v1, ...) si el cliente lo ofrece;
+        # si no, ?codec=msgpack o JSON por defecto
+        self.protocol = binary.negotiate(self.scope, self.room_group_name)
+        self.codec = codecs.JSON if self.protocol else codecs.negotiate(self.scope)
+        codecs.register(self.codec)
 
         # Unir al grupo
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        await self.accept()
+        join_room(self.room_name)
+        await self.accept(subprotocol=self.protocol.subprotocol if self.protocol else None)
+        metrics.ws_connections.inc(self.room_name)
+        if not owns_room(self.room_name):
+            # Funciona igual, pero el tráfico de la sala cruza de Redis:
+            # el proxy no está usando la tabla de /api/shards/
+            metrics.ws_misrouted.inc()
 
-        # Notificar presencia
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "presence",
-                "action": "join",
-                "peer": self.channel_name
-            }
-        )
+        # Roster actual solo para el que entra; al resto le llega en el
+        # próximo presence_diff. "seq" es el punto desde el que puede hacer resume
+        roster = await get_presence().join(self.channel_layer, self.room_name, self.channel_name)
+        if not self.presence_diff:
+            # Su propio join primero, así el cliente conoce su id antes que el de otros
+            await self.send_message({"type": "presence", "action": "join", "peer": self.channel_name})
+            return
+        await self.send_message({
+            "type": "roster",
+            "self": self.channel_name,
+            "peers": roster,
+            "seq": await get_room_log().head(self.room_group_name)
+        })
 
     async def disconnect(self, close_code):
+        codecs.unregister(self.codec)
+        metrics.ws_connections.dec(self.room_name)
         # Salir del grupo
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        # Notificar salida (agrupada en el próximo presence_diff)
+        await get_presence().leave(self.channel_layer, self.room_name, self.channel_name)
+        if await leave_room(self.room_name):
+            metrics.ws_connections.remove(self.room_name)
+            await drop_batcher(self.room_group_name)
+            await get_presence().drop_room(self.room_group_name)
+            binary.drop_interner(self.room_group_name)
 
-        # Notificar salida
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "presence",
-                "action": "leave",
-                "peer": self.channel_name
-            }
-        )
+    async def send_frames(self, frames, kind="other"):
+        if self.protocol:
+            # Body compartido por la sala + refs que esta conexión no conoce
+            frame = self.protocol.encode_frames(frames)
+        else:
+            # Mismo frame para todos los peers con este codec: no se re-serializa
+            frame = codecs.frame_for(frames, self.codec)
+        metrics.ws_messages.inc("out", kind)
+        metrics.ws_bytes.inc("out", kind, amount=len(frame))
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def send_message(self, message):
+        if self.protocol:
+            frame = self.protocol.dumps(message)
+            metrics.ws_messages.inc("out", message["type"])
+            metrics.ws_bytes.inc("out", message["type"], amount=len(frame))
+            await self.send(bytes_data=frame)
+            return
+        await self.send_frames({self.codec.name: self.codec.dumps(message)}, message["type"])
+
+    async def receive(self, text_data=None, bytes_data=None):
+        raw = text_data if text_data is not None else bytes_data
+        decoder = self.protocol or self.codec
+        # Decodificación completa a propósito: orjson/msgpack la hacen en C,
+        # "op" necesita el cuerpo y el batcher fusiona los payloads de drag.
+        # Lo caro (serializar) es una vez por mensaje, no por destinatario.
+        data = decoder.loads(raw)
+        # El tipo viene del cliente: solo los conocidos como label
+        kind = data.get("type") if data.get("type") in INBOUND_TYPES else "other"
+        metrics.ws_messages.inc("in", kind)
+        metrics.ws_bytes.inc("in", kind, amount=len(raw))
+        metrics.ws_message_size.observe(kind, value=len(raw))
+
+        # Si es un broadcast → enviar a todos, agrupado por ticks
+        if data["type"] == "broadcast" and getattr(settings, "CANVAS_BATCHING", True):
+            get_batcher(self.channel_layer, self.room_group_name).add(self.channel_name, data["payload"])
 
-        # Si es un broadcast → enviar a todos
-        if data["type"] == "broadcast":
-            await self.channel_layer.group_send(
+        elif data["type"] == "broadcast":
+            message = {
+                "type": "broadcast",
+                "from": self.channel_name,
+                "payload": data["payload"]
+            }
+            await get_room_log().append(self.room_group_name, [message])
+            await metrics.timed_group_send(
+                self.channel_layer,
                 self.room_group_name,
                 {
                     "type": "broadcast_message",
-                    "from": self.channel_name,
-                    "payload": data["payload"]
+                    "frames": codecs.encode_frames(message)
                 }
             )
 
@@ -64,60 +144,170 @@ class CanvasConsumer(AsyncWebsocketConsumer):
                 to,
                 {
                     "type": "signal_message",
-                    "from": self.channel_name,
-                    "payload": data["payload"]
+                    "frames": codecs.encode_frames({
+                        "type": "signal",
+                        "from": self.channel_name,
+                        "payload": data["payload"]
+                    })
                 }
             )
 
-    # Handlers para los eventos enviados
+        # Operación fina sobre el estado de la sala → reenviar solo el delta
+        elif data["type"] == "op":
+            await self.apply_op(data)
+
+        # Peer nuevo o reconectado → snapshot + versión actual
+        elif data["type"] == "sync":
+            await self.send_snapshot(await get_room_log().head(self.room_group_name))
+
+        # Peer reconectado con el último seq que vio → solo lo que se perdió
+        elif data["type"] == "resume":
+            await self.resume(data.get("seq"))
+
+    async def send_snapshot(self, seq):
+        state = await get_room_state(self.room_name)
+        await self.send_message({
+            "type": "snapshot",
+            "version": state.version,
+            "seq": seq,
+            "state": state.snapshot()
+        })
+
+    async def resume(self, seq):
+        # Lo que llegue en vivo mientras tanto puede repetirse: el cliente
+        # descarta los seq que ya tiene
+        head, messages = await get_room_log().replay(self.room_group_name, seq)
+        if messages is None:
+            # Hueco recortado del log o demasiado grande: estado completo
+            await self.send_snapshot(head)
+            return
+        await self.send_message({
+            "type": "catchup",
+            "seq": head,
+            "items": messages
+        })
+
+    async def apply_op(self, data):
+        state = await get_room_state(self.room_name)
+        # El envío va dentro del lock para que los deltas salgan en orden de versión
+        async with state.lock:
+            try:
+                delta = state.apply(data.get("op"))
+            except OpError as e:
+                rejected = {
+                    "type": "op_rejected",
+                    "op_id": data.get("op_id"),
+                    "version": state.version,
+                    "reason": str(e)
+                }
+            else:
+                rejected = None
+                schedule_save(self.room_name, state)
+                await metrics.timed_group_send(
+                    self.channel_layer,
+                    self.room_group_name,
+                    {
+                        "type": "room_delta",
+                        "frames": codecs.encode_frames({
+                            "type": "delta",
+                            "from": self.channel_name,
+                            "op_id": data.get("op_id"),
+                            "version": state.version,
+                            "op": delta
+                        })
+                    }
+                )
+
+        if rejected is not None:
+            await self.send_message(rejected)
+
+    # Handlers para los eventos enviados: el frame ya viene codificado
+    async def room_delta(self, event):
+        await self.send_frames(event["frames"], "delta")
+
+    async def room_deltas(self, event):
+        # Resultado de edición/eliminación aplicado en el servidor
+        for frames in event["frames"]:
+            await self.send_frames(frames, "delta")
+
+    async def merge_request(self, event):
+        # Otro worker pide aplicar una respuesta del LLM sobre el estado de
+        # esta sala, que vive en este worker
+        summary = await merge_result(
+            self.room_name, event["result"], self.channel_layer, event["origin"], event.get("key"),
+        )
+        await self.channel_layer.send(event["reply_to"], {"type": "merge_reply", "summary": summary})
+
     async def broadcast_message(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "broadcast",
-            "from": event["from"],
-            "payload": event["payload"]
-        }))
+        await self.send_frames(event["frames"], "broadcast")
+
+    async def broadcast_batch(self, event):
+        if self.batch_frames:
+            # El binario internea sobre el JSON; el resto usa su codec
+            codec = codecs.JSON if self.protocol else self.codec
+            await self.send_frames(codecs.batch_frames(event["item_frames"], codec), "batch")
+            return
+        # Clientes viejos: un frame por mensaje, ya fusionados
+        for frames in event["item_frames"]:
+            await self.send_frames(frames, "broadcast")
 
     async def signal_message(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "signal",
-            "from": event["from"],
-            "payload": event["payload"]
-        }))
+        await self.send_frames(event["frames"], "signal")
 
     async def presence(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "presence",
-            "action": event["action"],
-            "peer": event["peer"]
-        }))
+        if self.presence_diff:
+            await self.send_frames(event["frames"], "presence")
+            return
+        # Clientes viejos: un mensaje por peer, como antes del presence_diff
+        for action, peers in (("join", event["joined"]), ("leave", event["left"])):
+            for peer in peers:
+                if peer != self.channel_name:
+                    await self.send_message({"type": "presence", "action": action, "peer": peer})
+
+    async def job_result(self, event):
+        # Resultado de un trabajo de /api/chatbot/ en modo async
+        await self.send_message({
+            "type": "job_result",
+            "job": event["job"]
+        })
 
 
 
 class UMLConsumer(AsyncWebsocketConsumer):
     async def connect(self):
+        # La sala puede venir en la URL o en cada mensaje; si no, el
+        # historial de validación es el de esta conexión
+        self.room_name = self.scope.get("url_route", {}).get("kwargs", {}).get("room_name")
         await self.accept()
 
+    async def disconnect(self, close_code):
+        get_validation_store().forget(self.channel_name)
+
+    def validation_room(self, data):
+        return data.get("room_id") or self.room_name or self.channel_name
+
     async def receive(self, text_data):
         data = json.loads(text_data)
         action = data.get("action")
 
         if action == "validate_model":
             uml_json = data.get("uml")
+            room_id = self.validation_room(data)
 
-            prompt = f"""
-Eres un experto en diseño de bases de datos.
-Analiza si las relaciones de este UML son correctas en base a los nombres y atributos.
-
-JSON UML:
-{json.dumps(uml_json, indent=2)}
-"""
+            if data.get("stream"):
+                with rate_scope(room=room_id, client=scope_client(self.scope)):
+                    await self.stream_validation(uml_json, room_id)
+                return
 
-            # Llamar a Gemini
-            raw_output = call_gemini_analysis(prompt)
+            # Llamar a Gemini (sin bloquear el event loop, con caché por contenido)
+            try:
+                with rate_scope(room=room_id, client=scope_client(self.scope)):
+                    raw_output = await analyze_uml(uml_json, room_id)
+            except RateLimited as e:
+                raw_output = json.dumps({"error": "Límite de solicitudes alcanzado", "retry_after": e.retry_after})
 
             # 🧹 limpiar markdown (```json ... ```)
-            if isinstance(raw_output, str):
-                raw_output = re.sub(r"^```json\s*|\s*```$", "", raw_output.strip(), flags=re.MULTILINE)
+            raw_output = strip_markdown(raw_output)
 
             try:
                 analysis = json.loads(raw_output)
@@ -129,3 +319,56 @@ JSON UML:
                 "action": "validation_result",
                 "analysis": analysis
             }, ensure_ascii=False))
+
+    async def send_partial(self, section, item):
+        await self.send(text_data=json.dumps({
+            "action": "validation_partial",
+            "section": section,
+            "item": item
+        }, ensure_ascii=False))
+
+    async def stream_validation(self, uml_json, room_id):
+        # Los errores estructurales salen de inmediato, sin esperar a Gemini
+        report = local_uml_analysis(uml_json)
+        plan = None
+        if report is not None:
+            for item in report.errores:
+                await self.send_partial("errores", item)
+            if not validation_needs_llm(report):
+                await self.send(text_data=json.dumps({
+                    "action": "validation_result",
+                    "analysis": report.as_analysis(report.structural_validas())
+                }, ensure_ascii=False))
+                return
+            # Las relaciones sin cambios reutilizan su resultado anterior
+            store = get_validation_store()
+            plan = store.plan(room_id, report)
+            for section, item in plan.cached_items():
+                await self.send_partial(section, item)
+            uml_json = plan.remainder()
+
+        analysis = {"validas": [], "errores": []}
+        if plan is None or plan.dirty:
+            # Enviar cada relación analizada apenas Gemini la termina
+            try:
+                async for section, item in astream_uml_analysis(uml_json):
+                    if section is None:
+                        analysis = item
+                    else:
+                        await self.send_partial(section, item)
+            except RateLimited as e:
+                # Sin cupo o Gemini saturado: solo la pasada local
+                plan = None
+                if report is None:
+                    analysis = {"error": "Límite de solicitudes alcanzado", "retry_after": e.retry_after}
+                else:
+                    analysis = report.as_analysis(report.structural_validas())
+
+        if plan is not None:
+            analysis, room = plan.merge(analysis)
+            store.remember(room_id, room)
+
+        await self.send(text_data=json.dumps({
+            "action": "validation_result",
+            "analysis": analysis
+        }, ensure_ascii=False))
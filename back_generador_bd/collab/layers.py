@@ -0,0 +1,43 @@
+import uuid
+
+from channels_redis.core import RedisChannelLayer
+
+from uml_api.sharding import HashRing, parse_nodes
+
+
+class ShardedChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer que ubica cada grupo de sala en su nodo del anillo
+    (en vez de crc32 % hosts, que mueve casi todas las salas al agregar un
+    Redis) y los canales de este proceso en el Redis de su propio nodo.
+
+    Con el proxy mandando las conexiones de una sala a los workers de su
+    nodo, el group_send de la sala y la entrega a sus peers tocan un solo
+    Redis; una conexión que cae en otro nodo igual funciona, solo que cruza.
+
+    CONFIG: {"shards": {"a": "redis://...", ...}, "node": "a", "vnodes": 160}
+    más las opciones de RedisChannelLayer. Los nombres de nodo van sin "-"
+    ni "." (se leen del prefijo del canal).
+    """
+
+    def __init__(self, shards=None, node=None, vnodes=160, **kwargs):
+        self.shards = parse_nodes(shards)
+        super().__init__(hosts=list(self.shards.values()), **kwargs)
+        self.ring = HashRing(self.shards, vnodes)
+        self.node = node or None
+        self._index = {name: i for i, name in enumerate(self.shards)}
+        if self.node in self._index:
+            # El nodo va en el prefijo de los canales: cualquier proceso sabe
+            # en qué Redis está la cola de un canal sin consultar nada
+            self.client_prefix = f"{self.node}-{uuid.uuid4().hex}"
+
+    def consistent_hash(self, value):
+        if "!" in value:
+            # Canal específico "specific.<nodo>-<hex>!<local>": send() pasa el
+            # nombre completo y receive() solo hasta el "!", así que se hashea
+            # siempre la parte no local
+            value = self.non_local_name(value)
+            tag = value.partition(".")[2].partition("-")[0]
+            if tag in self._index:
+                return self._index[tag]
+        return self._index[self.ring.node_for(value)]
@@ -0,0 +1,82 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from uml_api.sharding import GROUP_PREFIX, get_ring, parse_nodes, shards
+
+try:
+    import redis
+except ImportError:  # redis es opcional fuera de docker
+    redis = None
+
+
+class Command(BaseCommand):
+    help = (
+        "Copia al nodo nuevo las claves de las salas que cambian de dueño al "
+        "agregar o quitar shards (grupos del channel layer y log de catch-up). "
+        "El destino es CANVAS_SHARDS. Orden: levantar el nodo nuevo, correr "
+        "esto y reiniciar los workers con la configuración nueva; los clientes "
+        "reconectan y hacen resume contra el log ya copiado."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--previous", required=True,
+                            help='shards anteriores, "a=redis://...,b=redis://..."')
+        parser.add_argument("--dry-run", action="store_true", help="solo cuenta lo que se movería")
+        parser.add_argument("--keep", action="store_true", help="no borra las claves del nodo anterior")
+
+    def handle(self, *args, **options):
+        if redis is None:
+            raise CommandError("Falta el paquete redis")
+        previous = parse_nodes(options["previous"])
+        current = shards()
+        if not previous or not current:
+            raise CommandError("Hacen falta --previous y CANVAS_SHARDS")
+
+        ring = get_ring()
+        prefix = settings.CHANNEL_LAYERS["default"].get("CONFIG", {}).get("prefix", "asgi")
+        patterns = (f"{prefix}:group:{GROUP_PREFIX}*", f"catchup:log:{GROUP_PREFIX}*", f"catchup:seq:{GROUP_PREFIX}*")
+        clients = {url: redis.Redis.from_url(url) for url in set(previous.values()) | set(current.values())}
+
+        moved = Counter()
+        skipped = 0
+        for name, url in previous.items():
+            source = clients[url]
+            for pattern in patterns:
+                for key in source.scan_iter(match=pattern, count=500):
+                    group = key.decode("utf-8").rsplit(":", 1)[1]
+                    node = ring.node_for(group)
+                    if current[node] == url:
+                        continue
+                    moved[(name, node)] += 1
+                    if options["dry_run"]:
+                        continue
+                    if not self._copy(source, clients[current[node]], key):
+                        skipped += 1
+                    elif not options["keep"]:
+                        source.delete(key)
+
+        for (source, target), count in sorted(moved.items()):
+            self.stdout.write(f"{source} -> {target}: {count} claves")
+        self.stdout.write(self.style.SUCCESS(
+            f"{sum(moved.values())} claves {'a mover' if options['dry_run'] else 'movidas'}"
+            f" ({skipped} ya existían en el destino)"
+        ))
+
+    @staticmethod
+    def _copy(source, target, key):
+        # DUMP/RESTORE conserva el tipo (zset, stream, string) y el TTL
+        data = source.dump(key)
+        ttl = source.pttl(key)
+        if data is None or ttl == -2:
+            return False
+        try:
+            target.restore(key, max(ttl, 0), data)
+        except redis.ResponseError as e:
+            # BUSYKEY: el nodo nuevo ya tiene esa clave (corrida anterior o
+            # workers ya reiniciados); no se pisa
+            if "BUSYKEY" in str(e):
+                return False
+            raise
+        return True
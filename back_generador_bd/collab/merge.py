@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .presence import get_presence
+from .room_state import is_local, merge_result, room_key
+
+logger = logging.getLogger(__name__)
+
+
+def merge_target(mode, room_id):
+    """Sala (room_key) donde se mergearía una respuesta de este modo, o None."""
+    if mode not in ("edit", "delete") or not getattr(settings, "UML_SERVER_MERGE", True):
+        return None
+    try:
+        uuid.UUID(str(room_id))
+    except (TypeError, ValueError):
+        return None
+    return room_key(room_id)
+
+
+def merge_room(mode, room_id, result=None):
+    """Sala donde aplicar la respuesta, o None si no corresponde."""
+    if not isinstance(result, dict) or "error" in result:
+        return None
+    return merge_target(mode, room_id)
+
+
+async def apply_to_room(room_name, result, origin="llm", key=None):
+    """
+    Aplica la respuesta en el worker dueño de la sala.
+
+    Si hay peers conectados aquí se aplica directo; si están en otro
+    worker se le pide a uno de ellos por el channel layer (su estado en
+    memoria es el autoritativo) y se espera el resumen. Sin peers en
+    ningún lado se aplica sobre el BackupUML.
+
+    `key` identifica la respuesta (id del trabajo, o uno nuevo): si un
+    peer solo tardó y la petición se reenvía, la sala la aplica una vez.
+    """
+    key = key or uuid.uuid4().hex
+    channel_layer = get_channel_layer()
+    if channel_layer is None or is_local(room_name):
+        return await merge_result(room_name, result, channel_layer, origin, key)
+
+    timeout = getattr(settings, "UML_MERGE_FORWARD_TIMEOUT", 5.0)
+    for peer in await get_presence().peers(room_name):
+        reply_to = await channel_layer.new_channel()
+        try:
+            await channel_layer.send(peer, {
+                "type": "merge_request",
+                "result": result,
+                "origin": origin,
+                "key": key,
+                "reply_to": reply_to,
+            })
+            reply = await asyncio.wait_for(channel_layer.receive(reply_to), timeout)
+        except Exception as e:
+            # Peer caído o que no respondió: se prueba con el siguiente
+            logger.warning("No se pudo aplicar el merge vía %s: %s", peer, e)
+            continue
+        return reply["summary"]
+
+    return await merge_result(room_name, result, channel_layer, origin, key)
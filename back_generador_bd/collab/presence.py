@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import time
+import weakref
+
+from django.conf import settings
+
+from uml_api import metrics
+from uml_api.redis_conn import get_redis, get_sync_redis
+
+from .codecs import encode_frames
+
+logger = logging.getLogger(__name__)
+
+# Registro de presencia en Redis con tres sorted sets cuyo score es el
+# vencimiento (ms): peers de cada sala, salas activas y todos los peers
+# ("sala|peer"). Contar salas o peers vivos es un ZCOUNT, sin recorrer nada.
+# Cada worker renueva sus peers cada CANVAS_PRESENCE_HEARTBEAT segundos; si
+# un worker muere, sus peers vencen solos a los CANVAS_PRESENCE_TTL.
+TOUCH_SCRIPT = """
+local expires = tonumber(ARGV[1])
+local room = ARGV[2]
+for i = 3, #ARGV do
+    redis.call("zadd", KEYS[1], expires, ARGV[i])
+    redis.call("zadd", KEYS[3], expires, room .. "|" .. ARGV[i])
+end
+local current = tonumber(redis.call("zscore", KEYS[2], room))
+if not current or current < expires then
+    redis.call("zadd", KEYS[2], expires, room)
+end
+return #ARGV - 2
+"""
+
+LEAVE_SCRIPT = """
+local room = ARGV[1]
+redis.call("zrem", KEYS[1], ARGV[2])
+redis.call("zrem", KEYS[3], room .. "|" .. ARGV[2])
+if redis.call("zcard", KEYS[1]) == 0 then
+    redis.call("zrem", KEYS[2], room)
+end
+return 1
+"""
+
+# Devuelve los peers vencidos de la sala y los saca de los tres índices
+PRUNE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local room = ARGV[2]
+local expired = redis.call("zrangebyscore", KEYS[1], "-inf", now)
+for _, peer in ipairs(expired) do
+    redis.call("zrem", KEYS[1], peer)
+    redis.call("zrem", KEYS[3], room .. "|" .. peer)
+end
+if redis.call("zcard", KEYS[1]) == 0 then
+    redis.call("zrem", KEYS[2], room)
+end
+return expired
+"""
+
+
+class MemoryPresenceBackend:
+    """Mismo registro dentro del proceso, para cuando no hay Redis."""
+
+    def __init__(self):
+        self.rooms = {}
+
+    async def touch(self, room, peers, expires):
+        members = self.rooms.setdefault(room, {})
+        for peer in peers:
+            members[peer] = expires
+
+    async def leave(self, room, peer):
+        members = self.rooms.get(room)
+        if members is None:
+            return
+        members.pop(peer, None)
+        if not members:
+            del self.rooms[room]
+
+    async def prune(self, room, now):
+        members = self.rooms.get(room) or {}
+        expired = [peer for peer, expires in members.items() if expires <= now]
+        for peer in expired:
+            del members[peer]
+        if not members:
+            self.rooms.pop(room, None)
+        return expired
+
+    async def roster(self, room, now):
+        return [peer for peer, expires in (self.rooms.get(room) or {}).items() if expires > now]
+
+    def counts(self, now):
+        rooms = peers = 0
+        for members in self.rooms.values():
+            alive = sum(1 for expires in members.values() if expires > now)
+            if alive:
+                rooms += 1
+                peers += alive
+        return rooms, peers
+
+    def room_count(self, room, now):
+        return sum(1 for expires in (self.rooms.get(room) or {}).values() if expires > now)
+
+
+class RedisPresenceBackend:
+    prefix = "presence:"
+
+    def _keys(self, room):
+        return (f"{self.prefix}room:{room}", f"{self.prefix}rooms", f"{self.prefix}peers")
+
+    @staticmethod
+    def _decode(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    async def touch(self, room, peers, expires):
+        if peers:
+            await get_redis().eval(TOUCH_SCRIPT, 3, *self._keys(room), expires, room, *peers)
+
+    async def leave(self, room, peer):
+        await get_redis().eval(LEAVE_SCRIPT, 3, *self._keys(room), room, peer)
+
+    async def prune(self, room, now):
+        expired = await get_redis().eval(PRUNE_SCRIPT, 3, *self._keys(room), now, room)
+        return [self._decode(peer) for peer in expired or []]
+
+    async def roster(self, room, now):
+        peers = await get_redis().zrangebyscore(self._keys(room)[0], f"({now}", "+inf")
+        return [self._decode(peer) for peer in peers]
+
+    # Conteos desde vistas síncronas (DRF)
+    def counts(self, now):
+        client = get_sync_redis()
+        rooms = client.zcount(f"{self.prefix}rooms", f"({now}", "+inf")
+        peers = client.zcount(f"{self.prefix}peers", f"({now}", "+inf")
+        return rooms, peers
+
+    def room_count(self, room, now):
+        return get_sync_redis().zcount(self._keys(room)[0], f"({now}", "+inf")
+
+
+class PresenceDiffer:
+    """
+    Junta las altas y bajas de una sala y las manda como un solo
+    presence_diff cada CANVAS_PRESENCE_DIFF_MS. Una entrada y salida dentro
+    del mismo intervalo se cancelan: en una tormenta de reconexiones la sala
+    recibe un mensaje por intervalo en vez de uno por peer.
+    """
+
+    def __init__(self, channel_layer, group, interval):
+        self.channel_layer = channel_layer
+        self.group = group
+        self.interval = interval
+        self.joined = set()
+        self.left = set()
+        self._timer = None
+
+    def add(self, joined=(), left=()):
+        for peer in joined:
+            if peer in self.left:
+                self.left.discard(peer)
+            else:
+                self.joined.add(peer)
+        for peer in left:
+            if peer in self.joined:
+                self.joined.discard(peer)
+            else:
+                self.left.add(peer)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Error enviando presencia a %s", self.group)
+
+    async def flush(self):
+        if not self.joined and not self.left:
+            return
+        message = {"type": "presence_diff", "joined": sorted(self.joined), "left": sorted(self.left)}
+        self.joined = set()
+        self.left = set()
+        # Las listas van también sueltas: los clientes sin ?presence=diff
+        # reciben un presence join/leave por peer
+        await metrics.timed_group_send(self.channel_layer, self.group, {
+            "type": "presence",
+            "frames": encode_frames(message),
+            "joined": message["joined"],
+            "left": message["left"],
+        })
+
+
+class PresenceRegistry:
+    """
+    Quién está en cada sala. El worker guarda sus peers locales, los
+    renueva en Redis por heartbeat y publica los cambios como diffs.
+    """
+
+    def __init__(self):
+        self.use_redis = getattr(settings, "CANVAS_PRESENCE_REDIS", True)
+        self.ttl = getattr(settings, "CANVAS_PRESENCE_TTL", 30)
+        self.heartbeat = getattr(settings, "CANVAS_PRESENCE_HEARTBEAT", 10)
+        self.diff_interval = getattr(settings, "CANVAS_PRESENCE_DIFF_MS", 250) / 1000.0
+        self.memory = MemoryPresenceBackend()
+        self.redis = RedisPresenceBackend()
+        self.local = {}
+        self._differs = {}
+        self._loops = weakref.WeakKeyDictionary()
+        self.stats = {"joins": 0, "leaves": 0, "expired": 0, "redis_errors": 0}
+
+    def _redis_enabled(self):
+        return self.use_redis and get_redis() is not None
+
+    @staticmethod
+    def _now():
+        return int(time.time() * 1000)
+
+    async def _call(self, method, *args):
+        if self._redis_enabled():
+            try:
+                return await getattr(self.redis, method)(*args)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning("Presencia en Redis no disponible, se usa la local: %s", e)
+        return await getattr(self.memory, method)(*args)
+
+    def _differ(self, channel_layer, group):
+        differ = self._differs.get(group)
+        if differ is None:
+            differ = PresenceDiffer(channel_layer, group, self.diff_interval)
+            self._differs[group] = differ
+        return differ
+
+    # ---------- heartbeat ----------
+    def ensure_heartbeat(self, channel_layer):
+        loop = asyncio.get_running_loop()
+        if loop not in self._loops:
+            self._loops[loop] = loop.create_task(self._heartbeat(channel_layer))
+
+    async def _heartbeat(self, channel_layer):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self.beat(channel_layer)
+            except Exception:
+                logger.exception("Error en el heartbeat de presencia")
+
+    async def beat(self, channel_layer):
+        """Renueva los peers locales y avisa de los que vencieron (workers caídos)."""
+        now = self._now()
+        for room, peers in list(self.local.items()):
+            await self._call("touch", room, list(peers), now + self.ttl * 1000)
+            expired = [peer for peer in await self._call("prune", room, now) if peer not in peers]
+            if expired:
+                self.stats["expired"] += len(expired)
+                self._differ(channel_layer, f"canvas_{room}").add(left=expired)
+
+    # ---------- API de los consumers ----------
+    async def join(self, channel_layer, room, peer):
+        """Registra al peer y devuelve el roster que ya estaba en la sala."""
+        self.ensure_heartbeat(channel_layer)
+        now = self._now()
+        roster = [p for p in await self._call("roster", room, now) if p != peer]
+        self.local.setdefault(room, set()).add(peer)
+        await self._call("touch", room, [peer], now + self.ttl * 1000)
+        self.stats["joins"] += 1
+        self._differ(channel_layer, f"canvas_{room}").add(joined=[peer])
+        return roster
+
+    async def peers(self, room):
+        """Peers vivos de la sala en cualquier worker."""
+        return await self._call("roster", room, self._now())
+
+    async def leave(self, channel_layer, room, peer):
+        peers = self.local.get(room)
+        if peers is not None:
+            peers.discard(peer)
+            if not peers:
+                del self.local[room]
+        await self._call("leave", room, peer)
+        self.stats["leaves"] += 1
+        self._differ(channel_layer, f"canvas_{room}").add(left=[peer])
+
+    async def drop_room(self, group):
+        """Sin peers locales se manda lo pendiente y se suelta el differ."""
+        differ = self._differs.pop(group, None)
+        if differ is not None:
+            if differ._timer is not None:
+                differ._timer.cancel()
+            await differ.flush()
+
+    # ---------- conteos ----------
+    def counts(self, room=None):
+        backend = self.redis if self.use_redis and get_sync_redis() is not None else self.memory
+        now = self._now()
+        try:
+            if room is not None:
+                return {"room": room, "peers": backend.room_count(room, now)}
+            rooms, peers = backend.counts(now)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning("No se pudo contar la presencia en Redis: %s", e)
+            return self._memory_counts(room, now)
+        return {"rooms": rooms, "peers": peers}
+
+    def _memory_counts(self, room, now):
+        if room is not None:
+            return {"room": room, "peers": self.memory.room_count(room, now)}
+        rooms, peers = self.memory.counts(now)
+        return {"rooms": rooms, "peers": peers}
+
+    def snapshot(self):
+        return dict(
+            self.stats,
+            local_rooms=len(self.local),
+            local_peers=sum(len(p) for p in self.local.values()),
+            redis_enabled=bool(self.use_redis),
+        )
+
+
+_registry = None
+
+
+def get_presence():
+    global _registry
+    if _registry is None:
+        _registry = PresenceRegistry()
+    return _registry
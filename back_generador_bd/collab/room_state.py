@@ -0,0 +1,396 @@
+import asyncio
+import copy
+import logging
+import uuid
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from uml_api import metrics
+from uml_api.merge import UMLMerger
+from uml_api.persistence import load_backup, save_backup
+
+from .codecs import encode_frames
+
+logger = logging.getLogger(__name__)
+
+CLASS_FIELDS = ("name", "position", "size")
+RELATIONSHIP_FIELDS = ("type", "sourceId", "targetId", "labels", "vertices")
+MEMBER_FIELDS = {
+    "attribute": ("attributes", ("name", "type")),
+    "method": ("methods", ("name", "parameters", "returnType")),
+}
+
+
+# Respuestas del LLM ya aplicadas que recuerda cada sala
+MAX_MERGED_KEYS = 256
+
+
+class OpError(ValueError):
+    pass
+
+
+def _object(op, field):
+    """Campo opcional de la operación que tiene que ser un objeto."""
+    value = op.get(field)
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise OpError(f"'{field}' debe ser un objeto")
+    return value
+
+
+def _member_list(payload, field):
+    value = payload.get(field)
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(m, dict) for m in value):
+        raise OpError(f"'{field}' debe ser una lista de objetos")
+    return list(value)
+
+
+def _ref(value, what):
+    # Los ids se usan como clave de dict: una lista o un objeto no sirven
+    if not isinstance(value, str):
+        raise OpError(f"No existe {what} {value}")
+    return value
+
+
+class RoomState:
+    """
+    Estado autoritativo del diagrama de una sala.
+
+    Aplica operaciones finas (clase, atributo, método o relación) y
+    devuelve el delta normalizado que se reenvía a la sala. Cada
+    operación aceptada incrementa `version`.
+    """
+
+    def __init__(self, data=None, version=0):
+        data = data or {}
+        self.classes = {c["id"]: c for c in data.get("classes", []) if isinstance(c, dict) and c.get("id")}
+        self.relationships = {r["id"]: r for r in data.get("relationships", []) if isinstance(r, dict) and r.get("id")}
+        self.version = version
+        # Versión que ya está en el BackupUML; solo se guarda si hay más
+        self.saved_version = version
+        # Guardado diferido pendiente tras las últimas operaciones
+        self.save_task = None
+        # clave de merge -> resumen, para no aplicar dos veces la misma respuesta
+        self.merged = OrderedDict()
+        self.lock = asyncio.Lock()
+
+    def snapshot(self):
+        return {
+            "classes": list(self.classes.values()),
+            "relationships": list(self.relationships.values()),
+        }
+
+    def apply(self, op):
+        if not isinstance(op, dict):
+            raise OpError("La operación debe ser un objeto")
+        kind = op.get("t")
+        handler = OPS.get(kind)
+        if handler is None:
+            raise OpError(f"Operación desconocida: {kind}")
+        delta = handler(self, op)
+        self.version += 1
+        return delta
+
+    # ---------- clases ----------
+    def _get_class(self, class_id):
+        cls = self.classes.get(_ref(class_id, "la clase"))
+        if cls is None:
+            raise OpError(f"No existe la clase {class_id}")
+        return cls
+
+    def add_class(self, op):
+        class_id = _ref(op.get("id") or str(uuid.uuid4()), "la clase")
+        if class_id in self.classes:
+            raise OpError(f"La clase {class_id} ya existe")
+        payload = _object(op, "payload")
+        cls = {
+            "id": class_id,
+            "name": payload.get("name", ""),
+            "attributes": _member_list(payload, "attributes"),
+            "methods": _member_list(payload, "methods"),
+        }
+        for field in ("position", "size"):
+            if field in payload:
+                cls[field] = payload[field]
+        self.classes[class_id] = cls
+        return {"t": "add_class", "id": class_id, "payload": copy.deepcopy(cls)}
+
+    def update_class(self, op):
+        cls = self._get_class(op.get("id"))
+        changes = {k: v for k, v in _object(op, "changes").items() if k in CLASS_FIELDS}
+        if not changes:
+            raise OpError("update_class sin cambios válidos")
+        cls.update(changes)
+        return {"t": "update_class", "id": cls["id"], "changes": changes}
+
+    def delete_class(self, op):
+        cls = self._get_class(op.get("id"))
+        del self.classes[cls["id"]]
+        # Las relaciones que colgaban de la clase se eliminan con ella
+        removed = [
+            rel_id for rel_id, rel in self.relationships.items()
+            if rel.get("sourceId") == cls["id"] or rel.get("targetId") == cls["id"]
+        ]
+        for rel_id in removed:
+            del self.relationships[rel_id]
+        return {"t": "delete_class", "id": cls["id"], "removed_relationships": removed}
+
+    # ---------- atributos y métodos ----------
+    def _member_index(self, members, name):
+        for i, member in enumerate(members):
+            if isinstance(member, dict) and member.get("name") == name:
+                return i
+        raise OpError(f"No existe el miembro {name}")
+
+    def add_member(self, op, member):
+        key, fields = MEMBER_FIELDS[member]
+        cls = self._get_class(op.get("class_id"))
+        item = {k: v for k, v in _object(op, member).items() if k in fields}
+        if not item.get("name"):
+            raise OpError(f"El {member} necesita nombre")
+        members = cls.setdefault(key, [])
+        index = op.get("index")
+        if not isinstance(index, int) or not 0 <= index <= len(members):
+            index = len(members)
+        members.insert(index, item)
+        return {"t": f"add_{member}", "class_id": cls["id"], "index": index, member: item}
+
+    def update_member(self, op, member):
+        key, fields = MEMBER_FIELDS[member]
+        cls = self._get_class(op.get("class_id"))
+        members = cls.setdefault(key, [])
+        index = self._member_index(members, op.get("name"))
+        changes = {k: v for k, v in _object(op, "changes").items() if k in fields}
+        if not changes:
+            raise OpError(f"update_{member} sin cambios válidos")
+        members[index].update(changes)
+        return {"t": f"update_{member}", "class_id": cls["id"], "name": op.get("name"), "changes": changes}
+
+    def delete_member(self, op, member):
+        key, _ = MEMBER_FIELDS[member]
+        cls = self._get_class(op.get("class_id"))
+        members = cls.setdefault(key, [])
+        index = self._member_index(members, op.get("name"))
+        del members[index]
+        return {"t": f"delete_{member}", "class_id": cls["id"], "name": op.get("name")}
+
+    # ---------- relaciones ----------
+    def add_relationship(self, op):
+        rel_id = _ref(op.get("id") or str(uuid.uuid4()), "la relación")
+        if rel_id in self.relationships:
+            raise OpError(f"La relación {rel_id} ya existe")
+        payload = _object(op, "payload")
+        for end in ("sourceId", "targetId"):
+            self._get_class(payload.get(end))
+        rel = {"id": rel_id, "type": payload.get("type", "association")}
+        rel.update({k: payload[k] for k in RELATIONSHIP_FIELDS if k in payload and k != "type"})
+        self.relationships[rel_id] = rel
+        return {"t": "add_relationship", "id": rel_id, "payload": copy.deepcopy(rel)}
+
+    def update_relationship(self, op):
+        rel = self.relationships.get(_ref(op.get("id"), "la relación"))
+        if rel is None:
+            raise OpError(f"No existe la relación {op.get('id')}")
+        changes = {k: v for k, v in _object(op, "changes").items() if k in RELATIONSHIP_FIELDS}
+        if not changes:
+            raise OpError("update_relationship sin cambios válidos")
+        for end in ("sourceId", "targetId"):
+            if end in changes:
+                self._get_class(changes[end])
+        rel.update(changes)
+        return {"t": "update_relationship", "id": rel["id"], "changes": changes}
+
+    def delete_relationship(self, op):
+        rel = self.relationships.pop(_ref(op.get("id"), "la relación"), None)
+        if rel is None:
+            raise OpError(f"No existe la relación {op.get('id')}")
+        return {"t": "delete_relationship", "id": rel["id"]}
+
+
+OPS = {
+    "add_class": RoomState.add_class,
+    "update_class": RoomState.update_class,
+    "delete_class": RoomState.delete_class,
+    "add_relationship": RoomState.add_relationship,
+    "update_relationship": RoomState.update_relationship,
+    "delete_relationship": RoomState.delete_relationship,
+}
+for _member in MEMBER_FIELDS:
+    OPS[f"add_{_member}"] = lambda state, op, m=_member: state.add_member(op, m)
+    OPS[f"update_{_member}"] = lambda state, op, m=_member: state.update_member(op, m)
+    OPS[f"delete_{_member}"] = lambda state, op, m=_member: state.delete_member(op, m)
+
+
+# ---------- registro de salas del proceso ----------
+# El estado vive en el worker: las conexiones de una sala deben llegar
+# al mismo worker (afinidad de sala en el proxy).
+_rooms = {}
+_members = {}
+# Versión de las salas invalidadas con peers conectados: al recargar sigue
+# creciendo y los clientes no ven deltas con versiones repetidas
+_versions = {}
+_registry_lock = asyncio.Lock()
+
+
+def room_key(room_name):
+    """
+    Nombre canónico de una sala: el uuid en minúsculas y con guiones si lo
+    es. Con él se arman el registro de salas, los grupos y la presencia.
+    """
+    try:
+        return str(uuid.UUID(str(room_name)))
+    except ValueError:
+        return str(room_name)
+
+
+@database_sync_to_async
+def _load_backup(room_name):
+    try:
+        room_id = uuid.UUID(str(room_name))
+    except ValueError:
+        return None
+    return load_backup(room_id)
+
+
+@database_sync_to_async
+def _save_backup(room_name, data):
+    try:
+        room_id = uuid.UUID(str(room_name))
+    except ValueError:
+        return
+    save_backup(room_id, data)
+
+
+async def get_room_state(room_name):
+    state = _rooms.get(room_name)
+    if state is not None:
+        return state
+    async with _registry_lock:
+        state = _rooms.get(room_name)
+        if state is None:
+            state = RoomState(await _load_backup(room_name), _versions.pop(room_name, 0))
+            _rooms[room_name] = state
+    return state
+
+
+def join_room(room_name):
+    _members[room_name] = _members.get(room_name, 0) + 1
+
+
+async def leave_room(room_name):
+    """
+    Al salir el último peer se persiste lo pendiente y se libera la memoria.
+    Devuelve True si la sala quedó vacía en este worker.
+    """
+    count = _members.get(room_name, 1) - 1
+    if count > 0:
+        _members[room_name] = count
+        return False
+    _members.pop(room_name, None)
+    _versions.pop(room_name, None)
+    state = _rooms.pop(room_name, None)
+    if state is not None:
+        _cancel_save(state)
+        # Solo operaciones todavía no guardadas: un backup más nuevo (set_backupUML)
+        # ya sacó el estado de memoria y no se pisa
+        if state.version > state.saved_version:
+            await _save_backup(room_name, copy.deepcopy(state.snapshot()))
+    return True
+
+
+def schedule_save(room_name, state):
+    """
+    Programa el guardado tras una operación aceptada. Las ráfagas se
+    agrupan: a lo sumo un save_backup cada CANVAS_SAVE_DEBOUNCE segundos,
+    que con write-behind solo encola el estado en el BackupWriter.
+    """
+    if state.save_task is None or state.save_task.done():
+        state.save_task = asyncio.create_task(_save_later(room_name, state))
+
+
+async def _save_later(room_name, state):
+    await asyncio.sleep(getattr(settings, "CANVAS_SAVE_DEBOUNCE", 1.0))
+    try:
+        async with state.lock:
+            # Sala invalidada o liberada mientras tanto: ese camino ya guardó
+            if _rooms.get(room_name) is not state or state.version <= state.saved_version:
+                return
+            version = state.version
+            snapshot = copy.deepcopy(state.snapshot())
+        await _save_backup(room_name, snapshot)
+        state.saved_version = max(state.saved_version, version)
+    except Exception:
+        # Queda sin guardar; la próxima operación o la salida lo reintentan
+        logger.exception("Error guardando el estado de la sala %s", room_name)
+
+
+def _cancel_save(state):
+    if state.save_task is not None and not state.save_task.done():
+        state.save_task.cancel()
+    state.save_task = None
+
+
+def invalidate_room(room_id):
+    """
+    Se guardó un diagrama completo de la sala por fuera de las operaciones:
+    el estado en memoria queda viejo y se vuelve a cargar en el próximo uso.
+    """
+    room_name = room_key(room_id)
+    state = _rooms.pop(room_name, None)
+    if state is not None:
+        _cancel_save(state)
+        if is_local(room_name):
+            _versions[room_name] = state.version
+
+
+def is_local(room_name):
+    """True si la sala tiene peers conectados a este worker."""
+    return _members.get(room_name, 0) > 0
+
+
+async def merge_result(room_name, result, channel_layer=None, origin="llm", key=None):
+    """
+    Aplica una respuesta de edición/eliminación al estado de la sala,
+    reenvía los deltas a los peers y persiste el resultado. Con `key`, una
+    respuesta ya aplicada devuelve el resumen anterior sin tocar la sala.
+    """
+    state = await get_room_state(room_name)
+    snapshot = None
+    async with state.lock:
+        summary = state.merged.get(key) if key is not None else None
+        if summary is None:
+            applied, unresolved = UMLMerger(state).merge(result)
+            if applied and channel_layer is not None:
+                # Un solo group_send con un frame por operación, en orden de versión
+                await metrics.timed_group_send(channel_layer, f"canvas_{room_name}", {
+                    "type": "room_deltas",
+                    "frames": [
+                        encode_frames({"type": "delta", "from": origin, "op_id": None, "version": version, "op": delta})
+                        for delta, version in applied
+                    ],
+                })
+            if applied:
+                snapshot = copy.deepcopy(state.snapshot())
+                state.saved_version = state.version
+            summary = {
+                "version": state.version,
+                "deltas": [delta for delta, _ in applied],
+                "unresolved": unresolved,
+            }
+            if key is not None:
+                state.merged[key] = summary
+                while len(state.merged) > MAX_MERGED_KEYS:
+                    state.merged.popitem(last=False)
+
+    if snapshot is not None:
+        await _save_backup(room_name, snapshot)
+    if not is_local(room_name):
+        # Sin peers en este worker el estado no queda en memoria: el dueño
+        # de la sala puede estar en otro worker
+        _rooms.pop(room_name, None)
+    return summary
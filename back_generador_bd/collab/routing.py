@@ -4,4 +4,5 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r"^ws/canvas/(?P<room_name>[^/]+)/?$", consumers.CanvasConsumer.as_asgi()),
     re_path(r"^ws/uml/$", consumers.UMLConsumer.as_asgi()),
+    re_path(r"^ws/uml/(?P<room_name>[^/]+)/?$", consumers.UMLConsumer.as_asgi()),
 ]
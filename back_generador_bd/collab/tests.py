@@ -0,0 +1,295 @@
+import asyncio
+import json
+from unittest import mock
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, override_settings
+
+from . import catchup, codecs, routing
+from .batching import RoomBatcher, classify
+from .room_state import OpError, RoomState
+
+IN_MEMORY = {
+    "CHANNEL_LAYERS": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    "REDIS_URL": None,
+}
+
+
+def sample_state():
+    return RoomState({
+        "classes": [
+            {"id": "a", "name": "Venta", "attributes": [{"name": "total", "type": "float"}], "methods": []},
+            {"id": "b", "name": "Cliente", "attributes": [], "methods": []},
+        ],
+        "relationships": [{"id": "r", "type": "association", "sourceId": "a", "targetId": "b"}],
+    })
+
+
+class RoomStateOpsTests(SimpleTestCase):
+    """Operaciones finas sobre el estado de una sala."""
+
+    def test_each_accepted_op_bumps_the_version(self):
+        state = sample_state()
+        state.apply({"t": "add_class", "id": "c", "payload": {"name": "Pago"}})
+        state.apply({"t": "update_class", "id": "c", "changes": {"name": "Cobro", "color": "red"}})
+        self.assertEqual(state.version, 2)
+        self.assertEqual(state.classes["c"]["name"], "Cobro")
+        self.assertNotIn("color", state.classes["c"])
+
+    def test_delete_class_removes_its_relationships(self):
+        state = sample_state()
+        delta = state.apply({"t": "delete_class", "id": "b"})
+        self.assertEqual(delta["removed_relationships"], ["r"])
+        self.assertEqual(state.relationships, {})
+
+    def test_members_keep_their_position(self):
+        state = sample_state()
+        state.apply({"t": "add_attribute", "class_id": "a", "index": 0, "attribute": {"name": "fecha", "type": "Date"}})
+        state.apply({"t": "update_attribute", "class_id": "a", "name": "total", "changes": {"type": "int"}})
+        self.assertEqual(state.classes["a"]["attributes"], [
+            {"name": "fecha", "type": "Date"},
+            {"name": "total", "type": "int"},
+        ])
+        state.apply({"t": "delete_attribute", "class_id": "a", "name": "fecha"})
+        self.assertEqual([a["name"] for a in state.classes["a"]["attributes"]], ["total"])
+
+    def test_relationship_ends_must_exist(self):
+        state = sample_state()
+        with self.assertRaises(OpError):
+            state.apply({"t": "add_relationship", "payload": {"sourceId": "a", "targetId": "zz"}})
+        with self.assertRaises(OpError):
+            state.apply({"t": "update_relationship", "id": "r", "changes": {"targetId": "zz"}})
+        self.assertEqual(state.version, 0)
+
+    def test_malformed_ops_raise_op_error(self):
+        state = sample_state()
+        malformed = [
+            None,
+            {"t": "nope"},
+            {"t": "update_class", "id": "a", "changes": ["a"]},
+            {"t": "update_class", "id": "a", "changes": "x"},
+            {"t": "add_attribute", "class_id": "a", "attribute": "x"},
+            {"t": "add_class", "payload": {"attributes": "abc"}},
+            {"t": "add_class", "id": ["x"]},
+            {"t": "update_relationship", "id": "r", "changes": 7},
+            {"t": "delete_relationship", "id": {"r": 1}},
+        ]
+        for op in malformed:
+            with self.subTest(op=op), self.assertRaises(OpError):
+                state.apply(op)
+        self.assertEqual(state.version, 0)
+
+
+@override_settings(**IN_MEMORY, CANVAS_BATCHING=False, CANVAS_SAVE_DEBOUNCE=60)
+class CanvasOpsSocketTests(SimpleTestCase):
+    """Ops por el websocket: el delta llega a la sala y un op inválido no cierra el socket."""
+
+    async def connect(self, room):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), f"/ws/canvas/{room}/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # su propio presence join
+        return communicator
+
+    async def test_bad_op_is_rejected_and_socket_stays_open(self):
+        socket = await self.connect("sala-ops")
+        try:
+            await socket.send_json_to({"type": "op", "op_id": 1, "op": {"t": "update_class", "id": "a", "changes": ["a"]}})
+            rejected = await socket.receive_json_from()
+            self.assertEqual(rejected["type"], "op_rejected")
+            self.assertEqual(rejected["op_id"], 1)
+
+            await socket.send_json_to({"type": "op", "op_id": 2, "op": {"t": "add_class", "id": "c1", "payload": {"name": "A"}}})
+            delta = await socket.receive_json_from()
+            self.assertEqual((delta["type"], delta["op_id"], delta["version"]), ("delta", 2, 1))
+        finally:
+            await socket.disconnect()
+
+
+@override_settings(CANVAS_CATCHUP=False)
+class BatchingTests(SimpleTestCase):
+    """Lotes por tick: los drag/cursor del mismo peer se fusionan y el orden se respeta."""
+
+    def setUp(self):
+        room_log = mock.patch.object(catchup, "_log", catchup.RoomLog())
+        room_log.start()
+        self.addCleanup(room_log.stop)
+        self.layer = mock.Mock()
+        self.layer.group_send = mock.AsyncMock()
+
+    def sent_items(self, call):
+        group, event = call.args
+        self.assertEqual((group, event["type"]), ("canvas_sala", "broadcast_batch"))
+        return [json.loads(frames["json"]) for frames in event["item_frames"]]
+
+    def test_classify(self):
+        self.assertEqual(classify("p1", {"t": "move", "id": "c1"}), ("drag", ("p1", "move", "c1", None)))
+        self.assertEqual(classify("p1", {"type": "cursor"}), ("cursor", ("p1", "cursor", None, None)))
+        self.assertEqual(classify("p1", {"t": "add_class"}), ("default", None))
+        self.assertEqual(classify("p1", "texto"), ("default", None))
+
+    async def test_superseded_updates_are_merged(self):
+        batcher = RoomBatcher(self.layer, "canvas_sala")
+        batcher.add("p1", {"t": "move", "id": "c1", "x": 1})
+        batcher.add("p1", {"t": "rename", "id": "c1", "name": "Venta"})
+        batcher.add("p2", {"t": "move", "id": "c1", "x": 5})
+        batcher.add("p1", {"t": "move", "id": "c1", "x": 2})
+        await batcher.flush()
+
+        items = self.sent_items(self.layer.group_send.await_args)
+        self.assertEqual([(i["from"], i["payload"]) for i in items], [
+            ("p1", {"t": "rename", "id": "c1", "name": "Venta"}),
+            ("p2", {"t": "move", "id": "c1", "x": 5}),
+            ("p1", {"t": "move", "id": "c1", "x": 2}),
+        ])
+        self.assertEqual(batcher.stats, {"received": 4, "merged": 1, "batches": 1})
+        await batcher.flush()  # sin pendientes no se manda nada
+        self.assertEqual(self.layer.group_send.await_count, 1)
+
+    async def test_shortest_tick_flushes_everything(self):
+        batcher = RoomBatcher(self.layer, "canvas_sala", {"cursor": 1000, "default": 10})
+        batcher.add("p1", {"t": "cursor", "x": 1})
+        await asyncio.sleep(0.05)
+        self.layer.group_send.assert_not_awaited()
+        batcher.add("p2", {"t": "add_class"})
+        await asyncio.sleep(0.05)
+        items = self.sent_items(self.layer.group_send.await_args)
+        self.assertEqual([i["from"] for i in items], ["p1", "p2"])
+
+    def test_batch_frame_is_built_from_item_frames(self):
+        items = [{"type": "broadcast", "from": "p1", "payload": {"t": "move", "x": 1.5, "name": "Señal"}},
+                 {"type": "broadcast", "from": "p2", "payload": {"t": "cursor"}}]
+        frames = codecs.batch_frames([codecs.encode_frames(item) for item in items], codecs.JSON)
+        self.assertEqual(json.loads(frames["json"]), {"type": "batch", "items": items})
+
+
+@override_settings(**IN_MEMORY, CANVAS_BATCH_TICKS={"cursor": 100, "drag": 100, "default": 100},
+                   CANVAS_CATCHUP=False)
+class BatchingSocketTests(SimpleTestCase):
+    """Un cliente con ?batch=1 recibe un frame por lote; los viejos, uno por mensaje."""
+
+    async def connect(self, query=""):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns),
+                                             f"/ws/canvas/sala-lotes/{query}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()  # su propio presence join
+        return communicator
+
+    async def receive(self, communicator):
+        # Los presence join de los demás llegan intercalados
+        while True:
+            message = await communicator.receive_json_from()
+            if message["type"] != "presence":
+                return message
+
+    async def test_batched_and_plain_clients(self):
+        with mock.patch.object(catchup, "_log", catchup.RoomLog()):
+            sender = await self.connect()
+            batched = await self.connect("?batch=1")
+            plain = await self.connect()
+            try:
+                for x in (1, 2, 3):
+                    await sender.send_json_to({"type": "broadcast", "payload": {"t": "move", "id": "c1", "x": x}})
+
+                batch = await self.receive(batched)
+                self.assertEqual(batch["type"], "batch")
+                self.assertEqual([item["payload"]["x"] for item in batch["items"]], [3])
+                message = await self.receive(plain)
+                self.assertEqual((message["type"], message["payload"]["x"]), ("broadcast", 3))
+                self.assertTrue(await plain.receive_nothing(0.1))
+            finally:
+                for communicator in (sender, batched, plain):
+                    await communicator.disconnect()
+
+
+@override_settings(CANVAS_CATCHUP_REDIS=False, CANVAS_CATCHUP_MAXLEN=5, CANVAS_CATCHUP_MAX_REPLAY=3)
+class CatchupLogTests(SimpleTestCase):
+    """Resume: lo perdido si sigue en el log, snapshot (None) si no."""
+
+    async def log_with(self, count):
+        log = catchup.RoomLog()
+        for n in range(count):
+            await log.append("canvas_sala", [{"type": "broadcast", "payload": {"n": n + 1}}])
+        return log
+
+    async def test_append_assigns_consecutive_seqs(self):
+        log = catchup.RoomLog()
+        messages = [{"type": "broadcast"}, {"type": "broadcast"}]
+        await log.append("canvas_sala", messages)
+        await log.append("canvas_otra", [{"type": "broadcast"}])
+        self.assertEqual([m["seq"] for m in messages], [1, 2])
+        self.assertEqual(await log.head("canvas_sala"), 2)
+        self.assertEqual(await log.head("canvas_otra"), 1)
+        self.assertEqual(await log.head("canvas_vacia"), 0)
+
+    async def test_replays_only_what_was_missed(self):
+        log = await self.log_with(4)
+        head, messages = await log.replay("canvas_sala", 2)
+        self.assertEqual(head, 4)
+        self.assertEqual([(m["seq"], m["payload"]["n"]) for m in messages], [(3, 3), (4, 4)])
+        self.assertEqual(await log.replay("canvas_sala", 4), (4, []))
+
+    async def test_snapshot_when_replay_is_not_possible(self):
+        log = await self.log_with(7)  # el log guarda solo del 3 al 7
+        cases = {
+            "hueco recortado": 1,
+            "demasiados mensajes": 3,
+            "log reiniciado": 9,
+            "seq inválido": "x",
+            "booleano": True,
+        }
+        for case, seq in cases.items():
+            with self.subTest(case):
+                self.assertEqual(await log.replay("canvas_sala", seq), (7, None))
+        self.assertEqual(len((await log.replay("canvas_sala", 4))[1]), 3)
+        self.assertEqual(log.stats["snapshots"], 5)
+
+    @override_settings(CANVAS_CATCHUP=False)
+    async def test_disabled_log(self):
+        log = catchup.RoomLog()
+        message = {"type": "broadcast"}
+        await log.append("canvas_sala", [message])
+        self.assertNotIn("seq", message)
+        self.assertEqual(await log.replay("canvas_sala", 0), (None, None))
+
+
+@override_settings(**IN_MEMORY, CANVAS_BATCHING=False, CANVAS_CATCHUP_REDIS=False)
+class CatchupSocketTests(SimpleTestCase):
+    """Un peer que vuelve con el último seq recibe solo los broadcast perdidos."""
+
+    async def connect(self, room):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns),
+                                             f"/ws/canvas/{room}/?presence=diff")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        roster = await communicator.receive_json_from()
+        self.assertEqual(roster["type"], "roster")
+        return communicator, roster["seq"]
+
+    async def receive(self, communicator, kind):
+        while True:
+            message = await communicator.receive_json_from()
+            if message["type"] == kind:
+                return message
+
+    async def test_resume_after_reconnect(self):
+        with mock.patch.object(catchup, "_log", catchup.RoomLog()):
+            sender, seq = await self.connect("sala-catchup")
+            try:
+                self.assertEqual(seq, 0)
+                for x in (1, 2, 3):
+                    await sender.send_json_to({"type": "broadcast", "payload": {"t": "move", "x": x}})
+                    # El propio broadcast vuelve con su seq
+                    self.assertEqual((await self.receive(sender, "broadcast"))["seq"], x)
+                back, head = await self.connect("sala-catchup")
+                self.assertEqual(head, 3)
+
+                await back.send_json_to({"type": "resume", "seq": 1})
+                message = await self.receive(back, "catchup")
+                self.assertEqual(message["seq"], 3)
+                self.assertEqual([(m["seq"], m["payload"]["x"]) for m in message["items"]], [(2, 2), (3, 3)])
+                await back.disconnect()
+            finally:
+                await sender.disconnect()
@@ -52,6 +52,168 @@ env = environ.Env()
 environ.Env.read_env(os.path.join(BASE_DIR, '.env'))
 
 GEMINI_API_KEY = env("GEMINI_API_KEY")
+# Endpoints alternativos (p. ej. el Gemini falso de bench/); vacío = Google
+GEMINI_API_URL = env("GEMINI_API_URL", default="")
+GEMINI_STREAM_URL = env("GEMINI_STREAM_URL", default="")
+
+# Cliente HTTP asíncrono para Gemini (pool keep-alive, timeouts y reintentos)
+GEMINI_CONNECT_TIMEOUT = env.float("GEMINI_CONNECT_TIMEOUT", default=5.0)
+GEMINI_READ_TIMEOUT = env.float("GEMINI_READ_TIMEOUT", default=60.0)
+GEMINI_MAX_CONNECTIONS = env.int("GEMINI_MAX_CONNECTIONS", default=20)
+GEMINI_MAX_KEEPALIVE = env.int("GEMINI_MAX_KEEPALIVE", default=10)
+GEMINI_MAX_CONCURRENCY = env.int("GEMINI_MAX_CONCURRENCY", default=8)
+GEMINI_MAX_RETRIES = env.int("GEMINI_MAX_RETRIES", default=3)
+GEMINI_BACKOFF_BASE = env.float("GEMINI_BACKOFF_BASE", default=0.5)
+# Tope de espera entre reintentos; un Retry-After mayor corta los reintentos
+GEMINI_MAX_BACKOFF = env.float("GEMINI_MAX_BACKOFF", default=10.0)
+
+# Varios backends del LLM: LLM_BACKENDS="flash=gemini:gemini-2.0-flash,
+# lite=gemini:gemini-2.0-flash-lite" (o una URL :generateContent). Se elige
+# el de menor EWMA de latencia/errores; LLM_FAILURES_TO_COOLDOWN fallas
+# seguidas lo sacan LLM_COOLDOWN s. Con LLM_HEDGE, si la respuesta supera el
+# LLM_HEDGE_PERCENTILE del backend se pide también al siguiente (a lo sumo
+# en LLM_HEDGE_MAX_RATIO de las llamadas). Vacío = GEMINI_API_URL
+LLM_BACKENDS = env.list("LLM_BACKENDS", default=[])
+LLM_EWMA_ALPHA = env.float("LLM_EWMA_ALPHA", default=0.2)
+LLM_EXPLORE = env.float("LLM_EXPLORE", default=0.05)
+LLM_COOLDOWN = env.float("LLM_COOLDOWN", default=30.0)
+LLM_FAILURES_TO_COOLDOWN = env.int("LLM_FAILURES_TO_COOLDOWN", default=3)
+LLM_HEDGE = env.bool("LLM_HEDGE", default=False)
+LLM_HEDGE_PERCENTILE = env.float("LLM_HEDGE_PERCENTILE", default=95.0)
+LLM_HEDGE_MIN_DELAY = env.float("LLM_HEDGE_MIN_DELAY", default=0.2)
+LLM_HEDGE_MAX_RATIO = env.float("LLM_HEDGE_MAX_RATIO", default=0.1)
+
+# Caché de respuestas del LLM (LRU en proceso + Redis opcional)
+UML_CACHE_TTL = env.int("UML_CACHE_TTL", default=3600)
+UML_CACHE_MAX_ENTRIES = env.int("UML_CACHE_MAX_ENTRIES", default=512)
+UML_CACHE_MAX_BYTES = env.int("UML_CACHE_MAX_BYTES", default=32 * 1024 * 1024)
+UML_CACHE_REDIS = env.bool("UML_CACHE_REDIS", default=False)
+
+# Single-flight: llamadas idénticas concurrentes comparten un solo round-trip
+UML_SINGLEFLIGHT_REDIS = env.bool("UML_SINGLEFLIGHT_REDIS", default=True)
+UML_SINGLEFLIGHT_LOCK_TTL = env.int("UML_SINGLEFLIGHT_LOCK_TTL", default=90)
+UML_SINGLEFLIGHT_WAIT_TIMEOUT = env.int("UML_SINGLEFLIGHT_WAIT_TIMEOUT", default=90)
+UML_SINGLEFLIGHT_RESULT_TTL = env.int("UML_SINGLEFLIGHT_RESULT_TTL", default=30)
+
+# Persistencia write-behind de BackupUML (debounce + upsert por lotes). El
+# buffer es por proceso y los otros workers leen lo pendiente de la caché de
+# payload en Redis: sin Redis, con varios workers, BACKUP_WRITE_BEHIND=False
+BACKUP_WRITE_BEHIND = env.bool("BACKUP_WRITE_BEHIND", default=True)
+BACKUP_FLUSH_DEBOUNCE = env.float("BACKUP_FLUSH_DEBOUNCE", default=2.0)
+BACKUP_FLUSH_MAX_DELAY = env.float("BACKUP_FLUSH_MAX_DELAY", default=10.0)
+BACKUP_FLUSH_INTERVAL = env.float("BACKUP_FLUSH_INTERVAL", default=0.5)
+BACKUP_FLUSH_BATCH_SIZE = env.int("BACKUP_FLUSH_BATCH_SIZE", default=200)
+
+# Historial de BackupUML: snapshots cada N revisiones + patches comprimidos
+BACKUP_HISTORY = env.bool("BACKUP_HISTORY", default=True)
+BACKUP_SNAPSHOT_EVERY = env.int("BACKUP_SNAPSHOT_EVERY", default=50)
+BACKUP_REVISION_CACHE_ROOMS = env.int("BACKUP_REVISION_CACHE_ROOMS", default=256)
+
+# Payload pre-serializado de get_backup_uml (ETag / 304 / gzip). Sin Redis
+# la caché es por proceso y solo se refresca en el worker que escribe:
+# con varios workers hace falta BACKUP_PAYLOAD_CACHE_REDIS
+BACKUP_PAYLOAD_CACHE_ENTRIES = env.int("BACKUP_PAYLOAD_CACHE_ENTRIES", default=512)
+BACKUP_PAYLOAD_GZIP_MIN = env.int("BACKUP_PAYLOAD_GZIP_MIN", default=1024)
+BACKUP_PAYLOAD_CACHE_REDIS = env.bool("BACKUP_PAYLOAD_CACHE_REDIS", default=True)
+BACKUP_PAYLOAD_CACHE_TTL = env.int("BACKUP_PAYLOAD_CACHE_TTL", default=3600)
+
+# Validación local del UML antes de Gemini (False en UML_VALIDATION_LLM
+# deja solo la pasada estructural)
+UML_LOCAL_VALIDATION = env.bool("UML_LOCAL_VALIDATION", default=True)
+UML_VALIDATION_LLM = env.bool("UML_VALIDATION_LLM", default=True)
+UML_VALIDATION_ROOMS = env.int("UML_VALIDATION_ROOMS", default=256)
+
+# Prompt compacto de análisis: diagramas con más relaciones se parten en
+# componentes conexas analizadas en paralelo
+UML_PROMPT_CHUNK_RELATIONSHIPS = env.int("UML_PROMPT_CHUNK_RELATIONSHIPS", default=40)
+
+# Trabajos de LLM en segundo plano (/api/chatbot/ con "async": true)
+UML_JOBS_REDIS = env.bool("UML_JOBS_REDIS", default=True)
+UML_JOB_WORKERS = env.int("UML_JOB_WORKERS", default=4)
+UML_JOB_TTL = env.int("UML_JOB_TTL", default=3600)
+UML_JOB_POLL_INTERVAL = env.float("UML_JOB_POLL_INTERVAL", default=1.0)
+# Un trabajo en curso cuyo worker no lo renueva en este plazo (s) se
+# reencola, hasta UML_JOB_MAX_ATTEMPTS veces
+UML_JOB_VISIBILITY_TIMEOUT = env.int("UML_JOB_VISIBILITY_TIMEOUT", default=300)
+UML_JOB_MAX_ATTEMPTS = env.int("UML_JOB_MAX_ATTEMPTS", default=3)
+# "priority": "high" solo con el header X-Priority-Token igual a este valor
+UML_JOB_PRIORITY_TOKEN = env("UML_JOB_PRIORITY_TOKEN", default="")
+
+# Lotes de prompts (/api/chatbot/batch/): máximo de ítems por pedido y de
+# llamadas a Gemini en paralelo por lote
+UML_BATCH_MAX_ITEMS = env.int("UML_BATCH_MAX_ITEMS", default=100)
+UML_BATCH_CONCURRENCY = env.int("UML_BATCH_CONCURRENCY", default=4)
+
+# Límite de llamadas a Gemini por minuto (global, por sala y por cliente)
+# y load-shedding cuando la latencia de Gemini supera UML_SHED_LATENCY
+UML_RATE_LIMIT = env.bool("UML_RATE_LIMIT", default=True)
+UML_RATE_REDIS = env.bool("UML_RATE_REDIS", default=True)
+UML_RATE_GLOBAL = env.int("UML_RATE_GLOBAL", default=120)
+UML_RATE_GLOBAL_BURST = env.int("UML_RATE_GLOBAL_BURST", default=20)
+UML_RATE_ROOM = env.int("UML_RATE_ROOM", default=30)
+UML_RATE_ROOM_BURST = env.int("UML_RATE_ROOM_BURST", default=5)
+UML_RATE_CLIENT = env.int("UML_RATE_CLIENT", default=20)
+UML_RATE_CLIENT_BURST = env.int("UML_RATE_CLIENT_BURST", default=5)
+UML_RATE_MAX_WAIT = env.float("UML_RATE_MAX_WAIT", default=5.0)
+# IPs o redes de los proxies propios: solo detrás de ellos se usa
+# X-Forwarded-For para el bucket por cliente (p. ej. "10.0.0.0/8,127.0.0.1")
+TRUSTED_PROXIES = env.list("TRUSTED_PROXIES", default=[])
+UML_SHED_LATENCY = env.float("UML_SHED_LATENCY", default=15.0)
+UML_SHED_PROBE_INTERVAL = env.float("UML_SHED_PROBE_INTERVAL", default=5.0)
+# Un timeout o error de Gemini cuenta como esta cantidad de veces el umbral
+UML_SHED_FAILURE_PENALTY = env.float("UML_SHED_FAILURE_PENALTY", default=2.0)
+
+# Las operaciones del canvas se guardan (vía write-behind) a lo sumo cada
+# CANVAS_SAVE_DEBOUNCE segundos, no solo cuando sale el último peer
+CANVAS_SAVE_DEBOUNCE = env.float("CANVAS_SAVE_DEBOUNCE", default=1.0)
+
+# Broadcast del canvas agrupado por ticks (ms) según la clase de mensaje
+CANVAS_BATCHING = env.bool("CANVAS_BATCHING", default=True)
+CANVAS_BATCH_TICKS = {
+    "cursor": env.int("CANVAS_BATCH_TICK_CURSOR", default=50),
+    "drag": env.int("CANVAS_BATCH_TICK_DRAG", default=33),
+    "default": env.int("CANVAS_BATCH_TICK_DEFAULT", default=16),
+}
+
+# Subprotocolo binario del canvas: en las variantes .deflate solo se
+# comprimen los frames a partir de este tamaño
+CANVAS_DEFLATE_MIN_BYTES = env.int("CANVAS_DEFLATE_MIN_BYTES", default=256)
+# Strings internados por sala antes de reiniciar la tabla de referencias
+CANVAS_INTERN_MAX_STRINGS = env.int("CANVAS_INTERN_MAX_STRINGS", default=10000)
+
+# Presencia por sala: registro en Redis con heartbeat/TTL (s) y cambios
+# agrupados en un presence_diff cada CANVAS_PRESENCE_DIFF_MS
+CANVAS_PRESENCE_REDIS = env.bool("CANVAS_PRESENCE_REDIS", default=True)
+CANVAS_PRESENCE_TTL = env.int("CANVAS_PRESENCE_TTL", default=30)
+CANVAS_PRESENCE_HEARTBEAT = env.int("CANVAS_PRESENCE_HEARTBEAT", default=10)
+CANVAS_PRESENCE_DIFF_MS = env.int("CANVAS_PRESENCE_DIFF_MS", default=250)
+
+# Log de broadcasts por sala (Redis Stream) para el catch-up al reconectar:
+# se guardan los últimos CANVAS_CATCHUP_MAXLEN y un resume que pide más de
+# CANVAS_CATCHUP_MAX_REPLAY recibe un snapshot
+CANVAS_CATCHUP = env.bool("CANVAS_CATCHUP", default=True)
+CANVAS_CATCHUP_REDIS = env.bool("CANVAS_CATCHUP_REDIS", default=True)
+CANVAS_CATCHUP_MAXLEN = env.int("CANVAS_CATCHUP_MAXLEN", default=1000)
+CANVAS_CATCHUP_MAX_REPLAY = env.int("CANVAS_CATCHUP_MAX_REPLAY", default=500)
+CANVAS_CATCHUP_TTL = env.int("CANVAS_CATCHUP_TTL", default=3600)
+
+# Merge en el servidor de las respuestas edit/delete con room_id: se
+# aplican al RoomState de la sala y solo se difunden los deltas
+UML_SERVER_MERGE = env.bool("UML_SERVER_MERGE", default=True)
+UML_MERGE_FORWARD_TIMEOUT = env.float("UML_MERGE_FORWARD_TIMEOUT", default=5.0)
+
+# Métricas en /api/metrics/ (Prometheus); METRICS_TRACING agrega spans por
+# petición, que se loguean como JSON en el logger "uml.trace"
+METRICS_TRACING = env.bool("METRICS_TRACING", default=False)
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "uml.trace": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
 
 
 CHANNEL_LAYERS = {
@@ -63,8 +225,30 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Sharding de salas: CANVAS_SHARDS="a=redis://redis-a:6379/0,b=redis://redis-b:6379/0"
+# reparte los grupos de sala (y su log de catch-up) por hashing consistente.
+# CANVAS_SHARD_NODE es el nodo de este worker y CANVAS_SHARD_UPSTREAMS
+# ("a=http://daphne-a:8000,...") lo que publica /api/shards/ para el proxy
+CANVAS_SHARDS = env.list("CANVAS_SHARDS", default=[])
+CANVAS_SHARD_NODE = env("CANVAS_SHARD_NODE", default="")
+CANVAS_SHARD_UPSTREAMS = env.list("CANVAS_SHARD_UPSTREAMS", default=[])
+CANVAS_SHARD_VNODES = env.int("CANVAS_SHARD_VNODES", default=160)
+
+if len(CANVAS_SHARDS) > 1:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "collab.layers.ShardedChannelLayer",
+            "CONFIG": {
+                "shards": CANVAS_SHARDS,
+                "node": CANVAS_SHARD_NODE,
+                "vnodes": CANVAS_SHARD_VNODES,
+            },
+        },
+    }
+
 
 MIDDLEWARE = [
+    "uml_api.tracing.TracingMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .redis_conn import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Campos de layout que no cambian el significado del diagrama
+LAYOUT_FIELDS = ("position", "size", "vertices")
+
+
+def normalize_prompt(prompt: str):
+    return re.sub(r"\s+", " ", prompt.strip())
+
+
+def make_key(mode: str, content: str):
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return f"{mode}:{digest}"
+
+
+class ResponseCache:
+    """
+    Caché de respuestas del LLM direccionada por contenido.
+
+    Nivel 1: LRU en proceso con TTL y límite de entradas/bytes.
+    Nivel 2 (opcional): Redis de CHANNEL_LAYERS con TTL.
+    """
+
+    def __init__(self):
+        self.ttl = getattr(settings, "UML_CACHE_TTL", 3600)
+        self.max_entries = getattr(settings, "UML_CACHE_MAX_ENTRIES", 512)
+        self.max_bytes = getattr(settings, "UML_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+        self.use_redis = getattr(settings, "UML_CACHE_REDIS", False)
+        self.prefix = "umlcache:"
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits_local": 0,
+            "hits_redis": 0,
+            "misses": 0,
+            "sets": 0,
+            "evictions": 0,
+            "redis_errors": 0,
+        }
+
+    # ---------- nivel local ----------
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value.encode("utf-8"))
+
+    # ---------- API ----------
+    async def get(self, key):
+        value = self._get_local(key)
+        if value is not None:
+            self.stats["hits_local"] += 1
+            return value
+
+        redis = get_redis() if self.use_redis else None
+        if redis is not None:
+            try:
+                raw = await redis.get(self.prefix + key)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning("Error leyendo caché Redis: %s", e)
+                raw = None
+            if raw is not None:
+                value = raw.decode("utf-8")
+                self._set_local(key, value)
+                self.stats["hits_redis"] += 1
+                return value
+
+        self.stats["misses"] += 1
+        return None
+
+    async def get_many(self, keys):
+        """{clave: valor} de las que están; las que faltan en local van en un solo MGET."""
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            value = self._get_local(key)
+            if value is not None:
+                self.stats["hits_local"] += 1
+                found[key] = value
+            else:
+                missing.append(key)
+
+        redis = get_redis() if self.use_redis and missing else None
+        if redis is not None:
+            try:
+                raws = await redis.mget([self.prefix + key for key in missing])
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning("Error leyendo caché Redis: %s", e)
+                raws = [None] * len(missing)
+            for key, raw in zip(missing, raws):
+                if raw is not None:
+                    found[key] = raw.decode("utf-8")
+                    self._set_local(key, found[key])
+                    self.stats["hits_redis"] += 1
+
+        self.stats["misses"] += sum(1 for key in missing if key not in found)
+        return found
+
+    async def set(self, key, value):
+        self.stats["sets"] += 1
+        self._set_local(key, value)
+
+        redis = get_redis() if self.use_redis else None
+        if redis is not None:
+            try:
+                await redis.set(self.prefix + key, value, ex=self.ttl)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning("Error escribiendo caché Redis: %s", e)
+
+    def snapshot(self):
+        with self._lock:
+            entries, size = len(self._entries), self._bytes
+        lookups = self.stats["hits_local"] + self.stats["hits_redis"] + self.stats["misses"]
+        hits = self.stats["hits_local"] + self.stats["hits_redis"]
+        return {
+            **self.stats,
+            "entries": entries,
+            "bytes": size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "redis_enabled": bool(self.use_redis),
+        }
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
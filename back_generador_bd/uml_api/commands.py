@@ -0,0 +1,392 @@
+import copy
+import re
+import threading
+import time
+import uuid
+
+# Motor local para órdenes simples de edición/eliminación: se interpretan
+# con una gramática fija y se aplican al JSON UML sin pasar por Gemini.
+# Si el prompt no encaja en la gramática se devuelve None y se usa el LLM.
+
+NAME = r"([\w]+)"
+TYPE = r"([\w]+(?:<[\w, ]+>)?(?:\[\])?)"
+ART = r"(?:(?:el|la|los|las|un|una|al|del)\s+)?"
+DEL = r"(?:elimina|eliminar|borra|borrar|quita|quitar|remueve|remover|saca|sacar|delete|remove)"
+ADD = r"(?:agrega|agregar|añade|añadir|anade|anadir|pon|poner|crea|crear)"
+RENAME = r"(?:renombra|renombrar|cambia|cambiar|modifica|modificar)"
+OF_CLASS = r"\s+(?:de|en|a|al|del|para)\s+(?:la\s+)?(?:clase\s+)?"
+TO = r"\s+(?:a|por|como)\s+"
+ATTR = r"(?:atributo|campo)"
+METHOD = r"(?:m[eé]todo|funci[oó]n)"
+REL = r"relaci[oó]n"
+
+RELATION_TYPES = {
+    "asociacion": "association",
+    "agregacion": "aggregation",
+    "composicion": "composition",
+    "herencia": "generalization",
+    "generalizacion": "generalization",
+    "dependencia": "dependency",
+    "association": "association",
+    "aggregation": "aggregation",
+    "composition": "composition",
+    "generalization": "generalization",
+    "dependency": "dependency",
+}
+REL_TYPE = r"(asociaci[oó]n|agregaci[oó]n|composici[oó]n|herencia|generalizaci[oó]n|dependencia)"
+
+GRAMMAR = [
+    ("delete_attribute", rf"{DEL}\s+{ART}{ATTR}\s+{NAME}{OF_CLASS}{NAME}"),
+    ("delete_method", rf"{DEL}\s+{ART}{METHOD}\s+{NAME}(?:\(\))?{OF_CLASS}{NAME}"),
+    ("delete_relationship", rf"{DEL}\s+{ART}{REL}(?:\s+de\s+{REL_TYPE})?\s+entre\s+{NAME}\s+y\s+{NAME}"),
+    ("delete_class", rf"{DEL}\s+{ART}clase\s+{NAME}"),
+    ("retype_attribute", rf"{RENAME}\s+{ART}tipo\s+{ART}{ATTR}\s+{NAME}{OF_CLASS}{NAME}{TO}{TYPE}"),
+    ("rename_attribute", rf"{RENAME}\s+{ART}{ATTR}\s+{NAME}(?:\s*:\s*{TYPE})?{OF_CLASS}{NAME}{TO}{NAME}(?:\s*:\s*{TYPE})?"),
+    ("rename_method", rf"{RENAME}\s+{ART}{METHOD}\s+{NAME}(?:\(\))?{OF_CLASS}{NAME}{TO}{NAME}"),
+    ("rename_class", rf"{RENAME}\s+(?:{ART}nombre\s+de\s+)?{ART}clase\s+{NAME}{TO}{NAME}"),
+    ("add_attribute", rf"{ADD}\s+{ART}{ATTR}\s+{NAME}(?:\s*:\s*{TYPE}|\s+de\s+tipo\s+{TYPE})?{OF_CLASS}{NAME}"),
+    ("add_method", rf"{ADD}\s+{ART}{METHOD}\s+{NAME}(?:\(([^)]*)\))?(?:\s*:\s*{TYPE})?{OF_CLASS}{NAME}"),
+    ("add_relationship", rf"{ADD}\s+{ART}{REL}(?:\s+de)?(?:\s+tipo)?(?:\s+{REL_TYPE})?\s+entre\s+{NAME}\s+y\s+{NAME}"
+                         rf"(?:\s+con\s+multiplicidad\s+(\S+)\s+(?:y|a)\s+(\S+))?"),
+]
+GRAMMAR = [(kind, re.compile(pattern, re.IGNORECASE)) for kind, pattern in GRAMMAR]
+
+SPLIT = re.compile(r"\s*(?:;|\n|\.\s+|,\s*(?:luego|despu[eé]s|y\s+luego)\s+)\s*", re.IGNORECASE)
+POLITE = re.compile(r"^(?:por\s+favor,?\s*|porfa,?\s*|quiero\s+que\s+|necesito\s+que\s+)", re.IGNORECASE)
+
+# Esquema de respuesta compatible con el del LLM para cada orden
+DELETE_KINDS = {"delete_class", "delete_attribute", "delete_method", "delete_relationship"}
+EDIT_KINDS = {"rename_class", "rename_attribute", "retype_attribute", "add_attribute",
+              "rename_method", "add_method"}
+CREATE_KINDS = {"add_relationship"}
+
+
+class CommandError(ValueError):
+    pass
+
+
+def _strip_accents(text):
+    return (text.lower().replace("á", "a").replace("é", "e").replace("í", "i")
+            .replace("ó", "o").replace("ú", "u"))
+
+
+def parse_command(text):
+    text = POLITE.sub("", text.strip().rstrip(".!"))
+    for kind, pattern in GRAMMAR:
+        match = pattern.fullmatch(text)
+        if match:
+            return _build(kind, match.groups())
+    return None
+
+
+def _build(kind, g):
+    if kind == "delete_class":
+        return {"kind": kind, "class": g[0]}
+    if kind in ("delete_attribute", "delete_method"):
+        return {"kind": kind, "name": g[0], "class": g[1]}
+    if kind == "delete_relationship":
+        return {"kind": kind, "type": RELATION_TYPES.get(_strip_accents(g[0])) if g[0] else None,
+                "source": g[1], "target": g[2]}
+    if kind == "rename_class":
+        return {"kind": kind, "class": g[0], "new_name": g[1]}
+    if kind == "retype_attribute":
+        return {"kind": kind, "name": g[0], "class": g[1], "new_type": g[2]}
+    if kind == "rename_attribute":
+        return {"kind": kind, "name": g[0], "class": g[2], "new_name": g[3], "new_type": g[4]}
+    if kind == "rename_method":
+        return {"kind": kind, "name": g[0], "class": g[1], "new_name": g[2]}
+    if kind == "add_attribute":
+        return {"kind": kind, "name": g[0], "type": g[1] or g[2] or "String", "class": g[3]}
+    if kind == "add_method":
+        return {"kind": kind, "name": g[0], "parameters": (g[1] or "").strip(),
+                "returnType": g[2] or "void", "class": g[3]}
+    if kind == "add_relationship":
+        labels = [g[3], g[4]] if g[3] and g[4] else []
+        return {"kind": kind, "type": RELATION_TYPES.get(_strip_accents(g[0])) if g[0] else "association",
+                "source": g[1], "target": g[2], "labels": labels}
+    return None
+
+
+def parse_commands(prompt):
+    """Lista de órdenes del prompt, o None si alguna parte no encaja."""
+    parts = [p for p in SPLIT.split(prompt.strip()) if p]
+    if not parts:
+        return None
+    commands = []
+    for part in parts:
+        command = parse_command(part)
+        if command is None:
+            return None
+        commands.append(command)
+    return commands
+
+
+# ---------- ejecución sobre el JSON UML ----------
+class UMLIndex:
+    """Índices nombre→clase e id→clase construidos una sola vez."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.by_id = {}
+        self.by_name = {}
+        self.by_lower = {}
+        for cls in doc.get("classes", []):
+            self.add(cls)
+
+    def add(self, cls):
+        self.by_id[cls.get("id")] = cls
+        self.by_name[cls.get("name")] = cls
+        self.by_lower.setdefault(str(cls.get("name", "")).lower(), cls)
+
+    def find(self, name):
+        cls = self.by_name.get(name) or self.by_lower.get(name.lower())
+        if cls is None:
+            raise CommandError(f"No existe la clase {name}")
+        return cls
+
+
+def _find_member(members, name):
+    for member in members:
+        if member.get("name") == name:
+            return member
+    for member in members:
+        if str(member.get("name", "")).lower() == name.lower():
+            return member
+    raise CommandError(f"No existe el miembro {name}")
+
+
+def _check_doc(doc):
+    # El UML lo manda el cliente: con una forma inesperada se deja al LLM
+    if not isinstance(doc, dict):
+        raise CommandError("El UML debe ser un objeto")
+    for key in ("classes", "relationships"):
+        items = doc.get(key, [])
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise CommandError(f"'{key}' debe ser una lista de objetos")
+    for cls in doc.get("classes", []):
+        for key in ("attributes", "methods"):
+            members = cls.get(key, [])
+            if not isinstance(members, list) or not all(isinstance(m, dict) for m in members):
+                raise CommandError(f"'{key}' debe ser una lista de objetos")
+    refs = [cls.get("id") for cls in doc.get("classes", [])]
+    refs += [rel.get(end) for rel in doc.get("relationships", []) for end in ("id", "sourceId", "targetId")]
+    if not all(isinstance(ref, (str, int, type(None))) for ref in refs):
+        raise CommandError("Los ids del UML deben ser textos")
+
+
+def _class_header(cls):
+    return {"id": cls.get("id"), "name": cls.get("name")}
+
+
+def execute(doc, commands):
+    """
+    Aplica las órdenes sobre una copia de `doc`.
+
+    Devuelve (doc_actualizado, respuesta) donde la respuesta sigue el
+    mismo esquema que devolvería Gemini para ese modo.
+    """
+    kinds = {c["kind"] for c in commands}
+    if kinds <= DELETE_KINDS:
+        schema = "delete"
+    elif kinds <= CREATE_KINDS:
+        schema = "create"
+    elif kinds <= EDIT_KINDS and len(commands) == 1:
+        schema = "edit"
+    else:
+        raise CommandError("Combinación de órdenes no soportada localmente")
+
+    if doc is None:
+        if schema != "delete":
+            raise CommandError("Se necesita el UML de la sala")
+        return None, _delete_markers_by_name(commands)
+
+    _check_doc(doc)
+    doc = copy.deepcopy(doc)
+    doc.setdefault("classes", [])
+    doc.setdefault("relationships", [])
+    index = UMLIndex(doc)
+
+    if schema == "delete":
+        return doc, _apply_deletes(doc, index, commands)
+    if schema == "create":
+        return doc, _apply_relationships(doc, index, commands)
+    return doc, _apply_edit(doc, index, commands[0])
+
+
+def _delete_markers_by_name(commands):
+    # Sin UML de la sala: marcadores por nombre, igual que los del LLM
+    classes, relationships = {}, []
+    for c in commands:
+        if c["kind"] == "delete_relationship":
+            rel = {"sourceId": c["source"], "targetId": c["target"], "eliminar": True}
+            if c["type"]:
+                rel["type"] = c["type"]
+            relationships.append(rel)
+            continue
+        entry = classes.setdefault(c["class"], {"name": c["class"]})
+        if c["kind"] == "delete_class":
+            entry["eliminar"] = True
+        else:
+            key = "attributes" if c["kind"] == "delete_attribute" else "methods"
+            entry.setdefault(key, []).append({"name": c["name"], "eliminar": True})
+    return {"classes": list(classes.values()), "relationships": relationships}
+
+
+def _apply_deletes(doc, index, commands):
+    classes, relationships = {}, []
+    removed_rel_ids = set()
+
+    for c in commands:
+        if c["kind"] == "delete_relationship":
+            source, target = index.find(c["source"]), index.find(c["target"])
+            ends = {source["id"], target["id"]}
+            found = [
+                rel for rel in doc["relationships"]
+                if {rel.get("sourceId"), rel.get("targetId")} == ends
+                and (c["type"] is None or rel.get("type") == c["type"])
+            ]
+            if not found:
+                raise CommandError(f"No hay relación entre {c['source']} y {c['target']}")
+            for rel in found:
+                removed_rel_ids.add(rel["id"])
+                relationships.append({
+                    "id": rel["id"],
+                    "type": rel.get("type"),
+                    "sourceId": index.by_id[rel["sourceId"]]["name"],
+                    "targetId": index.by_id[rel["targetId"]]["name"],
+                    "eliminar": True,
+                })
+            continue
+
+        cls = index.find(c["class"])
+        entry = classes.setdefault(cls["id"], _class_header(cls))
+        if c["kind"] == "delete_class":
+            entry["eliminar"] = True
+            entry.pop("attributes", None)
+            entry.pop("methods", None)
+            removed_rel_ids.update(
+                rel["id"] for rel in doc["relationships"]
+                if cls["id"] in (rel.get("sourceId"), rel.get("targetId"))
+            )
+        else:
+            key = "attributes" if c["kind"] == "delete_attribute" else "methods"
+            member = _find_member(cls.get(key, []), c["name"])
+            cls[key] = [m for m in cls[key] if m is not member]
+            if not entry.get("eliminar"):
+                entry.setdefault(key, []).append({**member, "eliminar": True})
+
+    deleted_ids = {cid for cid, entry in classes.items() if entry.get("eliminar")}
+    doc["classes"] = [cls for cls in doc["classes"] if cls.get("id") not in deleted_ids]
+    doc["relationships"] = [rel for rel in doc["relationships"] if rel.get("id") not in removed_rel_ids]
+    return {"classes": list(classes.values()), "relationships": relationships}
+
+
+def _apply_relationships(doc, index, commands):
+    created = []
+    for c in commands:
+        source, target = index.find(c["source"]), index.find(c["target"])
+        rel = {
+            "id": str(uuid.uuid4()),
+            "type": c["type"],
+            "sourceId": source["id"],
+            "targetId": target["id"],
+            "labels": c["labels"],
+        }
+        doc["relationships"].append(rel)
+        created.append(rel)
+    return {"classes": [], "relationships": created}
+
+
+def _apply_edit(doc, index, c):
+    cls = index.find(c["class"])
+    original = _class_header(cls)
+    edited = {**_class_header(cls), "editado": True}
+    kind = c["kind"]
+
+    if kind == "rename_class":
+        if c["new_name"] in index.by_name:
+            raise CommandError(f"Ya existe la clase {c['new_name']}")
+        cls["name"] = c["new_name"]
+        edited["name"] = c["new_name"]
+
+    elif kind in ("add_attribute", "add_method"):
+        key = "attributes" if kind == "add_attribute" else "methods"
+        if any(m.get("name") == c["name"] for m in cls.get(key, [])):
+            raise CommandError(f"{c['name']} ya existe en {cls['name']}")
+        if key == "attributes":
+            member = {"name": c["name"], "type": c["type"]}
+        else:
+            member = {"name": c["name"], "parameters": c["parameters"], "returnType": c["returnType"]}
+        cls.setdefault(key, []).append(member)
+        original[key] = []
+        edited[key] = [{**member, "editado": True}]
+
+    else:
+        key = "methods" if kind == "rename_method" else "attributes"
+        member = _find_member(cls.get(key, []), c["name"])
+        before = dict(member)
+        if c.get("new_name"):
+            member["name"] = c["new_name"]
+        if c.get("new_type"):
+            member["type"] = c["new_type"]
+        original[key] = [before]
+        edited[key] = [{**member, "editado": True}]
+
+    return {
+        "original": {"classes": [original], "relationships": []},
+        "editado": {"classes": [edited], "relationships": []},
+    }
+
+
+# ---------- métricas ----------
+class EngineStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.fallbacks = 0
+        self.local_seconds = 0.0
+        self.llm_latency_ewma = None
+        self.llm_calls = 0
+
+    def record_llm_latency(self, seconds, alpha=0.2):
+        with self._lock:
+            self.llm_calls += 1
+            if self.llm_latency_ewma is None:
+                self.llm_latency_ewma = seconds
+            else:
+                self.llm_latency_ewma = alpha * seconds + (1 - alpha) * self.llm_latency_ewma
+
+    def snapshot(self):
+        with self._lock:
+            attempts = self.local_hits + self.fallbacks
+            ewma = self.llm_latency_ewma or 0.0
+            return {
+                "local_hits": self.local_hits,
+                "fallbacks": self.fallbacks,
+                "hit_rate": round(self.local_hits / attempts, 4) if attempts else 0.0,
+                "avg_local_ms": round(self.local_seconds / self.local_hits * 1000, 4) if self.local_hits else 0.0,
+                "llm_latency_ewma_ms": round(ewma * 1000, 2),
+                "latency_saved_ms": round(max(ewma * self.local_hits - self.local_seconds, 0) * 1000, 2),
+            }
+
+
+stats = EngineStats()
+
+
+def try_local(prompt, doc=None):
+    """Respuesta local para el prompt, o None si hay que llamar al LLM."""
+    start = time.perf_counter()
+    commands = parse_commands(prompt)
+    try:
+        if commands is None:
+            raise CommandError("El prompt no encaja en la gramática local")
+        _, response = execute(doc, commands)
+    except CommandError:
+        with stats._lock:
+            stats.fallbacks += 1
+        return None
+
+    with stats._lock:
+        stats.local_hits += 1
+        stats.local_seconds += time.perf_counter() - start
+    return response
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .cache import LAYOUT_FIELDS
+
+# Validación incremental por sala: se recuerda el último diagrama
+# validado (huellas de clases y relaciones) y el resultado de Gemini para
+# cada relación. En la siguiente validación solo se reenvían las
+# relaciones nuevas, modificadas o con alguna clase extremo cambiada.
+
+RELATIONSHIP_KEYS = ("type", "sourceId", "targetId", "labels")
+
+
+def _fingerprint(value):
+    raw = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def class_fingerprint(cls):
+    return _fingerprint({k: v for k, v in cls.items() if k not in LAYOUT_FIELDS and k != "id"})
+
+
+def relationship_fingerprint(rel):
+    return _fingerprint({k: rel.get(k) for k in RELATIONSHIP_KEYS})
+
+
+class RoomValidation:
+    """Último diagrama validado de una sala y resultados por relación."""
+
+    def __init__(self):
+        self.classes = {}
+        self.relationships = {}
+
+
+class ValidationPlan:
+    """
+    Diff estructural entre el diagrama actual y el último validado:
+    `dirty` son las relaciones que hay que mandar a Gemini y `reused`
+    los resultados que se pueden conservar.
+    """
+
+    def __init__(self, report, previous=None):
+        self.report = report
+        self.previous = previous
+        graph = report.graph
+        self.classes = {cid: class_fingerprint(cls) for cid, cls in graph.by_id.items()}
+        self.dirty = []
+        self.reused = {}
+        for rel in report.pending:
+            rel_id = rel.get("id")
+            fingerprint = relationship_fingerprint(rel)
+            cached = previous.relationships.get(rel_id) if previous is not None and rel_id else None
+            if cached is not None and cached[0] == fingerprint and not self._endpoint_changed(rel):
+                self.reused[rel_id] = cached[1]
+            else:
+                self.dirty.append(rel)
+
+    def _endpoint_changed(self, rel):
+        return any(
+            self.previous.classes.get(rel.get(end)) != self.classes.get(rel.get(end))
+            for end in ("sourceId", "targetId")
+        )
+
+    def remainder(self):
+        """UML reducido a las relaciones a revalidar y sus clases."""
+        ids = set()
+        for rel in self.dirty:
+            ids.add(rel.get("sourceId"))
+            ids.add(rel.get("targetId"))
+        classes = [c for c in self.report.graph.classes if c.get("id") in ids]
+        return {"classes": classes, "relationships": list(self.dirty)}
+
+    def cached_items(self):
+        for items in self.reused.values():
+            for section, item in items:
+                yield section, item
+
+    def _assign(self, analysis):
+        """Reparte la respuesta de Gemini por id de relación."""
+        dirty_ids = {rel.get("id") for rel in self.dirty}
+        fresh = {rel_id: [] for rel_id in dirty_ids}
+        unassigned = []
+        for section in ("validas", "errores"):
+            for item in analysis.get(section) or []:
+                rel_id = item.get("id") if isinstance(item, dict) else None
+                if rel_id not in dirty_ids and len(dirty_ids) == 1:
+                    rel_id = next(iter(dirty_ids))
+                if rel_id in fresh:
+                    fresh[rel_id].append((section, item))
+                else:
+                    unassigned.append((section, item))
+        return fresh, unassigned
+
+    def merge(self, analysis):
+        """
+        Combina errores locales, resultados reutilizados y la respuesta
+        nueva. Devuelve (análisis completo, RoomValidation a recordar);
+        si Gemini falló se devuelve su error y no se recuerda nada.
+        """
+        if not isinstance(analysis, dict) or "error" in analysis:
+            return analysis, None
+
+        fresh, unassigned = self._assign(analysis)
+        merged = self.report.as_analysis()
+        for section, item in list(self.cached_items()) + [
+            entry for items in fresh.values() for entry in items
+        ] + unassigned:
+            merged[section].append(item)
+
+        room = RoomValidation()
+        room.classes = dict(self.classes)
+        fingerprints = {rel.get("id"): relationship_fingerprint(rel) for rel in self.report.pending}
+        for rel_id, items in self.reused.items():
+            room.relationships[rel_id] = (fingerprints[rel_id], items)
+        for rel_id, items in fresh.items():
+            # Sin resultado asignado no se cachea: se reintenta la próxima vez
+            if rel_id and items:
+                room.relationships[rel_id] = (fingerprints[rel_id], items)
+        return merged, room
+
+
+class ValidationStore:
+    """LRU en proceso con el último diagrama validado de cada sala."""
+
+    def __init__(self):
+        self.max_rooms = getattr(settings, "UML_VALIDATION_ROOMS", 256)
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"reused": 0, "revalidated": 0, "skipped_llm": 0}
+
+    def plan(self, room_id, report):
+        previous = None
+        if room_id is not None:
+            with self._lock:
+                previous = self._rooms.get(room_id)
+        plan = ValidationPlan(report, previous)
+        self.stats["reused"] += len(plan.reused)
+        self.stats["revalidated"] += len(plan.dirty)
+        if not plan.dirty:
+            self.stats["skipped_llm"] += 1
+        return plan
+
+    def remember(self, room_id, room):
+        if room_id is None or room is None:
+            return
+        with self._lock:
+            self._rooms[room_id] = room
+            self._rooms.move_to_end(room_id)
+            while len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+
+    def forget(self, room_id):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+
+    def snapshot(self):
+        with self._lock:
+            rooms = len(self._rooms)
+        return dict(self.stats, rooms=rooms)
+
+
+_store = None
+
+
+def get_validation_store():
+    global _store
+    if _store is None:
+        _store = ValidationStore()
+    return _store
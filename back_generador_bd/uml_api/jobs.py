@@ -0,0 +1,482 @@
+import asyncio
+import hmac
+import json
+import logging
+import time
+import uuid
+import weakref
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .persistence import load_backup
+from .ratelimit import RateLimited, rate_scope
+from .redis_conn import get_redis
+from .services import acall_gemini, detect_mode, strip_markdown
+from collab.merge import apply_to_room, merge_room, merge_target
+
+logger = logging.getLogger(__name__)
+
+# Prioridades en orden de atención
+PRIORITIES = ("high", "normal", "low")
+ANONYMOUS_ROOM = "_"
+
+# Cola justa: por prioridad hay un anillo de salas con trabajos pendientes
+# y una lista de trabajos por sala. Encolar agrega la sala al anillo si su
+# lista estaba vacía; desencolar rota el anillo, así cada sala avanza de a
+# un trabajo por vuelta aunque otra tenga cien en cola.
+ENQUEUE_SCRIPT = """
+local n = redis.call("rpush", KEYS[2], ARGV[1])
+if n == 1 then
+    redis.call("rpush", KEYS[1], ARGV[2])
+end
+return n
+"""
+
+# KEYS[1] es el set de trabajos en curso: cada uno queda con su plazo de
+# visibilidad y, si el worker muere sin renovarlo, se vuelve a encolar.
+DEQUEUE_SCRIPT = """
+for i = 2, #KEYS do
+    local ring = KEYS[i]
+    local room = redis.call("lpop", ring)
+    if room then
+        local queue = ARGV[1] .. room .. ":" .. ARGV[i + 1]
+        local job = redis.call("lpop", queue)
+        if redis.call("llen", queue) > 0 then
+            redis.call("rpush", ring, room)
+        end
+        if job then
+            redis.call("zadd", KEYS[1], ARGV[2], job)
+            return job
+        end
+    end
+end
+return false
+"""
+
+# Trabajos en curso con el plazo vencido; se sacan del set al devolverlos,
+# así dos workers no reencolan el mismo
+EXPIRED_SCRIPT = """
+local expired = redis.call("zrangebyscore", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, 100)
+for _, job in ipairs(expired) do
+    redis.call("zrem", KEYS[1], job)
+end
+return expired
+"""
+
+
+class MemoryJobBackend:
+    """Misma cola justa en memoria, para cuando no hay Redis."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.rings = {p: deque() for p in PRIORITIES}
+        self.queues = {}
+        self.jobs = {}
+
+    # La cola en memoria muere con el proceso: no hay trabajos que recuperar
+    async def touch(self, job_id, deadline):
+        pass
+
+    async def ack(self, job_id):
+        pass
+
+    async def expired(self, now):
+        return []
+
+    async def enqueue(self, job):
+        key = (job["room"], job["priority"])
+        queue = self.queues.setdefault(key, deque())
+        queue.append(job["id"])
+        if len(queue) == 1:
+            self.rings[job["priority"]].append(job["room"])
+
+    async def dequeue(self):
+        for priority in PRIORITIES:
+            ring = self.rings[priority]
+            while ring:
+                room = ring.popleft()
+                queue = self.queues.get((room, priority))
+                if not queue:
+                    self.queues.pop((room, priority), None)
+                    continue
+                job_id = queue.popleft()
+                if queue:
+                    ring.append(room)
+                else:
+                    del self.queues[(room, priority)]
+                return job_id
+        return None
+
+    async def save(self, job):
+        self.jobs[job["id"]] = (job, time.monotonic() + self.ttl)
+        self._prune()
+
+    async def load(self, job_id):
+        entry = self.jobs.get(job_id)
+        if entry is None or entry[1] < time.monotonic():
+            return None
+        return entry[0]
+
+    def _prune(self):
+        now = time.monotonic()
+        for job_id in [k for k, (_, expires_at) in self.jobs.items() if expires_at < now]:
+            del self.jobs[job_id]
+
+
+class RedisJobBackend:
+    """Cola compartida entre workers de Daphne sobre el Redis de CHANNEL_LAYERS."""
+
+    prefix = "umljobs:"
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def _ring(self, priority):
+        return f"{self.prefix}ring:{priority}"
+
+    def _queue(self, room, priority):
+        return f"{self.prefix}q:{room}:{priority}"
+
+    def _job(self, job_id):
+        return f"{self.prefix}job:{job_id}"
+
+    async def enqueue(self, job):
+        redis = get_redis()
+        await redis.eval(
+            ENQUEUE_SCRIPT, 2,
+            self._ring(job["priority"]), self._queue(job["room"], job["priority"]),
+            job["id"], job["room"],
+        )
+
+    def _running(self):
+        return f"{self.prefix}running"
+
+    async def dequeue(self, deadline):
+        redis = get_redis()
+        keys = [self._running()] + [self._ring(p) for p in PRIORITIES]
+        job_id = await redis.eval(DEQUEUE_SCRIPT, len(keys), *keys, f"{self.prefix}q:", deadline, *PRIORITIES)
+        if job_id is None:
+            return None
+        return job_id.decode("utf-8") if isinstance(job_id, bytes) else job_id
+
+    async def touch(self, job_id, deadline):
+        await get_redis().zadd(self._running(), {job_id: deadline}, xx=True)
+
+    async def ack(self, job_id):
+        await get_redis().zrem(self._running(), job_id)
+
+    async def expired(self, now):
+        job_ids = await get_redis().eval(EXPIRED_SCRIPT, 1, self._running(), now)
+        return [j.decode("utf-8") if isinstance(j, bytes) else j for j in job_ids or []]
+
+    async def save(self, job):
+        await get_redis().set(self._job(job["id"]), json.dumps(job, ensure_ascii=False), ex=self.ttl)
+
+    async def load(self, job_id):
+        raw = await get_redis().get(self._job(job_id))
+        return json.loads(raw) if raw is not None else None
+
+
+class JobQueue:
+    """
+    Trabajos de LLM en segundo plano para /api/chatbot/.
+
+    Cada proceso corre UML_JOB_WORKERS workers sobre su event loop (así se
+    acota la concurrencia); la cola vive en Redis y se comparte entre
+    procesos. Sin Redis, o si falla, se usa la cola en memoria. El
+    resultado se envía a la sala por el channel layer y queda guardado
+    UML_JOB_TTL segundos para consultarlo por polling.
+
+    Un trabajo tomado de Redis se renueva mientras corre; si su worker
+    muere, pasado UML_JOB_VISIBILITY_TIMEOUT otro lo vuelve a encolar
+    (hasta UML_JOB_MAX_ATTEMPTS veces).
+    """
+
+    def __init__(self):
+        self.workers = getattr(settings, "UML_JOB_WORKERS", 4)
+        self.ttl = getattr(settings, "UML_JOB_TTL", 3600)
+        self.poll_interval = getattr(settings, "UML_JOB_POLL_INTERVAL", 1.0)
+        self.use_redis = getattr(settings, "UML_JOBS_REDIS", True)
+        self.visibility_timeout = getattr(settings, "UML_JOB_VISIBILITY_TIMEOUT", 300)
+        self.max_attempts = getattr(settings, "UML_JOB_MAX_ATTEMPTS", 3)
+        self.memory = MemoryJobBackend(self.ttl)
+        self.redis = RedisJobBackend(self.ttl)
+        self._loops = weakref.WeakKeyDictionary()
+        self._next_reap = 0.0
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "running": 0,
+            "requeued": 0,
+            "redis_errors": 0,
+        }
+
+    def _redis_enabled(self):
+        return self.use_redis and get_redis() is not None
+
+    # ---------- workers ----------
+    def ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            wakeup = asyncio.Event()
+            tasks = [loop.create_task(self._worker(wakeup)) for _ in range(self.workers)]
+            state = (wakeup, tasks)
+            self._loops[loop] = state
+        return state[0]
+
+    async def _next_job_id(self):
+        job_id = await self.memory.dequeue()
+        if job_id is not None or not self._redis_enabled():
+            return job_id
+        try:
+            return await self.redis.dequeue(time.time() + self.visibility_timeout)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning("Error leyendo la cola de trabajos en Redis: %s", e)
+            return None
+
+    async def _worker(self, wakeup):
+        while True:
+            # Se limpia antes de mirar la cola para no perder un aviso
+            wakeup.clear()
+            job_id = await self._next_job_id()
+            if job_id is None:
+                await self._requeue_expired()
+                # Otros procesos también encolan en Redis: se revisa cada poll_interval
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job = await self.get(job_id)
+            if job is None or job.get("status") != "queued":
+                # Vencido, o ya lo terminó otro worker
+                await self._backend_call(job, "ack", job_id)
+                continue
+            heartbeat = asyncio.create_task(self._heartbeat(job))
+            try:
+                await self._run(job)
+            except Exception:
+                logger.exception("Error inesperado en el trabajo %s", job_id)
+            finally:
+                heartbeat.cancel()
+                await self._backend_call(job, "ack", job_id)
+
+    def _backend(self, job):
+        return self.redis if job is None or job.get("backend") == "redis" else self.memory
+
+    async def _backend_call(self, job, method, *args):
+        if self._backend(job) is self.redis and not self._redis_enabled():
+            return None
+        try:
+            return await getattr(self._backend(job), method)(*args)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning("Error de Redis en la cola de trabajos (%s): %s", method, e)
+            return None
+
+    async def _heartbeat(self, job):
+        # Renueva el plazo mientras el trabajo corre; sin esto se reencolaría
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            await self._backend_call(job, "touch", job["id"], time.time() + self.visibility_timeout)
+
+    async def _requeue_expired(self):
+        """Vuelve a encolar los trabajos cuyo worker murió sin terminarlos."""
+        now = time.monotonic()
+        if now < self._next_reap or not self._redis_enabled():
+            return
+        self._next_reap = now + self.visibility_timeout / 3
+        for job_id in await self._backend_call(None, "expired", time.time()) or []:
+            job = await self.get(job_id)
+            if job is None or job.get("status") != "running":
+                continue
+            job["attempts"] = job.get("attempts", 0) + 1
+            if job["attempts"] >= self.max_attempts:
+                job.update(status="error", finished_at=time.time(), error={
+                    "error": "El trabajo se interrumpió demasiadas veces",
+                    "attempts": job["attempts"],
+                })
+                self.stats["failed"] += 1
+                job.pop("uml", None)
+                await self._save(job)
+                await self._notify(job)
+                continue
+            logger.warning("Trabajo %s sin worker: se vuelve a encolar", job_id)
+            job["status"] = "queued"
+            await self._save(job)
+            await self._backend_call(job, "enqueue", job)
+            self.stats["requeued"] += 1
+
+    async def _run(self, job):
+        self.stats["running"] += 1
+        job.update(status="running", started_at=time.time())
+        await self._save(job)
+        try:
+            uml = job.get("uml") or await self._room_uml(job)
+            room = job["room"] if job["room"] != ANONYMOUS_ROOM else None
+            server_merge = job.get("merge", True) and merge_target(detect_mode(job["prompt"]), job["room"]) is not None
+            with rate_scope(room=room, client=job.get("client")):
+                output = strip_markdown(await acall_gemini(job["prompt"], uml, server_merge=server_merge))
+            try:
+                job["result"] = json.loads(output)
+                job["status"] = "done"
+            except ValueError as e:
+                job["status"] = "error"
+                job["error"] = {
+                    "error": "Gemini devolvió un formato inválido",
+                    "raw": output,
+                    "exception": str(e),
+                }
+            if job["status"] == "done" and job.get("merge", True):
+                await self._merge(job)
+        except RateLimited as e:
+            job["status"] = "error"
+            job["error"] = {"error": "Límite de solicitudes alcanzado", "reason": e.reason, "retry_after": e.retry_after}
+        except Exception as e:
+            job["status"] = "error"
+            job["error"] = {"error": "Error llamando a Gemini", "exception": str(e)}
+        finally:
+            self.stats["running"] -= 1
+
+        self.stats["completed" if job["status"] == "done" else "failed"] += 1
+        job["finished_at"] = time.time()
+        job.pop("uml", None)
+        await self._save(job)
+        await self._notify(job)
+
+    async def _merge(self, job):
+        # Edición/eliminación: se aplica a la sala y se guarda el resumen de deltas
+        room = merge_room(detect_mode(job["prompt"]), job["room"], job["result"])
+        if room is None:
+            return
+        try:
+            job["merge"] = await apply_to_room(room, job["result"], key=job["id"])
+        except Exception as e:
+            # El resultado sigue disponible; el cliente puede aplicarlo él
+            logger.warning("No se pudo aplicar el trabajo %s a la sala %s: %s", job["id"], room, e)
+            job["merge"] = {"error": str(e)}
+
+    async def _room_uml(self, job):
+        try:
+            room_id = uuid.UUID(job["room"])
+        except ValueError:
+            return None
+        return await sync_to_async(load_backup)(room_id)
+
+    async def _notify(self, job):
+        if job["room"] == ANONYMOUS_ROOM:
+            return
+        layer = get_channel_layer()
+        if layer is None:
+            return
+        try:
+            await metrics.timed_group_send(layer, f"canvas_{job['room']}", {
+                "type": "job_result",
+                "job": public_job(job),
+            })
+        except Exception as e:
+            # El cliente todavía puede consultar el resultado por polling
+            logger.warning("No se pudo avisar a la sala del trabajo %s: %s", job["id"], e)
+
+    # ---------- almacenamiento ----------
+    async def _save(self, job):
+        if job.get("backend") == "redis":
+            try:
+                await self.redis.save(job)
+                return
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning("Error guardando trabajo en Redis: %s", e)
+        await self.memory.save(job)
+
+    async def get(self, job_id):
+        job = await self.memory.load(job_id)
+        if job is not None or not self._redis_enabled():
+            return job
+        try:
+            return await self.redis.load(job_id)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning("Error leyendo trabajo de Redis: %s", e)
+            return None
+
+    # ---------- API ----------
+    async def submit(self, prompt, room_id=None, priority="normal", uml=None, client=None, merge=True):
+        wakeup = self.ensure_workers()
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "prompt": prompt,
+            "room": str(room_id) if room_id else ANONYMOUS_ROOM,
+            "priority": priority if priority in PRIORITIES else "normal",
+            "client": client,
+            "merge": bool(merge),
+            "created_at": time.time(),
+            "backend": "memory",
+        }
+        if isinstance(uml, dict):
+            job["uml"] = uml
+
+        if self._redis_enabled():
+            job["backend"] = "redis"
+            try:
+                await self.redis.save(job)
+                await self.redis.enqueue(job)
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning("Cola Redis no disponible, se usa la local: %s", e)
+                job["backend"] = "memory"
+        if job["backend"] == "memory":
+            await self.memory.save(job)
+            await self.memory.enqueue(job)
+
+        self.stats["submitted"] += 1
+        wakeup.set()
+        return job
+
+    def snapshot(self):
+        return dict(self.stats, workers=self.workers, redis_enabled=bool(self.use_redis))
+
+
+def allowed_priority(priority, token=None):
+    """
+    Prioridad que se respeta de lo que pidió el cliente. "high" pasa
+    delante de todas las salas: solo con UML_JOB_PRIORITY_TOKEN y el mismo
+    valor en `token`; si no, y para valores desconocidos, queda "normal".
+    """
+    if priority not in PRIORITIES:
+        return "normal"
+    if priority == "high":
+        secret = getattr(settings, "UML_JOB_PRIORITY_TOKEN", "")
+        if not secret or not isinstance(token, str) or not hmac.compare_digest(token, secret):
+            return "normal"
+    return priority
+
+
+def public_job(job):
+    """Lo que ve el cliente de un trabajo (sin prompt ni UML)."""
+    data = {k: job.get(k) for k in ("id", "status", "room", "priority", "created_at", "started_at", "finished_at")}
+    if job.get("status") == "done":
+        data["result"] = job.get("result")
+        if isinstance(job.get("merge"), dict):
+            data["merge"] = job["merge"]
+    elif job.get("status") == "error":
+        data["error"] = job.get("error")
+    return data
+
+
+_queue = None
+
+
+def get_job_queue():
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
@@ -0,0 +1,114 @@
+import copy
+
+# Subconjunto de RFC 6902 (add / remove / replace), suficiente para el
+# historial de BackupUML.
+
+
+class JsonPatchError(ValueError):
+    pass
+
+
+def _escape(token):
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def make_patch(old, new, path=""):
+    """Lista de operaciones que transforma `old` en `new`."""
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+        for key, value in new.items():
+            child = f"{path}/{_escape(key)}"
+            if key not in old:
+                ops.append({"op": "add", "path": child, "value": copy.deepcopy(value)})
+            else:
+                ops.extend(make_patch(old[key], value, child))
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        return _list_patch(old, new, path)
+    return [{"op": "replace", "path": path, "value": copy.deepcopy(new)}]
+
+
+def _list_patch(old, new, path):
+    # Recortar prefijo y sufijo comunes: una inserción o borrado en
+    # medio de la lista produce una sola operación.
+    start = 0
+    while start < len(old) and start < len(new) and old[start] == new[start]:
+        start += 1
+    end_old, end_new = len(old), len(new)
+    while end_old > start and end_new > start and old[end_old - 1] == new[end_new - 1]:
+        end_old -= 1
+        end_new -= 1
+
+    ops = []
+    common = min(end_old - start, end_new - start)
+    for i in range(start, start + common):
+        ops.extend(make_patch(old[i], new[i], f"{path}/{i}"))
+    # Borrar de atrás hacia adelante para no correr los índices
+    for i in range(end_old - 1, start + common - 1, -1):
+        ops.append({"op": "remove", "path": f"{path}/{i}"})
+    for i in range(start + common, end_new):
+        ops.append({"op": "add", "path": f"{path}/{i}", "value": copy.deepcopy(new[i])})
+    return ops
+
+
+def _resolve(doc, tokens):
+    target = doc
+    for token in tokens:
+        if isinstance(target, list):
+            try:
+                target = target[int(token)]
+            except (ValueError, IndexError):
+                raise JsonPatchError(f"Índice inválido: {token}")
+        elif isinstance(target, dict):
+            if token not in target:
+                raise JsonPatchError(f"Clave inexistente: {token}")
+            target = target[token]
+        else:
+            raise JsonPatchError(f"No se puede navegar en {token}")
+    return target
+
+
+def apply_patch(doc, patch):
+    """Aplica el patch sobre una copia de `doc` y la devuelve."""
+    doc = copy.deepcopy(doc)
+    for op in patch:
+        kind, path = op.get("op"), op.get("path", "")
+        if path == "":
+            if kind in ("add", "replace"):
+                doc = copy.deepcopy(op["value"])
+                continue
+            raise JsonPatchError(f"Operación {kind} inválida sobre la raíz")
+
+        tokens = [_unescape(t) for t in path.split("/")[1:]]
+        parent = _resolve(doc, tokens[:-1])
+        last = tokens[-1]
+
+        if isinstance(parent, list):
+            index = len(parent) if last == "-" else int(last)
+            if kind == "add":
+                parent.insert(index, copy.deepcopy(op["value"]))
+            elif kind == "remove":
+                del parent[index]
+            elif kind == "replace":
+                parent[index] = copy.deepcopy(op["value"])
+            else:
+                raise JsonPatchError(f"Operación no soportada: {kind}")
+        elif isinstance(parent, dict):
+            if kind in ("add", "replace"):
+                parent[last] = copy.deepcopy(op["value"])
+            elif kind == "remove":
+                parent.pop(last)
+            else:
+                raise JsonPatchError(f"Operación no soportada: {kind}")
+        else:
+            raise JsonPatchError(f"Ruta inválida: {path}")
+    return doc
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import random
+import weakref
+
+import httpx
+from django.conf import settings
+
+# Códigos que vale la pena reintentar (cuota, sobrecarga o caída temporal)
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class GeminiClient:
+    """
+    Cliente HTTP asíncrono compartido para el backend LLM.
+
+    Mantiene un pool keep-alive por event loop, limita la concurrencia
+    con un semáforo y reintenta con backoff exponencial + jitter.
+    """
+
+    def __init__(self):
+        self.connect_timeout = getattr(settings, "GEMINI_CONNECT_TIMEOUT", 5.0)
+        self.read_timeout = getattr(settings, "GEMINI_READ_TIMEOUT", 60.0)
+        self.max_connections = getattr(settings, "GEMINI_MAX_CONNECTIONS", 20)
+        self.max_keepalive = getattr(settings, "GEMINI_MAX_KEEPALIVE", 10)
+        self.max_concurrency = getattr(settings, "GEMINI_MAX_CONCURRENCY", 8)
+        self.max_retries = getattr(settings, "GEMINI_MAX_RETRIES", 3)
+        self.backoff_base = getattr(settings, "GEMINI_BACKOFF_BASE", 0.5)
+        self.max_backoff = getattr(settings, "GEMINI_MAX_BACKOFF", 10.0)
+
+        # httpx y asyncio.Semaphore quedan ligados al loop que los crea:
+        # Daphne usa un solo loop, pero async_to_sync puede crear otros.
+        self._clients = weakref.WeakKeyDictionary()
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive,
+                ),
+                headers={"Content-Type": "application/json"},
+            )
+            self._clients[loop] = client
+        return client
+
+    def _get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    def _backoff(self, attempt, response=None):
+        """
+        Espera antes del próximo intento, o None si no vale la pena: un
+        Retry-After mayor que max_backoff tendría al handler dormido con
+        un lugar del semáforo tomado, así que se devuelve el error.
+        """
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    pass
+                else:
+                    return delay if delay <= self.max_backoff else None
+        delay = self.backoff_base * (2 ** attempt)
+        return min(delay + random.uniform(0, delay / 2), self.max_backoff)
+
+    async def post_json(self, url, payload, params=None, retries=None):
+        client = self._get_client()
+        max_retries = self.max_retries if retries is None else retries
+
+        async with self._get_semaphore():
+            attempt = 0
+            while True:
+                try:
+                    response = await client.post(url, params=params, json=payload)
+                except (httpx.TimeoutException, httpx.TransportError):
+                    if attempt >= max_retries:
+                        raise
+                    await asyncio.sleep(self._backoff(attempt))
+                    attempt += 1
+                    continue
+
+                delay = None
+                if response.status_code in RETRY_STATUS and attempt < max_retries:
+                    delay = self._backoff(attempt, response)
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+
+                response.raise_for_status()
+                return response.json()
+
+    async def stream_sse(self, url, payload, params=None, retries=None):
+        """
+        POST con respuesta Server-Sent Events; devuelve cada evento `data:`
+        ya decodificado. Solo se reintenta antes de recibir el primer byte.
+        """
+        client = self._get_client()
+        max_retries = self.max_retries if retries is None else retries
+
+        async with self._get_semaphore():
+            attempt = 0
+            while True:
+                started = False
+                try:
+                    async with client.stream("POST", url, params=params, json=payload) as response:
+                        delay = None
+                        if response.status_code in RETRY_STATUS and attempt < max_retries:
+                            delay = self._backoff(attempt, response)
+                        if delay is not None:
+                            await response.aread()
+                        else:
+                            if response.is_error:
+                                await response.aread()
+                            response.raise_for_status()
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data:"):
+                                    continue
+                                data = line[5:].strip()
+                                if data:
+                                    started = True
+                                    yield json.loads(data)
+                            return
+                except (httpx.TimeoutException, httpx.TransportError):
+                    if started or attempt >= max_retries:
+                        raise
+                    delay = self._backoff(attempt)
+
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def aclose(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = GeminiClient()
+    return _client
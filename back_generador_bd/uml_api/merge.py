@@ -0,0 +1,280 @@
+# Motor de merge de las respuestas de edición/eliminación (del LLM o del
+# motor local) sobre el estado de una sala. Traduce cada elemento marcado
+# con "editado"/"eliminar" a una operación fina de RoomState, así el
+# resultado se aplica en O(cambios) y se reenvía solo el delta.
+#
+# Las clases se resuelven por id y si no por nombre (exacto y después sin
+# mayúsculas); las relaciones por id o por el par de clases extremo. Una
+# relación con un tipo que el par no tiene es nueva, salvo que traiga
+# "tipoOriginal" (cambio de tipo explícito).
+
+CLASS_MEMBERS = {
+    "attributes": ("attribute", ("name", "type")),
+    "methods": ("method", ("name", "parameters", "returnType")),
+}
+RELATIONSHIP_CHANGES = ("type", "labels")
+
+
+class UMLMerger:
+    """
+    Índices nombre→id y par de clases→relaciones, construidos una vez
+    sobre `state` (un RoomState) y mantenidos al aplicar cada operación.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.by_name = {}
+        self.by_lower = {}
+        self.pairs = {}
+        for cls in state.classes.values():
+            self._index_class(cls)
+        for rel in state.relationships.values():
+            self._index_relationship(rel)
+        self.applied = []
+        self.unresolved = []
+
+    # ---------- índices ----------
+    def _index_class(self, cls):
+        name = cls.get("name") or ""
+        self.by_name[name] = cls["id"]
+        self.by_lower.setdefault(name.lower(), cls["id"])
+
+    def _unindex_class(self, class_id, name):
+        name = name or ""
+        if self.by_name.get(name) == class_id:
+            del self.by_name[name]
+        if self.by_lower.get(name.lower()) == class_id:
+            del self.by_lower[name.lower()]
+            # Otra clase con el mismo nombre en minúsculas pasa a ser la referencia
+            for other in self.state.classes.values():
+                if other["id"] != class_id and (other.get("name") or "").lower() == name.lower():
+                    self.by_lower[name.lower()] = other["id"]
+                    break
+
+    @staticmethod
+    def _pair(source, target):
+        return frozenset((source, target))
+
+    def _index_relationship(self, rel):
+        self.pairs.setdefault(self._pair(rel.get("sourceId"), rel.get("targetId")), set()).add(rel["id"])
+
+    def _unindex_relationship(self, rel_id, source, target):
+        ids = self.pairs.get(self._pair(source, target))
+        if ids is not None:
+            ids.discard(rel_id)
+            if not ids:
+                del self.pairs[self._pair(source, target)]
+
+    def find_class(self, ref, name=None):
+        """Id de la clase a la que se refiere `ref` (id o nombre), o None."""
+        for candidate in (ref, name):
+            if not isinstance(candidate, str) or not candidate:
+                continue
+            if candidate in self.state.classes:
+                return candidate
+            class_id = self.by_name.get(candidate) or self.by_lower.get(candidate.lower())
+            if class_id is not None:
+                return class_id
+        return None
+
+    # ---------- aplicación ----------
+    def _apply(self, op, element):
+        before = None
+        if op["t"] in ("update_class", "delete_class"):
+            before = self.state.classes.get(op["id"], {}).get("name")
+        elif op["t"] in ("update_relationship", "delete_relationship"):
+            rel = self.state.relationships.get(op["id"]) or {}
+            before = (rel.get("sourceId"), rel.get("targetId"))
+        try:
+            delta = self.state.apply(op)
+        except ValueError as e:
+            self.skip(element, str(e))
+            return None
+
+        kind = delta["t"]
+        if kind == "add_class":
+            self._index_class(self.state.classes[delta["id"]])
+        elif kind == "update_class" and "name" in delta["changes"]:
+            self._unindex_class(delta["id"], before)
+            self._index_class(self.state.classes[delta["id"]])
+        elif kind == "delete_class":
+            self._unindex_class(delta["id"], before)
+            for ids in self.pairs.values():
+                ids.difference_update(delta["removed_relationships"])
+        elif kind == "add_relationship":
+            self._index_relationship(self.state.relationships[delta["id"]])
+        elif kind == "update_relationship":
+            self._unindex_relationship(delta["id"], *before)
+            self._index_relationship(self.state.relationships[delta["id"]])
+        elif kind == "delete_relationship":
+            self._unindex_relationship(delta["id"], *before)
+
+        self.applied.append((delta, self.state.version))
+        return delta
+
+    def skip(self, element, reason):
+        self.unresolved.append({"element": element, "reason": reason})
+
+    def merge(self, result):
+        """
+        Aplica la respuesta de un modo edit/delete. Acepta el formato nuevo
+        ({"editado": ...} con nombreOriginal), el anterior con "original" y
+        los marcadores "eliminar" del modo delete.
+        """
+        if not isinstance(result, dict):
+            self.skip(result, "La respuesta no es un objeto")
+            return self.applied, self.unresolved
+        if "editado" in result or "original" in result:
+            changes = result.get("editado") or {}
+            original = result.get("original") or {}
+        else:
+            changes, original = result, {}
+        originals = {
+            cls.get("id"): cls for cls in original.get("classes") or []
+            if isinstance(cls, dict) and cls.get("id")
+        }
+        # Formato anterior: el tipo de "original" para el mismo par es el tipo previo
+        original_types = {
+            self._pair(rel.get("sourceId"), rel.get("targetId")): rel.get("type")
+            for rel in original.get("relationships") or [] if isinstance(rel, dict)
+        }
+
+        for cls in changes.get("classes") or []:
+            if isinstance(cls, dict):
+                self._merge_class(cls, originals.get(cls.get("id")))
+        for rel in changes.get("relationships") or []:
+            if isinstance(rel, dict):
+                previous_type = original_types.get(self._pair(rel.get("sourceId"), rel.get("targetId")))
+                if previous_type and "tipoOriginal" not in rel:
+                    rel = {**rel, "tipoOriginal": previous_type}
+                self._merge_relationship(rel)
+        return self.applied, self.unresolved
+
+    # ---------- clases y miembros ----------
+    def _merge_class(self, cls, original=None):
+        previous_name = cls.get("nombreOriginal") or (original or {}).get("name")
+        class_id = self.find_class(cls.get("id"), previous_name or cls.get("name"))
+
+        if cls.get("eliminar"):
+            if class_id is None:
+                self.skip(cls, f"No existe la clase {cls.get('name') or cls.get('id')}")
+            else:
+                self._apply({"t": "delete_class", "id": class_id}, cls)
+            return
+
+        if class_id is None:
+            if any(m.get("eliminar") for key in CLASS_MEMBERS for m in cls.get(key) or [] if isinstance(m, dict)):
+                self.skip(cls, f"No existe la clase {cls.get('name')}")
+                return
+            self._add_class(cls)
+            return
+
+        current = self.state.classes[class_id]
+        if cls.get("name") and cls["name"] != current.get("name") and (previous_name or cls.get("id") == class_id):
+            self._apply({"t": "update_class", "id": class_id, "changes": {"name": cls["name"]}}, cls)
+
+        for key, (member, fields) in CLASS_MEMBERS.items():
+            before = (original or {}).get(key) or []
+            items = [m for m in cls.get(key) or [] if isinstance(m, dict)]
+            # Formato anterior: el miembro i de "editado" es el i de "original"
+            aligned = len(before) == len(items)
+            for i, item in enumerate(items):
+                name = item.get("nombreOriginal") or (before[i].get("name") if aligned and isinstance(before[i], dict) else None)
+                self._merge_member(class_id, member, fields, key, item, name or item.get("name"))
+
+    def _add_class(self, cls):
+        payload = {"name": cls.get("name", "")}
+        for key, (_, fields) in CLASS_MEMBERS.items():
+            payload[key] = [
+                {k: v for k, v in m.items() if k in fields}
+                for m in cls.get(key) or [] if isinstance(m, dict) and not m.get("eliminar")
+            ]
+        class_id = cls.get("id")
+        op = {"t": "add_class", "payload": payload}
+        # Los ids inventados por el modelo ("uuid", nombres...) no se reutilizan
+        if isinstance(class_id, str) and len(class_id) >= 32 and class_id not in self.state.classes:
+            op["id"] = class_id
+        self._apply(op, cls)
+
+    @staticmethod
+    def _find_member(members, name):
+        if not name:
+            return None
+        for member in members:
+            if member.get("name") == name:
+                return member
+        for member in members:
+            if str(member.get("name", "")).lower() == name.lower():
+                return member
+        return None
+
+    def _merge_member(self, class_id, member, fields, key, item, name):
+        members = self.state.classes[class_id].get(key) or []
+        existing = self._find_member(members, name)
+
+        if item.get("eliminar"):
+            if existing is None:
+                self.skip(item, f"No existe el {member} {name}")
+            else:
+                self._apply({"t": f"delete_{member}", "class_id": class_id, "name": existing["name"]}, item)
+            return
+
+        values = {k: item[k] for k in fields if k in item}
+        if existing is None:
+            if not values.get("name"):
+                self.skip(item, f"El {member} necesita nombre")
+                return
+            self._apply({"t": f"add_{member}", "class_id": class_id, member: values}, item)
+            return
+
+        changes = {k: v for k, v in values.items() if existing.get(k) != v}
+        if changes:
+            self._apply({"t": f"update_{member}", "class_id": class_id, "name": existing["name"], "changes": changes}, item)
+
+    # ---------- relaciones ----------
+    def _matching_relationships(self, rel, source, target):
+        if rel.get("id") in self.state.relationships:
+            return [rel["id"]]
+        if source is None or target is None:
+            return []
+        ids = sorted(self.pairs.get(self._pair(source, target)) or ())
+        if rel.get("tipoOriginal"):
+            # Cambio de tipo explícito: la del tipo anterior, o la del par si no hay
+            return self._of_type(ids, rel["tipoOriginal"]) or ids
+        if rel.get("type"):
+            # Un tipo que el par no tiene es una relación nueva, no un cambio de tipo
+            return self._of_type(ids, rel["type"])
+        return ids
+
+    def _of_type(self, ids, kind):
+        return [rel_id for rel_id in ids if self.state.relationships[rel_id].get("type") == kind]
+
+    def _merge_relationship(self, rel):
+        source = self.find_class(rel.get("sourceId"))
+        target = self.find_class(rel.get("targetId"))
+        matches = self._matching_relationships(rel, source, target)
+
+        if rel.get("eliminar"):
+            if not matches:
+                self.skip(rel, f"No hay relación entre {rel.get('sourceId')} y {rel.get('targetId')}")
+            for rel_id in matches:
+                self._apply({"t": "delete_relationship", "id": rel_id}, rel)
+            return
+
+        if not matches:
+            if source is None or target is None:
+                self.skip(rel, f"No existen las clases {rel.get('sourceId')} / {rel.get('targetId')}")
+                return
+            payload = {"type": rel.get("type") or "association", "sourceId": source, "targetId": target}
+            if isinstance(rel.get("labels"), list):
+                payload["labels"] = rel["labels"]
+            self._apply({"t": "add_relationship", "payload": payload}, rel)
+            return
+
+        current = self.state.relationships[matches[0]]
+        changes = {k: rel[k] for k in RELATIONSHIP_CHANGES if k in rel and rel[k] != current.get(k)}
+        for end, resolved in (("sourceId", source), ("targetId", target)):
+            if resolved is not None and resolved != current.get(end):
+                changes[end] = resolved
+        if changes:
+            self._apply({"t": "update_relationship", "id": matches[0], "changes": changes}, rel)
@@ -0,0 +1,260 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Métricas en formato de exposición de Prometheus, sin dependencias.
+#
+# Cada métrica guarda sus series en un dict {valores de labels: dato}; en
+# el camino caliente (broadcast del canvas) solo se hace un lookup y una
+# suma bajo un lock sin contención. El texto se arma al hacer scrape.
+# Cada proceso (worker de Daphne) expone lo suyo: Prometheus los scrapea
+# por separado y se agregan con sum().
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def remove(self, *values):
+        with self._lock:
+            self._series.pop(tuple(values), None)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *values, amount=1):
+        key = tuple(values)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = list(self._series.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in series
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+    def set(self, *values, value):
+        with self._lock:
+            self._series[tuple(values)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *values, value):
+        key = tuple(values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._series.get(key)
+            if data is None:
+                # Conteo por bucket (no acumulado) + suma + total
+                data = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[key] = data
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    @contextmanager
+    def time(self, *values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*values, value=time.perf_counter() - start)
+
+    def render(self):
+        with self._lock:
+            series = [(key, (list(data[0]), data[1], data[2])) for key, data in self._series.items()]
+        lines = self.header()
+        for key, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = 'le="' + _format_value(float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.add(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, func):
+        """func() -> {nombre: (tipo, ayuda, labels, {valores: dato})}, evaluada en cada scrape."""
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                lines.append(f"# collector {collect.__name__} falló: {_escape(e)}")
+                continue
+            for name, (kind, documentation, labels, series) in families.items():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for values, value in series.items():
+                    lines.append(f"{name}{_format_labels(labels, values)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ---------- canvas (websocket) ----------
+ws_connections = registry.gauge(
+    "canvas_ws_connections", "Conexiones websocket abiertas por sala", ("room",))
+ws_messages = registry.counter(
+    "canvas_ws_messages_total", "Mensajes websocket por dirección y tipo", ("direction", "type"))
+ws_bytes = registry.counter(
+    "canvas_ws_bytes_total", "Bytes de mensajes websocket por dirección y tipo", ("direction", "type"))
+ws_message_size = registry.histogram(
+    "canvas_ws_message_size_bytes", "Tamaño de los mensajes recibidos por tipo", ("type",), SIZE_BUCKETS)
+ws_misrouted = registry.counter(
+    "canvas_ws_misrouted_total", "Conexiones que llegaron a un worker que no es del nodo de la sala")
+group_send_seconds = registry.histogram(
+    "canvas_group_send_seconds", "Latencia de group_send del channel layer", ("event",))
+
+# ---------- LLM ----------
+llm_seconds = registry.histogram(
+    "uml_llm_request_seconds", "Latencia de las llamadas a Gemini por modo", ("mode", "stream"))
+llm_backend_seconds = registry.histogram(
+    "uml_llm_backend_seconds", "Latencia de las llamadas al LLM por backend elegido", ("backend",))
+llm_errors = registry.counter(
+    "uml_llm_errors_total", "Llamadas a Gemini fallidas por modo y error", ("mode", "error"))
+llm_tokens = registry.counter(
+    "uml_llm_tokens_total", "Tokens informados por Gemini (usageMetadata)", ("mode", "kind"))
+json_parse_failures = registry.counter(
+    "uml_json_parse_failures_total", "JSON inválido en GenerateUMLView (cuerpo o respuesta de Gemini)", ("source",))
+
+# ---------- BackupUML ----------
+backup_db_seconds = registry.histogram(
+    "uml_backup_db_seconds", "Latencia de lectura/escritura de BackupUML en la base", ("op",))
+
+USAGE_FIELDS = {
+    "promptTokenCount": "prompt",
+    "candidatesTokenCount": "output",
+    "totalTokenCount": "total",
+}
+
+
+def record_usage(mode, result):
+    """Tokens del usageMetadata de una respuesta (o del último evento SSE)."""
+    usage = result.get("usageMetadata") if isinstance(result, dict) else None
+    if not usage:
+        return
+    for field, kind in USAGE_FIELDS.items():
+        if usage.get(field):
+            llm_tokens.inc(mode or "create", kind, amount=usage[field])
+
+
+async def timed_group_send(channel_layer, group, message):
+    start = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, message)
+    finally:
+        group_send_seconds.observe(message["type"], value=time.perf_counter() - start)
+
+
+def _snapshot_series(prefix, snapshot, families):
+    # Los contadores de los snapshot() existentes, aplanados como gauges
+    for key, value in snapshot.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        families[f"{prefix}_{key}"] = ("gauge", f"{prefix} {key}", (), {(): value})
+
+
+@registry.collector
+def internal_stats():
+    from .cache import get_cache
+    from .jobs import get_job_queue
+    from .persistence import get_writer
+    from .providers import get_router
+    from .ratelimit import get_limiter, get_monitor
+
+    families = {}
+    _snapshot_series("uml_cache", get_cache().snapshot(), families)
+    _snapshot_series("uml_jobs", get_job_queue().snapshot(), families)
+    _snapshot_series("uml_rate_limit", get_limiter().snapshot(), families)
+    _snapshot_series("uml_upstream", get_monitor().snapshot(), families)
+    _snapshot_series("uml_backup_writer", get_writer().snapshot(), families)
+
+    router = get_router().snapshot()
+    _snapshot_series("uml_llm_router", router, families)
+    # Por backend: una serie con la etiqueta backend por cada valor numérico
+    for name, backend in router["backends"].items():
+        for key, value in backend.items():
+            if value is None or not isinstance(value, (int, float)):
+                continue
+            family = families.setdefault(
+                f"uml_llm_backend_{key}", ("gauge", f"uml_llm_backend {key}", ("backend",), {}))
+            family[3][(name,)] = float(value)
+    return families
+
+
+def render():
+    return registry.render()
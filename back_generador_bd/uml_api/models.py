@@ -7,4 +7,26 @@ class BackupUML(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
-        return str(self.room_id)
\ No newline at end of file
+        return str(self.room_id)
+
+
+class BackupUMLRevision(models.Model):
+    # Historial: snapshots completos cada N revisiones y patches RFC 6902
+    # entre ellos, ambos comprimidos con zlib
+    SNAPSHOT = "snapshot"
+    PATCH = "patch"
+    KIND_CHOICES = [(SNAPSHOT, "Snapshot"), (PATCH, "Patch")]
+
+    room_id = models.UUIDField(db_index=True)
+    revision = models.PositiveIntegerField()
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES)
+    payload = models.BinaryField()
+    size = models.PositiveIntegerField(default=0)   # bytes sin comprimir
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ("room_id", "revision")
+        ordering = ["room_id", "revision"]
+
+    def __str__(self):
+        return f"{self.room_id}@{self.revision}"
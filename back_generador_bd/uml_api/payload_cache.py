@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .redis_conn import get_sync_redis
+
+logger = logging.getLogger(__name__)
+
+
+class BackupPayload:
+    __slots__ = ("etag", "body", "gzipped")
+
+    def __init__(self, etag, body, gzipped=None):
+        self.etag = etag
+        self.body = body
+        self.gzipped = gzipped
+
+
+class BackupPayloadCache:
+    """
+    Caché de get_backup_uml con el documento ya serializado.
+
+    Cada entrada guarda el ETag (hash del contenido), los bytes JSON y,
+    si vale la pena, su versión gzip. Se refresca en cada escritura, así
+    las lecturas y los 304 no tocan Postgres. Con Redis activado (por
+    defecto) la entrada se comparte entre workers y solo se lee de ahí:
+    la copia en memoria de un worker no ve lo que escribió otro.
+    """
+
+    def __init__(self):
+        self.max_entries = getattr(settings, "BACKUP_PAYLOAD_CACHE_ENTRIES", 512)
+        self.gzip_min_bytes = getattr(settings, "BACKUP_PAYLOAD_GZIP_MIN", 1024)
+        self.use_redis = getattr(settings, "BACKUP_PAYLOAD_CACHE_REDIS", True)
+        self.ttl = getattr(settings, "BACKUP_PAYLOAD_CACHE_TTL", 3600)
+        self.prefix = "backup_payload:"
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "puts": 0, "not_modified": 0}
+
+    def render(self, data):
+        # Mismo formato compacto que el JSONRenderer de DRF
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        gzipped = gzip.compress(body, 6) if len(body) >= self.gzip_min_bytes else None
+        return BackupPayload(etag, body, gzipped)
+
+    def get(self, room_id):
+        key = str(room_id)
+        redis = get_sync_redis() if self.use_redis else None
+        if redis is not None:
+            entry = self._get_redis(redis, key)
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+        self.stats["hits" if entry is not None else "misses"] += 1
+        return entry
+
+    def put(self, room_id, data):
+        key = str(room_id)
+        entry = self.render(data)
+        self.stats["puts"] += 1
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        redis = get_sync_redis() if self.use_redis else None
+        if redis is not None:
+            mapping = {"etag": entry.etag, "body": entry.body}
+            if entry.gzipped is not None:
+                mapping["gzip"] = entry.gzipped
+            try:
+                pipe = redis.pipeline()
+                pipe.delete(self.prefix + key)
+                pipe.hset(self.prefix + key, mapping=mapping)
+                pipe.expire(self.prefix + key, self.ttl)
+                pipe.execute()
+            except Exception as e:
+                logger.warning("Error escribiendo payload en Redis: %s", e)
+        return entry
+
+    def shared_data(self, room_id):
+        """
+        Documento del último guardado según Redis, o None. Lo usa
+        load_backup: con write-behind el guardado puede estar todavía en
+        el buffer de otro worker y Postgres tener la versión anterior.
+        """
+        redis = get_sync_redis() if self.use_redis else None
+        if redis is None:
+            return None
+        try:
+            body = redis.hget(self.prefix + str(room_id), "body")
+        except Exception as e:
+            logger.warning("Error leyendo payload de Redis: %s", e)
+            return None
+        return json.loads(body) if body else None
+
+    def _get_redis(self, redis, key):
+        try:
+            raw = redis.hgetall(self.prefix + key)
+        except Exception as e:
+            logger.warning("Error leyendo payload de Redis: %s", e)
+            return None
+        if not raw:
+            return None
+        return BackupPayload(raw[b"etag"].decode(), raw[b"body"], raw.get(b"gzip"))
+
+    def snapshot(self):
+        with self._lock:
+            entries = len(self._entries)
+        return {**self.stats, "entries": entries, "redis_enabled": bool(self.use_redis)}
+
+
+_payload_cache = None
+
+
+def get_payload_cache():
+    global _payload_cache
+    if _payload_cache is None:
+        _payload_cache = BackupPayloadCache()
+    return _payload_cache
@@ -0,0 +1,205 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics
+from .models import BackupUML
+from .payload_cache import get_payload_cache
+from .revisions import get_revision_store
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class BackupWriter:
+    """
+    Persistencia write-behind de BackupUML.
+
+    Guarda en memoria el último estado de cada sala, agrupa los guardados
+    rápidos (debounce) y los escribe por lotes con un upsert
+    (INSERT ... ON CONFLICT DO UPDATE). Al apagar el proceso se vacía
+    todo lo pendiente.
+
+    El buffer es de este proceso; los demás workers ven lo pendiente por
+    la caché de payload en Redis (ver load_backup). Sin Redis hace falta
+    un solo worker o BACKUP_WRITE_BEHIND=False.
+    """
+
+    def __init__(self):
+        self.debounce = getattr(settings, "BACKUP_FLUSH_DEBOUNCE", 2.0)
+        self.max_delay = getattr(settings, "BACKUP_FLUSH_MAX_DELAY", 10.0)
+        self.interval = getattr(settings, "BACKUP_FLUSH_INTERVAL", 0.5)
+        self.batch_size = getattr(settings, "BACKUP_FLUSH_BATCH_SIZE", 200)
+        self.record_history = getattr(settings, "BACKUP_HISTORY", True)
+
+        self._pending = {}
+        # Lo que se está escribiendo: sigue visible para load_backup hasta el commit
+        self._writing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.stats = {
+            "scheduled": 0,
+            "coalesced": 0,
+            "flushed": 0,
+            "batches": 0,
+            "errors": 0,
+            "last_flush_lag": 0.0,
+            "max_flush_lag": 0.0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="backup-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush_all)
+
+    def schedule(self, room_id, data):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._pending.get(room_id)
+            if entry is None:
+                self._pending[room_id] = {"data": data, "first": now, "last": now}
+            else:
+                # Solo importa el último estado: se pisa el anterior
+                entry["data"] = data
+                entry["last"] = now
+                self.stats["coalesced"] += 1
+            self.stats["scheduled"] += 1
+        self.start()
+
+    def pending(self, room_id):
+        with self._lock:
+            entry = self._pending.get(room_id) or self._writing.get(room_id)
+            return entry["data"] if entry else None
+
+    def _due(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            due = [
+                room_id for room_id, entry in self._pending.items()
+                if force
+                or now - entry["last"] >= self.debounce
+                or now - entry["first"] >= self.max_delay
+            ]
+            batch = {room_id: self._pending.pop(room_id) for room_id in due[:self.batch_size]}
+            self._writing.update(batch)
+        return batch
+
+    def _written(self, batch):
+        with self._lock:
+            for room_id in batch:
+                self._writing.pop(room_id, None)
+
+    def flush(self, force=False):
+        with self._flush_lock:
+            batch = self._due(force)
+            if not batch:
+                return 0
+            try:
+                with metrics.backup_db_seconds.time("bulk_write"):
+                    BackupUML.objects.bulk_create(
+                        [BackupUML(room_id=room_id, data=entry["data"]) for room_id, entry in batch.items()],
+                        update_conflicts=True,
+                        unique_fields=["room_id"],
+                        update_fields=["data"],
+                    )
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error("Error guardando backups (%s salas): %s", len(batch), e)
+                self._requeue(batch)
+                return 0
+            self._written(batch)
+
+            if self.record_history:
+                for room_id, entry in batch.items():
+                    record_revision(room_id, entry["data"])
+
+            now = time.monotonic()
+            lag = max(now - entry["first"] for entry in batch.values())
+            self.stats["flushed"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["last_flush_lag"] = round(lag, 4)
+            self.stats["max_flush_lag"] = round(max(self.stats["max_flush_lag"], lag), 4)
+            return len(batch)
+
+    def _requeue(self, batch):
+        with self._lock:
+            for room_id, entry in batch.items():
+                self._writing.pop(room_id, None)
+                # No pisar un estado más nuevo que llegó mientras tanto
+                self._pending.setdefault(room_id, entry)
+
+    def flush_all(self):
+        while self._pending:
+            if not self.flush(force=True):
+                break
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                while self.flush():
+                    pass
+            except Exception:
+                # El hilo no puede morir: lo pendiente se reintenta en la próxima vuelta
+                self.stats["errors"] += 1
+                logger.exception("Error inesperado en el writer de backups")
+            finally:
+                close_old_connections()
+
+    def snapshot(self):
+        with self._lock:
+            pending = len(self._pending)
+            oldest = min((entry["first"] for entry in self._pending.values()), default=None)
+        lag = time.monotonic() - oldest if oldest is not None else 0.0
+        return {**self.stats, "pending": pending, "current_flush_lag": round(lag, 4)}
+
+
+_writer = None
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        _writer = BackupWriter()
+    return _writer
+
+
+def save_backup(room_id, data):
+    """Guarda el backup de una sala (diferido si BACKUP_WRITE_BEHIND está activo)."""
+    # Refrescar el payload pre-serializado: la próxima lectura no toca Postgres
+    get_payload_cache().put(room_id, data)
+    if getattr(settings, "BACKUP_WRITE_BEHIND", True):
+        get_writer().schedule(room_id, data)
+    else:
+        with metrics.backup_db_seconds.time("write"), span("backup.write"):
+            BackupUML.objects.update_or_create(room_id=room_id, defaults={"data": data})
+        if getattr(settings, "BACKUP_HISTORY", True):
+            record_revision(room_id, data)
+
+
+def record_revision(room_id, data):
+    # El historial nunca debe hacer fallar el guardado principal
+    try:
+        get_revision_store().record(room_id, data)
+    except Exception as e:
+        logger.error("Error guardando revisión de %s: %s", room_id, e)
+
+
+def load_backup(room_id):
+    """Lee el backup de una sala viendo primero lo pendiente de escribir."""
+    pending = get_writer().pending(room_id) if _writer is not None else None
+    if pending is None and getattr(settings, "BACKUP_WRITE_BEHIND", True):
+        # Pendiente en el buffer de otro worker: save_backup ya lo dejó en Redis
+        pending = get_payload_cache().shared_data(room_id)
+    if pending is not None:
+        return pending
+    with metrics.backup_db_seconds.time("read"), span("backup.read"):
+        backup = BackupUML.objects.filter(room_id=room_id).first()
+    return backup.data if backup else None
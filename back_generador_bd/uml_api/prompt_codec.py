@@ -0,0 +1,164 @@
+import re
+
+# Serialización compacta del UML para los prompts de análisis: texto
+# canónico con alias cortos (C1, R1...) en lugar de UUIDs y sin campos de
+# layout. La respuesta del modelo se traduce de vuelta a los ids reales.
+
+ALIAS_RE = re.compile(r"\b([CR]\d+)\b")
+
+
+def _attribute(attr):
+    if not isinstance(attr, dict):
+        return str(attr)
+    name, kind = attr.get("name") or "", attr.get("type") or ""
+    return f"{name}:{kind}" if kind else name
+
+
+def _method(method):
+    if not isinstance(method, dict):
+        return str(method)
+    text = f"{method.get('name') or ''}({method.get('parameters') or ''})"
+    if method.get("returnType"):
+        text += f":{method['returnType']}"
+    return text
+
+
+def _class_line(cls):
+    attrs = ", ".join(_attribute(a) for a in cls.get("attributes") or [])
+    methods = ", ".join(_method(m) for m in cls.get("methods") or [])
+    line = f"{cls.get('name') or '?'}: {attrs}"
+    if methods:
+        line += f" | {methods}"
+    return line
+
+
+class EncodedUML:
+    """
+    Texto compacto de un UML y la tabla de alias para deshacerlo.
+
+    Los alias se asignan en orden canónico (por contenido, no por id), así
+    dos diagramas equivalentes producen el mismo texto y comparten caché.
+    """
+
+    def __init__(self, uml):
+        classes = [c for c in uml.get("classes") or [] if isinstance(c, dict)]
+        relationships = [r for r in uml.get("relationships") or [] if isinstance(r, dict)]
+
+        # Los ids pueden faltar (None) o no ser str: se comparan como texto
+        lines = sorted(((_class_line(c), c.get("id")) for c in classes), key=lambda t: (t[0], str(t[1])))
+        self.aliases = {}
+        self.names = {}
+        by_id = {}
+        text = ["Clases:"]
+        for i, (line, class_id) in enumerate(lines, 1):
+            alias = f"C{i}"
+            self.aliases[alias] = class_id
+            by_id[class_id] = alias
+            self.names[alias] = line.split(":", 1)[0]
+            text.append(f"{alias} {line}")
+
+        rel_lines = []
+        for rel in relationships:
+            labels = " ".join(l for l in rel.get("labels") or [] if isinstance(l, str) and l.strip())
+            line = (f"{rel.get('type') or 'association'} "
+                    f"{by_id.get(rel.get('sourceId'), '?')}->{by_id.get(rel.get('targetId'), '?')}")
+            if labels:
+                line += f" {labels}"
+            rel_lines.append((line, rel.get("id")))
+        rel_lines.sort(key=lambda t: (t[0], str(t[1])))
+
+        text.append("Relaciones:")
+        for i, (line, rel_id) in enumerate(rel_lines, 1):
+            alias = f"R{i}"
+            self.aliases[alias] = rel_id
+            text.append(f"{alias} {line}")
+        self.text = "\n".join(text)
+
+    def _decode_text(self, value):
+        # Si el modelo usó alias de clase en el texto, poner el nombre
+        return ALIAS_RE.sub(lambda m: self.names.get(m.group(1), m.group(1)), value)
+
+    def decode_item(self, item):
+        if not isinstance(item, dict):
+            return item
+        item = dict(item)
+        alias = item.get("id")
+        if isinstance(alias, str) and alias.strip() in self.aliases:
+            item["id"] = self.aliases[alias.strip()]
+        for key, value in item.items():
+            if key != "id" and isinstance(value, str):
+                item[key] = self._decode_text(value)
+        return item
+
+    def decode(self, analysis):
+        if not isinstance(analysis, dict) or "error" in analysis:
+            return analysis
+        return {
+            section: [self.decode_item(item) for item in analysis.get(section) or []]
+            for section in ("validas", "errores")
+        }
+
+
+def encode(uml):
+    return EncodedUML(uml if isinstance(uml, dict) else {})
+
+
+def split(uml, max_relationships):
+    """
+    Parte el UML en componentes conexas y las agrupa en trozos de hasta
+    `max_relationships` relaciones. Una componente más grande que el
+    límite va sola: partirla haría perder contexto al modelo.
+    """
+    uml = uml if isinstance(uml, dict) else {}
+    relationships = [r for r in uml.get("relationships") or [] if isinstance(r, dict)]
+    if len(relationships) <= max_relationships:
+        return [uml]
+
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for rel in relationships:
+        a, b = find(rel.get("sourceId")), find(rel.get("targetId"))
+        if a != b:
+            parent[a] = b
+
+    components = {}
+    for rel in relationships:
+        components.setdefault(find(rel.get("sourceId")), []).append(rel)
+
+    # First-fit decreciente: menos trozos y de tamaño parecido
+    bins = []
+    for rels in sorted(components.values(), key=len, reverse=True):
+        for chunk in bins:
+            if len(chunk) + len(rels) <= max_relationships:
+                chunk.extend(rels)
+                break
+        else:
+            bins.append(list(rels))
+
+    classes = [c for c in uml.get("classes") or [] if isinstance(c, dict)]
+    parts = []
+    for rels in bins:
+        ids = {r.get("sourceId") for r in rels} | {r.get("targetId") for r in rels}
+        parts.append({
+            "classes": [c for c in classes if c.get("id") in ids],
+            "relationships": rels,
+        })
+    return parts
+
+
+def merge(results):
+    """Une los análisis de cada trozo; el primer error se devuelve tal cual."""
+    merged = {"validas": [], "errores": []}
+    for analysis in results:
+        if not isinstance(analysis, dict) or "error" in analysis:
+            return analysis
+        for section in merged:
+            merged[section].extend(analysis.get(section) or [])
+    return merged
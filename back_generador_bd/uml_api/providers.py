@@ -0,0 +1,336 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+
+from .llm_client import get_client
+
+logger = logging.getLogger(__name__)
+
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent"
+GEMINI_MODEL_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:{method}"
+
+# Varios backends del LLM (modelos o endpoints) detrás de un router: cada
+# uno lleva EWMA de latencia y de errores, se elige el más rápido sano y,
+# con LLM_HEDGE, si la respuesta tarda más que el percentil de ese backend
+# se manda una segunda petición a otro y gana la primera que vuelve.
+
+FAKE_TEXT = '{"classes": [], "relationships": []}'
+
+
+class Backend:
+    """Estadísticas de un backend; las subclases hacen la llamada."""
+
+    def __init__(self, name, alpha=0.2, samples=200):
+        self.name = name
+        self.alpha = alpha
+        self.latency_ewma = None
+        self.error_ewma = 0.0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self.inflight = 0
+        self._samples = deque(maxlen=samples)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "cancelled": 0}
+
+    def record_success(self, seconds):
+        with self._lock:
+            self.stats["requests"] += 1
+            self.latency_ewma = seconds if self.latency_ewma is None else (
+                self.alpha * seconds + (1 - self.alpha) * self.latency_ewma)
+            self.error_ewma = (1 - self.alpha) * self.error_ewma
+            self.failures = 0
+            self._samples.append(seconds)
+
+    def record_error(self, failures_to_cooldown, cooldown):
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["errors"] += 1
+            self.error_ewma = self.alpha + (1 - self.alpha) * self.error_ewma
+            self.failures += 1
+            if self.failures >= failures_to_cooldown:
+                # Circuito abierto: no se elige hasta que venza; después
+                # una sola falla lo vuelve a abrir
+                self.cooldown_until = time.monotonic() + cooldown
+                self.failures = failures_to_cooldown - 1
+
+    def record_cancelled(self):
+        with self._lock:
+            self.stats["cancelled"] += 1
+
+    def healthy(self, now=None):
+        return (now or time.monotonic()) >= self.cooldown_until
+
+    def score(self):
+        # Sin muestras va primero (hay que medirlo); los errores pesan como latencia
+        if self.latency_ewma is None:
+            return 0.0
+        return self.latency_ewma * (1 + 4 * self.error_ewma)
+
+    def percentile(self, pct, min_samples=20):
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100.0 * len(ordered)))]
+
+    def snapshot(self):
+        p95 = self.percentile(95)
+        return dict(
+            self.stats,
+            latency_ewma_ms=round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            p95_ms=round(p95 * 1000, 1) if p95 is not None else None,
+            error_rate=round(self.error_ewma, 3),
+            healthy=self.healthy(),
+            inflight=self.inflight,
+        )
+
+    async def generate(self, payload, retries=None):
+        raise NotImplementedError
+
+    def stream(self, payload, retries=None):
+        raise NotImplementedError
+
+
+class GeminiBackend(Backend):
+    def __init__(self, name, url, stream_url, **kwargs):
+        super().__init__(name, **kwargs)
+        self.url = url
+        self.stream_url = stream_url
+
+    def _params(self, **extra):
+        return dict(key=getattr(settings, "GEMINI_API_KEY", None), **extra)
+
+    async def generate(self, payload, retries=None):
+        return await get_client().post_json(self.url, payload, params=self._params(), retries=retries)
+
+    def stream(self, payload, retries=None):
+        return get_client().stream_sse(self.stream_url, payload, params=self._params(alt="sse"), retries=retries)
+
+
+class FakeBackend(Backend):
+    """
+    Backend local sin red con latencia configurable, para probar el ruteo
+    y el hedging: "fake:?latency=0.5&jitter=0.1&error_rate=0.05".
+    """
+
+    def __init__(self, name, latency=0.5, jitter=0.0, error_rate=0.0, text=FAKE_TEXT, **kwargs):
+        super().__init__(name, **kwargs)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.text = text
+
+    def _delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    async def generate(self, payload, retries=None):
+        await asyncio.sleep(self._delay())
+        if random.random() < self.error_rate:
+            raise RuntimeError(f"Error simulado en {self.name}")
+        return {"candidates": [{"content": {"parts": [{"text": self.text}]}}], "modelVersion": self.name}
+
+    async def stream(self, payload, retries=None):
+        await asyncio.sleep(self._delay())
+        if random.random() < self.error_rate:
+            raise RuntimeError(f"Error simulado en {self.name}")
+        step = max(1, len(self.text) // 4)
+        for i in range(0, len(self.text), step):
+            yield {"candidates": [{"content": {"parts": [{"text": self.text[i:i + step]}]}}]}
+            await asyncio.sleep(0)
+
+
+def parse_backend(spec, **kwargs):
+    """
+    "nombre=gemini:<modelo>", "nombre=https://.../models/x:generateContent"
+    o "nombre=fake:?latency=0.3&jitter=0.05&error_rate=0".
+    """
+    name, _, target = spec.partition("=")
+    name, target = name.strip(), target.strip()
+    if target.startswith("fake:"):
+        query = {k: v[0] for k, v in parse_qs(urlsplit(target).query).items()}
+        options = {k: float(query[k]) for k in ("latency", "jitter", "error_rate") if k in query}
+        if "text" in query:
+            options["text"] = query["text"]
+        return FakeBackend(name, **options, **kwargs)
+    if target.startswith("gemini:"):
+        model = target[len("gemini:"):]
+        return GeminiBackend(
+            name,
+            GEMINI_MODEL_URL.format(model=model, method="generateContent"),
+            GEMINI_MODEL_URL.format(model=model, method="streamGenerateContent"),
+            **kwargs,
+        )
+    if target.startswith(("http://", "https://")):
+        return GeminiBackend(name, target, target.replace(":generateContent", ":streamGenerateContent"), **kwargs)
+    raise ValueError(f"Backend LLM inválido: {spec}")
+
+
+class LLMRouter:
+    """
+    Elige backend por EWMA (latencia penalizada por errores) entre los que
+    no están en cooldown, con un poco de exploración para que un backend
+    lento pueda volver a medirse. Si la llamada falla se pasa al siguiente.
+    """
+
+    def __init__(self, backends=None):
+        alpha = getattr(settings, "LLM_EWMA_ALPHA", 0.2)
+        if backends is None:
+            specs = getattr(settings, "LLM_BACKENDS", None) or []
+            backends = [parse_backend(spec, alpha=alpha) for spec in specs]
+        if not backends:
+            # Sin LLM_BACKENDS: el endpoint de siempre (o el de GEMINI_API_URL)
+            backends = [GeminiBackend(
+                "gemini",
+                getattr(settings, "GEMINI_API_URL", None) or GEMINI_API_URL,
+                getattr(settings, "GEMINI_STREAM_URL", None) or GEMINI_STREAM_URL,
+                alpha=alpha,
+            )]
+        self.backends = backends
+        self.explore = getattr(settings, "LLM_EXPLORE", 0.05)
+        self.cooldown = getattr(settings, "LLM_COOLDOWN", 30.0)
+        self.failures_to_cooldown = getattr(settings, "LLM_FAILURES_TO_COOLDOWN", 3)
+        self.hedge = getattr(settings, "LLM_HEDGE", False)
+        self.hedge_percentile = getattr(settings, "LLM_HEDGE_PERCENTILE", 95.0)
+        self.hedge_min_delay = getattr(settings, "LLM_HEDGE_MIN_DELAY", 0.2)
+        self.hedge_max_ratio = getattr(settings, "LLM_HEDGE_MAX_RATIO", 0.1)
+        self.stats = {"calls": 0, "failovers": 0, "hedges": 0, "hedge_wins": 0}
+
+    # ---------- elección ----------
+    def ranked(self, exclude=()):
+        """Backends de mejor a peor; los que están en cooldown al final."""
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude]
+        healthy = sorted((b for b in candidates if b.healthy(now)), key=lambda b: (b.score(), b.inflight))
+        if len(healthy) > 1 and random.random() < self.explore:
+            healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+        cooling = sorted((b for b in candidates if not b.healthy(now)), key=lambda b: b.cooldown_until)
+        return healthy + cooling
+
+    def hedge_delay(self, backend):
+        """Espera antes de la segunda petición, o None si no corresponde."""
+        if not self.hedge or len(self.backends) < 2:
+            return None
+        # Presupuesto: a lo sumo hedge_max_ratio de las llamadas llevan hedge
+        if self.stats["hedges"] + 1 > self.hedge_max_ratio * self.stats["calls"] + 1:
+            return None
+        delay = backend.percentile(self.hedge_percentile)
+        if delay is None:
+            return None
+        return max(delay, self.hedge_min_delay)
+
+    # ---------- llamadas ----------
+    async def _timed(self, backend, payload, retries):
+        start = time.perf_counter()
+        backend.inflight += 1
+        try:
+            result = await backend.generate(payload, retries=retries)
+        except asyncio.CancelledError:
+            backend.record_cancelled()
+            raise
+        except Exception:
+            backend.record_error(self.failures_to_cooldown, self.cooldown)
+            raise
+        finally:
+            backend.inflight -= 1
+        backend.record_success(time.perf_counter() - start)
+        return result
+
+    def _launch(self, backend, payload, retries):
+        return asyncio.ensure_future(self._timed(backend, payload, retries))
+
+    async def generate(self, payload):
+        """(backend, respuesta) del primer backend que contesta bien."""
+        self.stats["calls"] += 1
+        order = self.ranked()
+        # Con alternativas no se reintenta en el mismo backend: se pasa al siguiente
+        retries = 0 if len(order) > 1 else None
+        pending = {}
+        hedge = None
+        error = None
+        try:
+            while order or pending:
+                if not pending:
+                    if error is not None:
+                        self.stats["failovers"] += 1
+                    backend = order.pop(0)
+                    pending[self._launch(backend, payload, retries)] = backend
+                delay = self.hedge_delay(backend) if hedge is None and len(pending) == 1 and order else None
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # La primera pasó el percentil de su backend: segunda
+                    # petición al siguiente y gana la que vuelva antes
+                    self.stats["hedges"] += 1
+                    hedge = self._launch(order[0], payload, retries)
+                    pending[hedge] = order.pop(0)
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        error = e
+                        logger.warning("Backend LLM %s falló: %s", backend.name, e)
+                        continue
+                    if task is hedge:
+                        self.stats["hedge_wins"] += 1
+                    return backend, result
+            raise error
+        finally:
+            # El perdedor (o todo, si cancelan al que llama) se cancela
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def stream(self, payload):
+        """
+        Eventos SSE del mejor backend. Sin hedge (el primer evento ya se
+        entregó); si falla antes del primer evento se pasa al siguiente.
+        """
+        self.stats["calls"] += 1
+        order = self.ranked()
+        retries = 0 if len(order) > 1 else None
+        for i, backend in enumerate(order):
+            if i:
+                self.stats["failovers"] += 1
+            start = time.perf_counter()
+            started = False
+            backend.inflight += 1
+            try:
+                async for event in backend.stream(payload, retries=retries):
+                    started = True
+                    yield event
+            except Exception as e:
+                backend.record_error(self.failures_to_cooldown, self.cooldown)
+                if started or i == len(order) - 1:
+                    raise
+                logger.warning("Backend LLM %s falló: %s", backend.name, e)
+                continue
+            finally:
+                backend.inflight -= 1
+            backend.record_success(time.perf_counter() - start)
+            return
+
+    def snapshot(self):
+        return dict(
+            self.stats,
+            hedge=bool(self.hedge),
+            backends={backend.name: backend.snapshot() for backend in self.backends},
+        )
+
+
+_router = None
+
+
+def get_router():
+    global _router
+    if _router is None:
+        _router = LLMRouter()
+    return _router
@@ -0,0 +1,288 @@
+import asyncio
+import contextvars
+import ipaddress
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .redis_conn import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Token bucket de varias llaves a la vez (global, sala, cliente): se
+# concede solo si todas tienen fichas y entonces se descuenta de todas.
+# Si no alcanza devuelve los ms a esperar para la llave más escasa.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local capacity = tonumber(ARGV[2 + 2 * i])
+    local bucket = redis.call("hmget", key, "tokens", "ts")
+    local available = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    available = math.min(capacity, available + math.max(0, now - ts) * rate)
+    tokens[i] = available
+    if available < cost then
+        wait = math.max(wait, (cost - available) / rate)
+    end
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + 2 * i])
+    local capacity = tonumber(ARGV[2 + 2 * i])
+    redis.call("hset", key, "tokens", tokens[i] - cost, "ts", now)
+    redis.call("pexpire", key, math.ceil(capacity / rate) * 2)
+end
+return 0
+"""
+
+# Sala y cliente de la petición en curso; lo fijan vistas y consumers
+_scope = contextvars.ContextVar("uml_rate_scope", default=None)
+
+
+class RateLimited(Exception):
+    """La petición superó el límite; `retry_after` en segundos."""
+
+    def __init__(self, retry_after, reason="rate_limited"):
+        super().__init__(f"{reason}: reintentar en {retry_after:.1f}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+@contextmanager
+def rate_scope(room=None, client=None):
+    token = _scope.set({"room": room, "client": client})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def _trusted_proxies():
+    networks = []
+    for value in getattr(settings, "TRUSTED_PROXIES", []):
+        try:
+            networks.append(ipaddress.ip_network(value, strict=False))
+        except ValueError:
+            logger.warning("TRUSTED_PROXIES: dirección inválida %r", value)
+    return networks
+
+
+def _is_trusted(address, proxies):
+    try:
+        ip = ipaddress.ip_address(address)
+    except (TypeError, ValueError):
+        return False
+    return any(ip in network for network in proxies)
+
+
+def client_address(peer, forwarded):
+    """
+    IP del cliente para su bucket. X-Forwarded-For lo puede inventar el
+    cliente: solo cuenta si la conexión viene de un proxy de TRUSTED_PROXIES,
+    y entonces se toma el último salto que no sea uno de esos proxies.
+    """
+    proxies = _trusted_proxies()
+    if not forwarded or not proxies or not _is_trusted(peer, proxies):
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted(hop, proxies):
+            return hop
+    return hops[0] if hops else peer
+
+
+def request_client(request):
+    return client_address(request.META.get("REMOTE_ADDR"), request.META.get("HTTP_X_FORWARDED_FOR"))
+
+
+def scope_client(scope):
+    forwarded = None
+    for name, value in scope.get("headers") or []:
+        if name == b"x-forwarded-for":
+            forwarded = value.decode("latin-1")
+    client = scope.get("client")
+    return client_address(client[0] if client else None, forwarded)
+
+
+class UpstreamMonitor:
+    """
+    EWMA de la latencia de Gemini. Por encima de UML_SHED_LATENCY se
+    entra en modo degradado: solo caché y resultados locales. Cada
+    UML_SHED_PROBE_INTERVAL se deja pasar una llamada para medir de nuevo.
+    """
+
+    def __init__(self):
+        self.threshold = getattr(settings, "UML_SHED_LATENCY", 15.0)
+        self.probe_interval = getattr(settings, "UML_SHED_PROBE_INTERVAL", 5.0)
+        self.failure_penalty = getattr(settings, "UML_SHED_FAILURE_PENALTY", 2.0)
+        self.latency_ewma = None
+        self._last_probe = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"probes": 0, "failures": 0}
+
+    def record(self, seconds, alpha=0.2):
+        with self._lock:
+            if self.latency_ewma is None:
+                self.latency_ewma = seconds
+            else:
+                self.latency_ewma = alpha * seconds + (1 - alpha) * self.latency_ewma
+
+    def record_failure(self, seconds):
+        """
+        Timeout o error de Gemini: cuenta como una muestra de al menos
+        failure_penalty x el umbral, así unas pocas fallas seguidas activan
+        el load-shedding aunque ninguna haya devuelto nada.
+        """
+        self.stats["failures"] += 1
+        threshold = self.threshold or 0
+        if self.latency_ewma is None:
+            # Sin historia una sola falla no alcanza para degradar
+            self.record(threshold)
+            return
+        self.record(max(seconds, threshold * self.failure_penalty))
+
+    def overloaded(self):
+        return bool(self.threshold) and self.latency_ewma is not None and self.latency_ewma > self.threshold
+
+    def should_shed(self):
+        if not self.overloaded():
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_probe >= self.probe_interval:
+                self._last_probe = now
+                self.stats["probes"] += 1
+                return False
+        return True
+
+    def snapshot(self):
+        return dict(
+            self.stats,
+            latency_ewma_ms=round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            threshold_ms=round(self.threshold * 1000, 1) if self.threshold else None,
+            overloaded=self.overloaded(),
+        )
+
+
+class RateLimiter:
+    """
+    Control de admisión de las llamadas a Gemini.
+
+    Buckets por minuto para todo el servicio, por sala y por cliente,
+    compartidos entre workers vía Redis (en memoria si no hay Redis).
+    Sin fichas se espera como máximo UML_RATE_MAX_WAIT segundos; si hace
+    falta más se rechaza con RateLimited y el tiempo de reintento.
+    """
+
+    prefix = "umlrate:"
+
+    def __init__(self):
+        self.enabled = getattr(settings, "UML_RATE_LIMIT", True)
+        self.use_redis = getattr(settings, "UML_RATE_REDIS", True)
+        self.max_wait = getattr(settings, "UML_RATE_MAX_WAIT", 5.0)
+        self.limits = {
+            "global": (getattr(settings, "UML_RATE_GLOBAL", 120), getattr(settings, "UML_RATE_GLOBAL_BURST", 20)),
+            "room": (getattr(settings, "UML_RATE_ROOM", 30), getattr(settings, "UML_RATE_ROOM_BURST", 5)),
+            "client": (getattr(settings, "UML_RATE_CLIENT", 20), getattr(settings, "UML_RATE_CLIENT_BURST", 5)),
+        }
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.stats = {"admitted": 0, "waited": 0, "rejected": 0, "shed": 0, "redis_errors": 0}
+
+    def _keys(self):
+        scope = _scope.get() or {}
+        keys = [("global", "global")]
+        for kind in ("room", "client"):
+            if scope.get(kind):
+                keys.append((kind, f"{kind}:{scope[kind]}"))
+        # (clave, fichas por ms, capacidad); un límite en 0 lo desactiva
+        result = []
+        for kind, key in keys:
+            per_minute, burst = self.limits[kind]
+            if per_minute:
+                result.append((self.prefix + key, per_minute / 60000.0, max(1, burst)))
+        return result
+
+    def _take_local(self, buckets, now_ms, cost=1):
+        with self._lock:
+            wait = 0.0
+            tokens = []
+            for key, rate, capacity in buckets:
+                available, ts = self._buckets.get(key, (capacity, now_ms))
+                available = min(capacity, available + max(0, now_ms - ts) * rate)
+                tokens.append(available)
+                if available < cost:
+                    wait = max(wait, (cost - available) / rate)
+            if wait > 0:
+                return wait
+            for (key, _, _), available in zip(buckets, tokens):
+                self._buckets[key] = (available - cost, now_ms)
+            return 0.0
+
+    async def _take(self, buckets):
+        now_ms = time.time() * 1000
+        redis = get_redis() if self.use_redis else None
+        if redis is not None:
+            args = [now_ms, 1]
+            for _, rate, capacity in buckets:
+                args.extend([rate, capacity])
+            try:
+                return float(await redis.eval(ACQUIRE_SCRIPT, len(buckets), *[b[0] for b in buckets], *args))
+            except Exception as e:
+                self.stats["redis_errors"] += 1
+                logger.warning("Rate limit en Redis no disponible, se usa el local: %s", e)
+        return self._take_local(buckets, now_ms)
+
+    async def admit(self):
+        """Espera una ficha o lanza RateLimited; también aplica el load-shedding."""
+        if get_monitor().should_shed():
+            self.stats["shed"] += 1
+            raise RateLimited(get_monitor().probe_interval, "overloaded")
+        if not self.enabled:
+            return
+
+        buckets = self._keys()
+        deadline = time.monotonic() + self.max_wait
+        waited = False
+        while True:
+            wait = (await self._take(buckets)) / 1000.0
+            if wait <= 0:
+                self.stats["admitted"] += 1
+                if waited:
+                    self.stats["waited"] += 1
+                return
+            if time.monotonic() + wait > deadline:
+                self.stats["rejected"] += 1
+                raise RateLimited(wait)
+            waited = True
+            await asyncio.sleep(wait)
+
+    def snapshot(self):
+        return dict(self.stats, enabled=bool(self.enabled), limits_per_minute={k: v[0] for k, v in self.limits.items()})
+
+
+_limiter = None
+_monitor = None
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
+
+
+def get_monitor():
+    global _monitor
+    if _monitor is None:
+        _monitor = UpstreamMonitor()
+    return _monitor
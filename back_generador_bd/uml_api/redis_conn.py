@@ -0,0 +1,65 @@
+import asyncio
+import weakref
+
+from django.conf import settings
+
+from .sharding import parse_nodes, shard_url
+
+try:
+    import redis
+    import redis.asyncio as aioredis
+except ImportError:  # redis es opcional fuera de docker
+    redis = None
+    aioredis = None
+
+_clients = weakref.WeakKeyDictionary()
+_sync_client = None
+
+
+def redis_url():
+    # Reutilizar el mismo Redis que usa CHANNEL_LAYERS
+    explicit = getattr(settings, "REDIS_URL", None)
+    if explicit:
+        return explicit
+    try:
+        config = settings.CHANNEL_LAYERS["default"]["CONFIG"]
+        # Con sharding el primer nodo hace de Redis "de control"
+        host = config["hosts"][0] if "hosts" in config else next(iter(parse_nodes(config["shards"]).values()))
+    except (AttributeError, KeyError, IndexError, TypeError, StopIteration):
+        return None
+    if isinstance(host, str):
+        return host
+    if isinstance(host, dict):
+        return host.get("address")
+    return f"redis://{host[0]}:{host[1]}/0"
+
+
+def get_redis(room=None):
+    """
+    Cliente redis.asyncio por event loop, o None si no hay Redis. Con
+    `room` y CANVAS_SHARDS es el del nodo dueño de esa sala.
+    """
+    if aioredis is None:
+        return None
+    url = (shard_url(room) if room is not None else None) or redis_url()
+    if not url:
+        return None
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(url)
+    if client is None:
+        client = aioredis.Redis.from_url(url)
+        clients[url] = client
+    return client
+
+
+def get_sync_redis():
+    """Cliente redis síncrono (vistas DRF y hilos), o None si no hay Redis."""
+    global _sync_client
+    if redis is None:
+        return None
+    if _sync_client is None:
+        url = redis_url()
+        if not url:
+            return None
+        _sync_client = redis.Redis.from_url(url)
+    return _sync_client
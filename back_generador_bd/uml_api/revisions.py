@@ -0,0 +1,140 @@
+import json
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .jsonpatch import apply_patch, make_patch
+from .models import BackupUMLRevision
+
+
+def _encode(value):
+    raw = json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return zlib.compress(raw, 6), len(raw)
+
+
+def _decode(payload):
+    return json.loads(zlib.decompress(bytes(payload)).decode("utf-8"))
+
+
+class RevisionStore:
+    """
+    Historial de BackupUML: snapshot completo cada SNAPSHOT_EVERY
+    revisiones y patches JSON entre medio, así cada escritura ocupa lo
+    que ocupa el cambio. Se recuerda el último documento de cada sala
+    para no reconstruirlo en cada guardado.
+    """
+
+    def __init__(self):
+        self.snapshot_every = getattr(settings, "BACKUP_SNAPSHOT_EVERY", 50)
+        self.max_cached_rooms = getattr(settings, "BACKUP_REVISION_CACHE_ROOMS", 256)
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, room_id, revision, doc):
+        with self._lock:
+            self._last[room_id] = (revision, doc)
+            self._last.move_to_end(room_id)
+            while len(self._last) > self.max_cached_rooms:
+                self._last.popitem(last=False)
+
+    def _latest(self, room_id):
+        with self._lock:
+            cached = self._last.get(room_id)
+        if cached is not None:
+            return cached
+        last = BackupUMLRevision.objects.filter(room_id=room_id).order_by("-revision").first()
+        if last is None:
+            return 0, None
+        return last.revision, self.reconstruct(room_id, last.revision)
+
+    def record(self, room_id, doc):
+        """Guarda una revisión nueva; devuelve su número o None si no cambió nada."""
+        for _ in range(2):
+            revision, previous = self._latest(room_id)
+            if previous == doc:
+                return None
+
+            next_revision = revision + 1
+            patch = make_patch(previous, doc) if previous is not None else None
+            snapshot_payload, snapshot_size = _encode(doc)
+            use_snapshot = patch is None or next_revision % self.snapshot_every == 1
+
+            if not use_snapshot:
+                payload, size = _encode(patch)
+                # Si el patch no ahorra nada, conviene un snapshot
+                use_snapshot = len(payload) >= len(snapshot_payload)
+            if use_snapshot:
+                payload, size = snapshot_payload, snapshot_size
+
+            try:
+                with transaction.atomic():
+                    BackupUMLRevision.objects.create(
+                        room_id=room_id,
+                        revision=next_revision,
+                        kind=BackupUMLRevision.SNAPSHOT if use_snapshot else BackupUMLRevision.PATCH,
+                        payload=payload,
+                        size=size,
+                    )
+            except IntegrityError:
+                # Otro proceso escribió esa revisión: recargar y reintentar
+                with self._lock:
+                    self._last.pop(room_id, None)
+                continue
+
+            self._remember(room_id, next_revision, doc)
+            return next_revision
+        return None
+
+    def resolve(self, room_id, revision=None, at=None):
+        """Número de revisión pedido, o la última anterior a `at`."""
+        qs = BackupUMLRevision.objects.filter(room_id=room_id)
+        if revision is not None:
+            qs = qs.filter(revision__lte=revision)
+        if at is not None:
+            qs = qs.filter(created_at__lte=at)
+        return qs.order_by("-revision").values_list("revision", flat=True).first()
+
+    def reconstruct(self, room_id, revision):
+        """Reconstruye la sala en `revision` desde el snapshot más cercano."""
+        base = (
+            BackupUMLRevision.objects
+            .filter(room_id=room_id, revision__lte=revision, kind=BackupUMLRevision.SNAPSHOT)
+            .order_by("-revision")
+            .first()
+        )
+        if base is None:
+            return None
+
+        doc = _decode(base.payload)
+        patches = (
+            BackupUMLRevision.objects
+            .filter(room_id=room_id, revision__gt=base.revision, revision__lte=revision)
+            .order_by("revision")
+        )
+        for rev in patches:
+            if rev.kind == BackupUMLRevision.SNAPSHOT:
+                doc = _decode(rev.payload)
+            else:
+                doc = apply_patch(doc, _decode(rev.payload))
+        return doc
+
+    def history(self, room_id):
+        return list(
+            BackupUMLRevision.objects
+            .filter(room_id=room_id)
+            .order_by("revision")
+            .values("revision", "kind", "size", "created_at")
+        )
+
+
+_store = None
+
+
+def get_revision_store():
+    global _store
+    if _store is None:
+        _store = RevisionStore()
+    return _store
@@ -1,30 +1,47 @@
-import requests
-from django.conf import settings
+import asyncio
+import json
+import re
+import time
 
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+from asgiref.sync import async_to_sync
+from django.conf import settings
 
-def call_gemini(prompt: str):
-    GEMINI_API_KEY = getattr(settings, "GEMINI_API_KEY", None)
+from . import commands, metrics, prompt_codec, validator
+from .cache import get_cache, make_key, normalize_prompt
+from .incremental import get_validation_store
+from .providers import get_router
+from .ratelimit import RateLimited, get_limiter, get_monitor
+from .singleflight import get_singleflight
+from .streaming import IncrementalJSONParser
+from .tracing import span
+
+# Palabras clave para detectar el modo de la solicitud
+DELETE_KEYWORDS = ["eliminar", "elimina", "borra", "borrar", 
+                   "quitar", "quita", "remover", "remueve",
+                   "sacar", "saca", "delete", "remove"]
+
+EDIT_KEYWORDS = ["cambies","cambiar", "cambia",
+                 "edites","edita","editar", 
+                 "modifiques", "modifica","modificar", 
+                 "actualices", "actualizar","actualiza",
+                 "agregar", "agrega","añadir","añade",
+                 "renombra", "renombrar"
+                ]
 
-    headers = {"Content-Type": "application/json"}
-    params = {"key": GEMINI_API_KEY}
 
+def detect_mode(prompt: str):
+    text = prompt.lower()
     # Detectar si es una solicitud de eliminación
-    delete_keywords = ["eliminar", "elimina", "borra", "borrar", 
-                      "quitar", "quita", "remover", "remueve",
-                      "sacar", "saca", "delete", "remove"]
-    is_delete_request = any(keyword in prompt.lower() for keyword in delete_keywords)
-
+    if any(keyword in text for keyword in DELETE_KEYWORDS):
+        return "delete"
     # Detectar si es una solicitud de edición
-    edit_keywords = ["cambies","cambiar", "cambia",
-                     "edites","edita","editar", 
-                     "modifiques", "modifica","modificar", 
-                     "actualices", "actualizar","actualiza",
-                     "agregar", "agrega","añadir","añade"
-                    ]
-    is_edit_request = any(keyword in prompt.lower() for keyword in edit_keywords)
-
-    if is_delete_request:
+    if any(keyword in text for keyword in EDIT_KEYWORDS):
+        return "edit"
+    return "create"
+
+
+def build_generation_prompt(prompt: str, mode: str, server_merge: bool = False):
+    if mode == "delete":
         # Prompt para eliminación - devolver un solo JSON con marcadores de eliminación
         prompt_text = f"""
 Analiza el siguiente prompt de eliminación y devuelve UN SOLO JSON con los elementos marcados para eliminar.
@@ -80,7 +97,65 @@ Ejemplos:
 Prompt del usuario:
 {prompt}
 """
-    elif is_edit_request:
+    elif mode == "edit" and server_merge:
+        # Prompt para edición - solo los cambios; el merge lo hace el servidor
+        prompt_text = f"""
+Analiza el siguiente prompt de edición y devuelve UN SOLO JSON con los elementos modificados.
+
+IMPORTANTE: El usuario quiere editar/modificar una tabla o relación existente.
+NO repitas el modelo completo: devuelve SOLO los elementos que cambian, con sus NUEVOS valores.
+
+Ejemplo de cambio de atributo:
+- Si el prompt dice "cambia fecha:Date a fecha_Hora:String" en la clase Venta
+- Debe aparecer: {{"name": "Venta", "attributes": [{{"nombreOriginal": "fecha", "name": "fecha_Hora", "type": "String", "editado": true}}], "editado": true}}
+
+Formato de respuesta:
+```json
+{{
+  "editado": {{
+    "classes": [
+      {{
+        "id": "id_de_la_clase_si_se_conoce",
+        "nombreOriginal": "NombreActualDeLaClase",
+        "name": "NombreClaseModificado",
+        "attributes": [
+          {{"nombreOriginal": "nombre_actual", "name": "nuevo_nombre_atributo", "type": "nuevo_tipo", "editado": true}}
+        ],
+        "methods": [
+          {{"nombreOriginal": "nombre_actual", "name": "nuevo_nombre_metodo", "parameters": "nuevos_params", "returnType": "nuevo_tipo", "editado": true}}
+        ],
+        "editado": true
+      }}
+    ],
+    "relationships": [
+      {{
+        "tipoOriginal": "tipo_actual_si_cambia",
+        "type": "nuevo_tipo_relacion",
+        "sourceId": "NombreClaseOrigen",
+        "targetId": "NombreClaseDestino",
+        "labels": ["nueva_etiqueta1", "nueva_etiqueta2"],
+        "editado": true
+      }}
+    ]
+  }}
+}}
+```
+
+REGLAS CRÍTICAS:
+- Aplica EXACTAMENTE los cambios solicitados en el prompt
+- Si el prompt dice "cambia X a Y", debe aparecer Y en "name" y X en "nombreOriginal"
+- Incluye "nombreOriginal" solo en clases, atributos o métodos que se RENOMBRAN
+- Para cambiar solo el tipo de un atributo usa su nombre actual en "name", sin "nombreOriginal"
+- Un atributo o método nuevo va sin "nombreOriginal"; uno que se quita va con "eliminar": true
+- En las relaciones, sourceId y targetId son los NOMBRES de las clases
+- Si cambia el tipo de una relación existente, el tipo actual va en "tipoOriginal"; una relación nueva va sin "tipoOriginal"
+- Marca con "editado": true SOLO los elementos que sufrieron modificaciones
+- NO devuelvas nada más, solo el JSON
+
+Prompt del usuario:
+{prompt}
+"""
+    elif mode == "edit":
         # Prompt para edición - devolver dos JSONs
         prompt_text = f"""
 Analiza el siguiente prompt de edición y devuelve DOS JSONs separados:
@@ -195,41 +270,11 @@ NO devuelvas nada más, solo el JSON.
 Prompt del usuario:
 {prompt}
 """
+    return prompt_text
 
-    data = {
-        "contents": [
-            {
-                "parts": [
-                    {
-                        "text": prompt_text
-                    }
-                ]
-            }
-        ]
-    }
-
-    response = requests.post(GEMINI_API_URL, headers=headers, params=params, json=data)
-    response.raise_for_status()
-    result = response.json()
 
-    try:
-        text_output = result['candidates'][0]['content']['parts'][0]['text']
-        return text_output
-    except (KeyError, IndexError):
-        return '{"error": "No se pudo parsear la respuesta de Gemini"}'
-
-def call_gemini_analysis(prompt: str):
-    GEMINI_API_KEY = getattr(settings, "GEMINI_API_KEY", None)
-
-    headers = {"Content-Type": "application/json"}
-    params = {"key": GEMINI_API_KEY}
-
-    data = {
-        "contents": [
-            {
-                "parts": [
-                    {
-                        "text": f"""
+def build_analysis_prompt(prompt: str):
+    return f"""
 Analiza este modelo UML y responde SOLO en formato JSON.
 
 Estructura de salida obligatoria:
@@ -253,19 +298,349 @@ No escribas explicaciones fuera del JSON.
 Prompt:
 {prompt}
 """
+
+
+def build_uml_analysis_prompt(compact_uml: str):
+    return f"""
+Eres un experto en diseño de bases de datos.
+Analiza si las relaciones de este UML son correctas en base a los nombres y atributos.
+Las clases tienen alias C1, C2... (nombre: atributos | métodos) y las relaciones
+alias R1, R2... (tipo origen->destino multiplicidades).
+En cada elemento de "validas" y "errores" incluye también el campo "id" con el alias
+de la relación (R1, R2...) y usa los nombres de las clases en "relacion".
+
+UML:
+{compact_uml}
+"""
+
+
+def _gemini_payload(prompt_text: str):
+    return {
+        "contents": [
+            {
+                "parts": [
+                    {
+                        "text": prompt_text
                     }
                 ]
             }
         ]
     }
 
-    response = requests.post(GEMINI_API_URL, headers=headers, params=params, json=data)
-    response.raise_for_status()
-    result = response.json()
 
+def _extract_text(result):
     try:
-        text_output = result["candidates"][0]["content"]["parts"][0]["text"]
-        return text_output
+        return result["candidates"][0]["content"]["parts"][0]["text"]
     except (KeyError, IndexError):
         return '{"error": "No se pudo parsear la respuesta de Gemini"}'
 
+
+def strip_markdown(output):
+    # 🧹 limpiar markdown (```json ... ```)
+    if isinstance(output, str):
+        output = re.sub(r"^```json\s*|\s*```$", "", output.strip(), flags=re.MULTILINE)
+    return output
+
+
+async def _generate(prompt_text: str, mode: str = None):
+    # Control de admisión: solo las llamadas que llegan a Gemini gastan fichas
+    await get_limiter().admit()
+    label = mode or "create"
+    start = time.perf_counter()
+    with span("gemini.generate", mode=label):
+        try:
+            # El router elige backend (y manda un hedge si tarda de más)
+            backend, result = await get_router().generate(_gemini_payload(prompt_text))
+        except Exception as e:
+            metrics.llm_errors.inc(label, type(e).__name__)
+            get_monitor().record_failure(time.perf_counter() - start)
+            raise
+    elapsed = time.perf_counter() - start
+    get_monitor().record(elapsed)
+    metrics.llm_seconds.observe(label, "false", value=elapsed)
+    metrics.llm_backend_seconds.observe(backend.name, value=elapsed)
+    metrics.record_usage(label, result)
+    if mode in ("edit", "delete"):
+        # Referencia para estimar la latencia que ahorra el motor local
+        commands.stats.record_llm_latency(elapsed)
+    return _extract_text(result)
+
+
+def _is_cacheable(output):
+    # Solo se cachean respuestas JSON válidas que no sean errores
+    try:
+        parsed = json.loads(strip_markdown(output))
+    except (TypeError, ValueError):
+        return False
+    return not (isinstance(parsed, dict) and "error" in parsed)
+
+
+async def _cached_generate(key: str, prompt_text: str, mode: str = None):
+    cache = get_cache()
+    cached = await cache.get(key)
+    if cached is not None:
+        return cached
+    return await _generate_and_cache(key, prompt_text, mode)
+
+
+async def _generate_and_cache(key: str, prompt_text: str, mode: str = None):
+    async def generate():
+        output = await _generate(prompt_text, mode)
+        if _is_cacheable(output):
+            await get_cache().set(key, output)
+        return output
+
+    # Peticiones idénticas concurrentes comparten una sola llamada a Gemini
+    return await get_singleflight().do(key, generate)
+
+
+def try_local_command(prompt: str, mode: str, uml=None):
+    # Órdenes simples de edición/eliminación se resuelven sin Gemini
+    if mode not in ("edit", "delete"):
+        return None
+    local = commands.try_local(prompt, uml)
+    if local is None:
+        return None
+    return json.dumps(local, ensure_ascii=False)
+
+
+def _generation_key(prompt: str, mode: str, server_merge: bool = False):
+    # Las dos variantes del prompt de edición no comparten entrada de caché
+    prefix = "edit_delta" if mode == "edit" and server_merge else mode
+    return make_key(prefix, normalize_prompt(prompt))
+
+
+async def acall_gemini(prompt: str, uml=None, server_merge: bool = False):
+    """
+    `server_merge`: la respuesta se va a mergear en la sala, así que en una
+    edición basta con los cambios; sin merge se pide el par original/editado
+    que aplica el frontend.
+    """
+    mode = detect_mode(prompt)
+    local = try_local_command(prompt, mode, uml)
+    if local is not None:
+        return local
+    key = _generation_key(prompt, mode, server_merge)
+    return await _cached_generate(key, build_generation_prompt(prompt, mode, server_merge), mode)
+
+
+async def abatch_gemini(items, concurrency=None):
+    """
+    Varios prompts de una vez. Modo, motor local y caché se resuelven en
+    bloque (un solo MGET); lo que queda va a Gemini en paralelo con a lo
+    sumo `concurrency` llamadas. Devuelve (índice, modo, origen, salida)
+    a medida que termina cada uno; si falla, la salida es la excepción.
+    """
+    concurrency = concurrency or getattr(settings, "UML_BATCH_CONCURRENCY", 4)
+    planned = []
+    for index, (prompt, uml) in enumerate(items):
+        mode = detect_mode(prompt)
+        local = try_local_command(prompt, mode, uml)
+        if local is not None:
+            yield index, mode, "local", local
+        else:
+            planned.append((index, mode, _generation_key(prompt, mode), prompt))
+
+    cached = await get_cache().get_many([key for _, _, key, _ in planned])
+    # Prompts repetidos dentro del lote comparten una sola llamada
+    pending = {}
+    for index, mode, key, prompt in planned:
+        if key in cached:
+            yield index, mode, "cache", cached[key]
+        else:
+            pending.setdefault(key, (mode, prompt, []))[2].append(index)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(key, mode, prompt, indexes):
+        async with semaphore:
+            try:
+                output = await _generate_and_cache(key, build_generation_prompt(prompt, mode), mode)
+            except Exception as e:
+                output = e
+        return mode, indexes, output
+
+    tasks = [asyncio.ensure_future(run(key, *item)) for key, item in pending.items()]
+    try:
+        for future in asyncio.as_completed(tasks):
+            mode, indexes, output = await future
+            for index in indexes:
+                yield index, mode, "llm", output
+    finally:
+        # Si el cliente se desconecta no siguen las llamadas que faltan
+        for task in tasks:
+            task.cancel()
+
+
+async def acall_gemini_analysis(prompt: str):
+    key = make_key("analysis", normalize_prompt(prompt))
+    return await _cached_generate(key, build_analysis_prompt(prompt), "analysis")
+
+
+def local_uml_analysis(uml_json):
+    """Pasada estructural local; None si está desactivada."""
+    if not getattr(settings, "UML_LOCAL_VALIDATION", True):
+        return None
+    return validator.validate(uml_json)
+
+
+def validation_needs_llm(report):
+    # Gemini solo ve las relaciones que pasaron la validación estructural
+    return bool(report.pending) and getattr(settings, "UML_VALIDATION_LLM", True)
+
+
+def _encode_for_analysis(uml_json):
+    # Diagramas grandes: un prompt por grupo de componentes conexas
+    max_relationships = getattr(settings, "UML_PROMPT_CHUNK_RELATIONSHIPS", 40)
+    return [prompt_codec.encode(part) for part in prompt_codec.split(uml_json, max_relationships)]
+
+
+def _analysis_prompt(encoded):
+    # La clave usa el texto compacto: ni el layout ni los UUIDs invalidan el resultado
+    key = make_key("analysis", encoded.text)
+    return key, build_analysis_prompt(build_uml_analysis_prompt(encoded.text))
+
+
+async def _analyze_chunk(encoded):
+    raw_output = await _cached_generate(*_analysis_prompt(encoded), "analysis")
+    try:
+        analysis = json.loads(strip_markdown(raw_output))
+    except (TypeError, ValueError):
+        return {"error": "Formato inválido", "raw": raw_output}
+    return encoded.decode(analysis)
+
+
+async def _analyze_remote(uml_json):
+    """Análisis de Gemini con ids reales; los trozos van en paralelo."""
+    parts = _encode_for_analysis(uml_json)
+    results = await asyncio.gather(*(_analyze_chunk(encoded) for encoded in parts))
+    return prompt_codec.merge(results)
+
+
+async def analyze_uml(uml_json, room_id=None):
+    report = local_uml_analysis(uml_json)
+    if report is None:
+        return json.dumps(await _analyze_remote(uml_json), ensure_ascii=False)
+    if not validation_needs_llm(report):
+        return json.dumps(report.as_analysis(report.structural_validas()), ensure_ascii=False)
+
+    # Solo se revalidan las relaciones que cambiaron desde la última vez
+    store = get_validation_store()
+    plan = store.plan(room_id, report)
+    analysis = {"validas": [], "errores": []}
+    if plan.dirty:
+        try:
+            analysis = await _analyze_remote(plan.remainder())
+        except RateLimited:
+            # Sin cupo o Gemini saturado: se responde solo con la pasada local
+            return json.dumps(report.as_analysis(report.structural_validas()), ensure_ascii=False)
+
+    merged, room = plan.merge(analysis)
+    store.remember(room_id, room)
+    return json.dumps(merged, ensure_ascii=False)
+
+
+async def _stream(prompt_text: str, mode: str = None):
+    await get_limiter().admit()
+    label = mode or "create"
+    start = time.perf_counter()
+    events = get_router().stream(_gemini_payload(prompt_text))
+    event = None
+    try:
+        async for event in events:
+            try:
+                text = event["candidates"][0]["content"]["parts"][0]["text"]
+            except (KeyError, IndexError):
+                continue
+            if text:
+                yield text
+    except Exception as e:
+        metrics.llm_errors.inc(label, type(e).__name__)
+        get_monitor().record_failure(time.perf_counter() - start)
+        raise
+    elapsed = time.perf_counter() - start
+    get_monitor().record(elapsed)
+    metrics.llm_seconds.observe(label, "true", value=elapsed)
+    # El usageMetadata completo viene en el último evento
+    metrics.record_usage(label, event)
+
+
+async def _cached_stream(key: str, prompt_text: str, mode: str = None):
+    # Un hit de caché se entrega como un único fragmento
+    cache = get_cache()
+    cached = await cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = []
+    async for text in _stream(prompt_text, mode):
+        chunks.append(text)
+        yield text
+
+    output = "".join(chunks)
+    if _is_cacheable(output):
+        await cache.set(key, output)
+
+
+async def _single_chunk(text: str):
+    yield text
+
+
+def astream_gemini(prompt: str, uml=None):
+    mode = detect_mode(prompt)
+    local = try_local_command(prompt, mode, uml)
+    if local is not None:
+        return _single_chunk(local)
+    key = _generation_key(prompt, mode)
+    return _cached_stream(key, build_generation_prompt(prompt, mode), mode)
+
+
+async def astream_uml_analysis(uml_json):
+    """
+    Emite (sección, item) a medida que Gemini cierra cada elemento y al
+    final (None, análisis completo). Los trozos se consultan en paralelo
+    y sus elementos se intercalan según van llegando.
+    """
+    parts = _encode_for_analysis(uml_json)
+    queue = asyncio.Queue()
+
+    async def run(encoded):
+        parser = IncrementalJSONParser()
+        try:
+            async for chunk in _cached_stream(*_analysis_prompt(encoded), "analysis"):
+                for section, item in parser.feed(chunk):
+                    await queue.put((section, encoded.decode_item(item)))
+            try:
+                analysis = encoded.decode(parser.result())
+            except ValueError:
+                analysis = {"error": "Formato inválido", "raw": parser.buffer}
+        except Exception as e:
+            await queue.put((None, e))
+            return
+        await queue.put((None, analysis))
+
+    tasks = [asyncio.create_task(run(encoded)) for encoded in parts]
+    results = []
+    try:
+        while len(results) < len(tasks):
+            section, value = await queue.get()
+            if section is not None:
+                yield section, value
+            elif isinstance(value, Exception):
+                raise value
+            else:
+                results.append(value)
+    finally:
+        for task in tasks:
+            task.cancel()
+    yield None, prompt_codec.merge(results)
+
+
+# Versiones síncronas para código que no corre en el event loop
+def call_gemini(prompt: str, uml=None):
+    return async_to_sync(acall_gemini)(prompt, uml)
+
+
+def call_gemini_analysis(prompt: str):
+    return async_to_sync(acall_gemini_analysis)(prompt)
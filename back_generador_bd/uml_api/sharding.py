@@ -0,0 +1,109 @@
+import bisect
+import hashlib
+
+from django.conf import settings
+
+# Sharding de salas entre nodos. Un nodo es un Redis (tráfico de grupo del
+# channel layer y log de catch-up de sus salas) más el grupo de workers de
+# Daphne al que el proxy manda las conexiones de esas salas. La sala se
+# ubica con hashing consistente (nodos virtuales), así al agregar un nodo
+# solo cambian de dueño ~1/N de las salas.
+
+GROUP_PREFIX = "canvas_"
+
+
+def room_key(name):
+    """Clave de hashing: el id de la sala, venga el grupo o la sala."""
+    return name[len(GROUP_PREFIX):] if name.startswith(GROUP_PREFIX) else name
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+def parse_nodes(value):
+    """"a=redis://r1:6379/0,b=..." (o lista/dict) -> {nombre: url} en orden."""
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, str):
+        value = [item for item in value.split(",") if item.strip()]
+    nodes = {}
+    for item in value or []:
+        name, _, url = item.partition("=")
+        nodes[name.strip()] = url.strip()
+    return nodes
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=160):
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect.bisect(self._hashes, _hash(room_key(key)))
+        return self._owners[index % len(self._owners)]
+
+    def points(self):
+        """Puntos del anillo, para que un proxy pueda replicar la ubicación."""
+        return [[point, node] for point, node in zip(self._hashes, self._owners)]
+
+    def moved(self, other, keys):
+        """Claves que cambian de nodo al pasar de este anillo a `other`."""
+        return {key: (self.node_for(key), other.node_for(key)) for key in keys
+                if self.node_for(key) != other.node_for(key)}
+
+
+_ring = None
+_shards = None
+
+
+def shards():
+    global _shards
+    if _shards is None:
+        _shards = parse_nodes(getattr(settings, "CANVAS_SHARDS", None))
+    return _shards
+
+
+def sharding_enabled():
+    return len(shards()) > 1
+
+
+def get_ring():
+    global _ring
+    if _ring is None:
+        _ring = HashRing(shards() or ["default"], getattr(settings, "CANVAS_SHARD_VNODES", 160))
+    return _ring
+
+
+def owns_room(room):
+    """False si este worker (CANVAS_SHARD_NODE) no es del nodo de la sala."""
+    node = getattr(settings, "CANVAS_SHARD_NODE", "")
+    return not node or not sharding_enabled() or get_ring().node_for(room) == node
+
+
+def shard_url(key):
+    """URL del Redis dueño de la sala, o None sin sharding."""
+    nodes = shards()
+    if len(nodes) < 2:
+        return None
+    return nodes[get_ring().node_for(key)]
+
+
+def routing_table(room=None):
+    """Tabla para el proxy: nodo y upstream de una sala, o el anillo completo."""
+    upstreams = parse_nodes(getattr(settings, "CANVAS_SHARD_UPSTREAMS", None))
+    ring = get_ring()
+    if room is not None:
+        node = ring.node_for(room)
+        return {"room": room_key(room), "node": node, "upstream": upstreams.get(node)}
+    return {
+        "hash": "md5[:8] big-endian, nodo virtual '<nodo>#<i>'",
+        "vnodes": ring.vnodes,
+        "nodes": [{"name": node, "upstream": upstreams.get(node)} for node in ring.nodes],
+        "points": ring.points(),
+    }
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+import uuid
+import weakref
+
+from django.conf import settings
+
+from .redis_conn import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Borra el lock solo si sigue siendo nuestro
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Deduplica llamadas concurrentes con la misma clave.
+
+    Dentro del proceso los seguidores esperan el mismo Future; entre
+    workers de Daphne el líder toma un lock en Redis, publica el resultado
+    y los demás lo reciben por pub/sub. La función debe devolver un str.
+    """
+
+    def __init__(self):
+        self.use_redis = getattr(settings, "UML_SINGLEFLIGHT_REDIS", True)
+        self.lock_ttl = getattr(settings, "UML_SINGLEFLIGHT_LOCK_TTL", 90)
+        self.wait_timeout = getattr(settings, "UML_SINGLEFLIGHT_WAIT_TIMEOUT", 90)
+        self.result_ttl = getattr(settings, "UML_SINGLEFLIGHT_RESULT_TTL", 30)
+        self.prefix = "singleflight:"
+
+        self._inflight = weakref.WeakKeyDictionary()
+        self.stats = {
+            "leaders": 0,
+            "shared_local": 0,
+            "shared_remote": 0,
+            "fallbacks": 0,
+            "takeovers": 0,
+        }
+
+    def _inflight_for_loop(self):
+        loop = asyncio.get_running_loop()
+        inflight = self._inflight.get(loop)
+        if inflight is None:
+            inflight = {}
+            self._inflight[loop] = inflight
+        return inflight
+
+    async def do(self, key, fn):
+        inflight = self._inflight_for_loop()
+        while key in inflight:
+            future = inflight[key]
+            self.stats["shared_local"] += 1
+            try:
+                # shield: si un seguidor se cancela no cancela al líder
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # Cancelaron al líder (p. ej. su cliente se fue), no a este
+                # seguidor: el primero que llega aquí toma su lugar
+                self.stats["takeovers"] += 1
+
+        future = asyncio.get_running_loop().create_future()
+        inflight[key] = future
+        try:
+            result = await self._run(key, fn)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # evitar "exception was never retrieved"
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            inflight.pop(key, None)
+
+    async def _run(self, key, fn):
+        redis = get_redis() if self.use_redis else None
+        if redis is None:
+            self.stats["leaders"] += 1
+            return await fn()
+
+        lock_key = f"{self.prefix}lock:{key}"
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            token = uuid.uuid4().hex
+            try:
+                acquired = await redis.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+            except Exception as e:
+                logger.warning("Single-flight sin Redis: %s", e)
+                self.stats["leaders"] += 1
+                return await fn()
+            if acquired:
+                return await self._lead(redis, key, lock_key, token, fn)
+
+            try:
+                raw = await self._follow(redis, key, deadline)
+            except Exception as e:
+                logger.warning("Single-flight: error esperando al líder: %s", e)
+                break
+            if raw is not None:
+                self.stats["shared_remote"] += 1
+                return raw.decode("utf-8") if isinstance(raw, bytes) else raw
+            if time.monotonic() >= deadline:
+                break
+            # El líder falló o murió sin resultado: se vuelve a competir por
+            # el lock y uno solo de los seguidores pasa a ser el líder
+            self.stats["takeovers"] += 1
+
+        # El líder tardó demasiado o Redis falló: hacer la llamada nosotros
+        self.stats["fallbacks"] += 1
+        return await fn()
+
+    async def _lead(self, redis, key, lock_key, token, fn):
+        self.stats["leaders"] += 1
+        channel = f"{self.prefix}done:{key}"
+        try:
+            result = await fn()
+        except BaseException:
+            # Los seguidores vuelven a pedir el lock en vez de llamar todos
+            await self._safe(redis.publish(channel, "error"))
+            await self._safe(redis.eval(RELEASE_SCRIPT, 1, lock_key, token))
+            raise
+
+        await self._safe(redis.set(f"{self.prefix}result:{key}", result, ex=self.result_ttl))
+        await self._safe(redis.publish(channel, "ok"))
+        await self._safe(redis.eval(RELEASE_SCRIPT, 1, lock_key, token))
+        return result
+
+    async def _follow(self, redis, key, deadline):
+        """Resultado del líder, o None si falló, murió o se acabó el tiempo."""
+        result_key = f"{self.prefix}result:{key}"
+        channel = f"{self.prefix}done:{key}"
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            # El líder pudo terminar antes de suscribirnos
+            raw = await redis.get(result_key)
+            while raw is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, 1.0))
+                if message is not None:
+                    return await redis.get(result_key) if message.get("data") == b"ok" else None
+                # Si el lock expiró sin resultado, el líder murió
+                if not await redis.exists(f"{self.prefix}lock:{key}"):
+                    return await redis.get(result_key)
+            return raw
+        finally:
+            await self._safe(pubsub.unsubscribe(channel))
+            await self._safe(pubsub.aclose())
+
+    async def _safe(self, awaitable):
+        try:
+            return await awaitable
+        except Exception as e:
+            logger.warning("Single-flight: error de Redis: %s", e)
+            return None
+
+
+_singleflight = None
+
+
+def get_singleflight():
+    global _singleflight
+    if _singleflight is None:
+        _singleflight = SingleFlight()
+    return _singleflight
@@ -0,0 +1,104 @@
+import json
+
+# Arreglos cuyos elementos se emiten apenas se cierran
+STREAM_ARRAYS = ("classes", "relationships", "validas", "errores")
+
+
+class IncrementalJSONParser:
+    """
+    Parser incremental para la salida en streaming del LLM.
+
+    Recibe fragmentos de texto con `feed()` y devuelve, en cuanto se
+    cierran, los objetos que son elementos de los arreglos de interés
+    (clases, relaciones, validas, errores) junto con su ruta, p. ej.
+    ("editado.classes", {...}). Ignora el texto fuera del JSON, como los
+    bloques ```json de markdown.
+    """
+
+    def __init__(self, arrays=STREAM_ARRAYS):
+        self.arrays = set(arrays)
+        self.buffer = ""
+        self.pos = 0
+        self.root_start = None
+        self.root_end = None
+        self.done = False
+
+        # Pila de contenedores abiertos: [tipo, ruta, inicio]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._key = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        items = []
+        buffer = self.buffer
+
+        for i in range(self.pos, len(buffer)):
+            if self.done:
+                break
+            ch = buffer[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = buffer[self._string_start:i + 1]
+                continue
+
+            if self.root_start is None:
+                # Todavía no empezó el JSON (texto o ```json previo)
+                if ch == "{":
+                    self.root_start = i
+                    self._stack.append(["{", "", i])
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == ":":
+                if self._stack and self._stack[-1][0] == "{" and self._last_string is not None:
+                    self._key = json.loads(self._last_string)
+            elif ch == ",":
+                self._key = None
+            elif ch in "{[":
+                parent = self._stack[-1]
+                if parent[0] == "{" and self._key is not None:
+                    path = f"{parent[1]}.{self._key}" if parent[1] else self._key
+                else:
+                    path = parent[1]
+                self._stack.append([ch, path, i])
+                self._key = None
+            elif ch in "}]":
+                kind, path, start = self._stack.pop()
+                if not self._stack:
+                    self.done = True
+                    self.root_end = i
+                elif kind == "{" and self._stack[-1][0] == "[":
+                    array_path = self._stack[-1][1]
+                    if array_path.rsplit(".", 1)[-1] in self.arrays:
+                        items.append((array_path, json.loads(buffer[start:i + 1])))
+                self._key = None
+
+        self.pos = len(buffer)
+        return items
+
+    def result(self):
+        """JSON completo una vez terminado el stream."""
+        if not self.done:
+            raise ValueError("El JSON de la respuesta está incompleto")
+        return json.loads(self.buffer[self.root_start:self.root_end + 1])
+
+
+def sse_event(event, data):
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+def ndjson_line(data):
+    return json.dumps(data, ensure_ascii=False) + "\n"
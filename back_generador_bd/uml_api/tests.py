@@ -0,0 +1,691 @@
+import asyncio
+import json
+import uuid
+from unittest import mock
+
+import httpx
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from collab.room_state import RoomState
+
+from . import cache, commands, providers, ratelimit, services, singleflight, validator
+from .cache import ResponseCache, make_key, normalize_prompt
+from .jsonpatch import JsonPatchError, apply_patch, make_patch
+from .llm_client import GeminiClient
+from .merge import UMLMerger
+from .models import BackupUMLRevision
+from .revisions import RevisionStore
+
+LEGACY_EDIT = {
+    "original": {"classes": [{"id": "1", "name": "Venta", "attributes": [{"name": "fecha", "type": "Date"}]}], "relationships": []},
+    "editado": {"classes": [{"id": "1", "name": "Venta", "attributes": [{"name": "fecha_Hora", "type": "String", "editado": True}], "editado": True}], "relationships": []},
+}
+
+
+@override_settings(UML_CACHE_REDIS=False, UML_RATE_LIMIT=False, UML_SHED_LATENCY=0)
+class EditWithoutRoomTests(SimpleTestCase):
+    """Sin room_id no hay merge en el servidor: el frontend recibe original/editado."""
+
+    async def test_edit_without_room_returns_original_and_editado(self):
+        prompts = []
+
+        async def fake_generate(prompt_text, mode=None):
+            prompts.append(prompt_text)
+            return json.dumps(LEGACY_EDIT)
+
+        with mock.patch.object(services, "_generate", fake_generate):
+            response = await self.async_client.post(
+                "/api/chatbot/",
+                {"prompt": "cambia la relación entre Venta y Cliente a composición"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertIn("original", body)
+        self.assertIn("editado", body)
+        self.assertEqual(len(prompts), 1)
+        self.assertIn("JSON ORIGINAL", prompts[0])
+
+    def test_edit_prompt_variants(self):
+        legacy = services.build_generation_prompt("cambia Venta a Pedido", "edit")
+        delta = services.build_generation_prompt("cambia Venta a Pedido", "edit", server_merge=True)
+        self.assertIn('"original"', legacy)
+        self.assertNotIn('"original"', delta)
+        self.assertNotEqual(
+            services._generation_key("cambia Venta a Pedido", "edit"),
+            services._generation_key("cambia Venta a Pedido", "edit", server_merge=True),
+        )
+
+
+@override_settings(GEMINI_BACKOFF_BASE=0, GEMINI_MAX_RETRIES=2, GEMINI_MAX_BACKOFF=10.0)
+class GeminiClientTests(SimpleTestCase):
+    """Reintentos del cliente HTTP sobre un transporte simulado."""
+
+    def client_for(self, handler):
+        client = GeminiClient()
+        client._clients[asyncio.get_running_loop()] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return client
+
+    async def test_retries_overloaded_responses(self):
+        statuses = [503, 429, 200]
+
+        def handler(request):
+            return httpx.Response(statuses.pop(0), json={"ok": True})
+
+        client = self.client_for(handler)
+        self.assertEqual(await client.post_json("https://llm.test/generate", {}), {"ok": True})
+        self.assertEqual(statuses, [])
+
+    async def test_gives_up_after_max_retries(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(503)
+
+        client = self.client_for(handler)
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.post_json("https://llm.test/generate", {})
+        self.assertEqual(len(calls), 3)
+
+    async def test_long_retry_after_is_not_waited(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(429, headers={"Retry-After": "60"})
+
+        client = self.client_for(handler)
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.post_json("https://llm.test/generate", {})
+        self.assertEqual(len(calls), 1)
+
+    def test_backoff_is_capped(self):
+        client = GeminiClient()
+        client.backoff_base = 1.0
+        self.assertLessEqual(client._backoff(10), client.max_backoff)
+        response = httpx.Response(429, headers={"Retry-After": "2"})
+        self.assertEqual(client._backoff(0, response), 2.0)
+
+    async def test_stream_yields_sse_events(self):
+        def handler(request):
+            body = b'data: {"n": 1}\n\n: ping\n\ndata: {"n": 2}\n\n'
+            return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+
+        client = self.client_for(handler)
+        events = [event async for event in client.stream_sse("https://llm.test/stream", {})]
+        self.assertEqual(events, [{"n": 1}, {"n": 2}])
+
+
+@override_settings(UML_CACHE_REDIS=False, UML_SINGLEFLIGHT_REDIS=False)
+class ResponseCacheTests(SimpleTestCase):
+    """Caché de respuestas: clave por contenido, LRU por entradas/bytes y TTL."""
+
+    def setUp(self):
+        patcher = mock.patch.object(cache, "_cache", ResponseCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(singleflight, "_singleflight", singleflight.SingleFlight())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_key_ignores_whitespace(self):
+        self.assertEqual(
+            make_key("create", normalize_prompt("crea  una clase\nVenta ")),
+            make_key("create", normalize_prompt("crea una clase Venta")),
+        )
+        self.assertNotEqual(make_key("create", "x"), make_key("edit", "x"))
+
+    @override_settings(UML_CACHE_MAX_ENTRIES=2)
+    async def test_evicts_least_recently_used(self):
+        store = ResponseCache()
+        await store.set("a", "1")
+        await store.set("b", "2")
+        await store.get("a")
+        await store.set("c", "3")
+        self.assertEqual(await store.get_many(["a", "b", "c"]), {"a": "1", "c": "3"})
+        self.assertEqual(store.stats["evictions"], 1)
+
+    @override_settings(UML_CACHE_MAX_BYTES=10)
+    async def test_respects_byte_budget(self):
+        store = ResponseCache()
+        await store.set("big", "x" * 11)
+        await store.set("a", "12345")
+        await store.set("b", "123456")
+        self.assertIsNone(await store.get("big"))
+        self.assertIsNone(await store.get("a"))
+        self.assertEqual(await store.get("b"), "123456")
+
+    async def test_expired_entries_are_misses(self):
+        store = ResponseCache()
+        await store.set("a", "1")
+        with mock.patch("uml_api.cache.time.monotonic", return_value=10 ** 9):
+            self.assertIsNone(await store.get("a"))
+
+    async def test_identical_prompts_share_one_generation(self):
+        calls = []
+
+        async def fake_generate(prompt_text, mode=None):
+            calls.append(prompt_text)
+            return '{"classes": [], "relationships": []}'
+
+        with mock.patch.object(services, "_generate", fake_generate):
+            first = await services.acall_gemini("crea una clase Venta")
+            second = await services.acall_gemini("  crea una   clase Venta")
+        self.assertEqual(first, second)
+        self.assertEqual(len(calls), 1)
+
+    async def test_error_responses_are_not_cached(self):
+        calls = []
+
+        async def fake_generate(prompt_text, mode=None):
+            calls.append(prompt_text)
+            return '{"error": "cuota"}'
+
+        with mock.patch.object(services, "_generate", fake_generate):
+            await services.acall_gemini("crea una clase Venta")
+            await services.acall_gemini("crea una clase Venta")
+        self.assertEqual(len(calls), 2)
+
+
+@override_settings(UML_SINGLEFLIGHT_REDIS=False)
+class SingleFlightTests(SimpleTestCase):
+    """Llamadas concurrentes con la misma clave dentro del proceso."""
+
+    async def test_concurrent_calls_share_one_execution(self):
+        flight = singleflight.SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        results = await asyncio.gather(*(flight.do("k", fn) for _ in range(5)))
+        self.assertEqual(results, ["ok"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats["shared_local"], 4)
+
+    async def test_followers_get_the_leader_error(self):
+        flight = singleflight.SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.05)
+            raise RuntimeError("upstream")
+
+        results = await asyncio.gather(*(flight.do("k", fn) for _ in range(3)), return_exceptions=True)
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+
+    async def test_follower_takes_over_when_leader_is_cancelled(self):
+        flight = singleflight.SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        leader = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        followers = [asyncio.ensure_future(flight.do("k", fn)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        self.assertEqual(await asyncio.gather(*followers), ["ok", "ok"])
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(flight.stats["takeovers"], 2)
+
+    async def test_cancelled_follower_does_not_cancel_leader(self):
+        flight = singleflight.SingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.05)
+            return "ok"
+
+        leader = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(flight.do("k", fn))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        self.assertEqual(await leader, "ok")
+        self.assertTrue(follower.cancelled())
+
+
+def diagram(*names, relationships=()):
+    return {
+        "classes": [{"id": name.lower(), "name": name, "attributes": [], "methods": []} for name in names],
+        "relationships": list(relationships),
+    }
+
+
+class JsonPatchTests(SimpleTestCase):
+    """make_patch + apply_patch reproducen el documento nuevo."""
+
+    def assertRoundTrip(self, old, new):
+        self.assertEqual(apply_patch(old, make_patch(old, new)), new)
+
+    def test_round_trips(self):
+        cases = [
+            (diagram("Venta"), diagram("Venta", "Cliente")),
+            (diagram("Venta", "Cliente", "Pago"), diagram("Venta", "Pago")),
+            (diagram("Venta"), {"classes": [], "relationships": [], "extra": {"a/b": 1, "c~d": [1, 2]}}),
+            ({"a/b": {"c~d": 1}}, {"a/b": {"c~d": 2}}),
+            ([1, 2, 3], "texto"),
+            ({"x": [1, 2, 3, 4]}, {"x": [4, 3]}),
+        ]
+        for old, new in cases:
+            with self.subTest(old=old, new=new):
+                self.assertRoundTrip(old, new)
+
+    def test_insert_in_the_middle_is_one_op(self):
+        old = diagram("A", "B", "C", "D")
+        new = diagram("A", "B", "X", "C", "D")
+        self.assertEqual(make_patch(old, new), [
+            {"op": "add", "path": "/classes/2", "value": new["classes"][2]},
+        ])
+
+    def test_does_not_modify_the_input(self):
+        old = diagram("Venta")
+        apply_patch(old, [{"op": "add", "path": "/classes/-", "value": {"name": "X"}}])
+        self.assertEqual(old, diagram("Venta"))
+
+    def test_invalid_paths_raise(self):
+        with self.assertRaises(JsonPatchError):
+            apply_patch({"a": 1}, [{"op": "replace", "path": "/b/c", "value": 1}])
+        with self.assertRaises(JsonPatchError):
+            apply_patch({"a": [1]}, [{"op": "replace", "path": "/a/x/y", "value": 1}])
+
+
+@override_settings(BACKUP_SNAPSHOT_EVERY=3)
+class RevisionStoreTests(TestCase):
+    """Historial con snapshots cada N revisiones y patches entre medio."""
+
+    def test_every_revision_can_be_rebuilt(self):
+        room_id = uuid.uuid4()
+        store = RevisionStore()
+        # Una clase grande en común para que los patches salgan más chicos que un snapshot
+        bulky = {"id": "base", "name": "Base", "methods": [],
+                 "attributes": [{"name": "campo%d" % i, "type": "String"} for i in range(30)]}
+        docs = []
+        for n in range(7):
+            doc = diagram(*["C%d" % i for i in range(n + 1)])
+            doc["classes"].insert(0, bulky)
+            docs.append(doc)
+        for doc in docs:
+            store.record(room_id, doc)
+
+        kinds = [r["kind"] for r in store.history(room_id)]
+        self.assertEqual(kinds.count(BackupUMLRevision.SNAPSHOT), 3)
+        self.assertEqual(kinds.count(BackupUMLRevision.PATCH), 4)
+        # Sin el documento en memoria: todo sale de la base
+        fresh = RevisionStore()
+        for revision, doc in enumerate(docs, start=1):
+            self.assertEqual(fresh.reconstruct(room_id, revision), doc)
+
+    def test_unchanged_document_is_not_recorded(self):
+        room_id = uuid.uuid4()
+        store = RevisionStore()
+        self.assertEqual(store.record(room_id, diagram("Venta")), 1)
+        self.assertIsNone(store.record(room_id, diagram("Venta")))
+        self.assertEqual(RevisionStore().record(room_id, diagram("Venta", "Cliente")), 2)
+
+    def test_resolve_picks_the_latest_at_or_before(self):
+        room_id = uuid.uuid4()
+        store = RevisionStore()
+        for n in range(3):
+            store.record(room_id, diagram(*["C%d" % i for i in range(n + 1)]))
+        self.assertEqual(store.resolve(room_id), 3)
+        self.assertEqual(store.resolve(room_id, revision=2), 2)
+        self.assertIsNone(store.resolve(uuid.uuid4()))
+
+
+class CommandEngineTests(SimpleTestCase):
+    """Gramática local de órdenes simples y su ejecución sin Gemini."""
+
+    def doc(self):
+        return {
+            "classes": [
+                {"id": "1", "name": "Venta", "attributes": [{"name": "total", "type": "float"}], "methods": []},
+                {"id": "2", "name": "Cliente", "attributes": [], "methods": [{"name": "pagar", "returnType": "void"}]},
+            ],
+            "relationships": [{"id": "r1", "type": "association", "sourceId": "1", "targetId": "2"}],
+        }
+
+    def test_parses_several_orders(self):
+        parsed = commands.parse_commands(
+            "Por favor elimina el atributo total de la clase Venta; borra la clase Cliente")
+        self.assertEqual(parsed, [
+            {"kind": "delete_attribute", "name": "total", "class": "Venta"},
+            {"kind": "delete_class", "class": "Cliente"},
+        ])
+        self.assertEqual(commands.parse_command("agrega el atributo edad: int a la clase Cliente"),
+                         {"kind": "add_attribute", "name": "edad", "type": "int", "class": "Cliente"})
+        self.assertEqual(commands.parse_command("crea una relación de composición entre Venta y Cliente")["type"],
+                         "composition")
+
+    def test_unknown_text_goes_to_the_llm(self):
+        self.assertIsNone(commands.parse_commands("elimina la clase Venta; diseña un sistema de ventas"))
+        self.assertIsNone(commands.parse_commands("   "))
+
+    def test_delete_class_drops_its_relationships(self):
+        doc = self.doc()
+        updated, response = commands.execute(doc, commands.parse_commands("elimina la clase Cliente"))
+        self.assertEqual(response["classes"], [{"id": "2", "name": "Cliente", "eliminar": True}])
+        self.assertEqual([c["name"] for c in updated["classes"]], ["Venta"])
+        self.assertEqual(updated["relationships"], [])
+        self.assertEqual(len(doc["classes"]), 2)  # el original no se toca
+
+    def test_edit_returns_original_and_edited(self):
+        _, response = commands.execute(
+            self.doc(), commands.parse_commands("cambia el tipo del atributo total de Venta a int"))
+        self.assertEqual(response["original"]["classes"][0]["attributes"], [{"name": "total", "type": "float"}])
+        self.assertEqual(response["editado"]["classes"][0]["attributes"],
+                         [{"name": "total", "type": "int", "editado": True}])
+
+    def test_delete_without_doc_uses_name_markers(self):
+        _, response = commands.execute(None, commands.parse_commands(
+            "quita el método pagar de Cliente; elimina la relación entre Venta y Cliente"))
+        self.assertEqual(response, {
+            "classes": [{"name": "Cliente", "methods": [{"name": "pagar", "eliminar": True}]}],
+            "relationships": [{"sourceId": "Venta", "targetId": "Cliente", "eliminar": True}],
+        })
+        with self.assertRaises(commands.CommandError):
+            commands.execute(None, commands.parse_commands("renombra la clase Venta a Compra"))
+
+    def test_try_local_falls_back_on_bad_input(self):
+        prompt = "elimina el atributo total de Venta"
+        self.assertIsNotNone(commands.try_local(prompt, self.doc()))
+        malformed = [
+            "no soy un dict",
+            {"classes": "Venta"},
+            {"classes": [{"id": "1", "name": "Venta", "attributes": "total"}]},
+            {"classes": [{"id": ["1"], "name": "Venta"}]},
+            {"classes": [], "relationships": [{"id": "r", "sourceId": {"x": 1}, "targetId": "2"}]},
+        ]
+        for doc in malformed:
+            with self.subTest(doc=doc):
+                self.assertIsNone(commands.try_local(prompt, doc))
+        # Clase o miembro inexistente: también decide el LLM
+        self.assertIsNone(commands.try_local("elimina el atributo saldo de Venta", self.doc()))
+        self.assertIsNone(commands.try_local("elimina la clase Pago", self.doc()))
+
+
+class ValidatorTests(SimpleTestCase):
+    """Pasada estructural local antes de pedirle el análisis a Gemini."""
+
+    def uml(self, *relationships, classes=("A", "B", "C")):
+        return {
+            "classes": [{"id": name.lower(), "name": name, "attributes": []} for name in classes],
+            "relationships": list(relationships),
+        }
+
+    def rel(self, rel_id, kind, source, target, labels=()):
+        return {"id": rel_id, "type": kind, "sourceId": source, "targetId": target, "labels": list(labels)}
+
+    def test_multiplicities(self):
+        for label in ("1", "*", "n", "0..1", "1..*", "2..5", "0 .. n"):
+            with self.subTest(label=label):
+                self.assertTrue(validator.valid_multiplicity(label))
+        for label in ("", "5..2", "*..1", "uno", "1..", "1...3"):
+            with self.subTest(label=label):
+                self.assertFalse(validator.valid_multiplicity(label))
+
+    def test_clean_diagram_keeps_everything_pending(self):
+        ok = self.rel("r1", "association", "a", "b", ["1", "0..*"])
+        report = validator.validate(self.uml(ok))
+        self.assertEqual(report.errores, [])
+        self.assertEqual(report.pending, [ok])
+        self.assertEqual([c["id"] for c in report.remainder()["classes"]], ["a", "b"])
+
+    def test_broken_relationships_are_not_sent_to_gemini(self):
+        ok = self.rel("r1", "association", "a", "b")
+        dangling = self.rel("r2", "association", "a", "zz")
+        bad_label = self.rel("r3", "dependency", "b", "c", ["5..2"])
+        unknown = self.rel("r4", "usa", "a", "c")
+        report = validator.validate(self.uml(ok, dangling, bad_label, unknown))
+        self.assertEqual(report.pending, [ok])
+        self.assertEqual(len(report.errores), 3)
+        self.assertEqual(report.errores[0]["relacion"], "Asociación A -> <zz>")
+
+    def test_composition_with_two_owners(self):
+        report = validator.validate(self.uml(
+            self.rel("r1", "composition", "a", "c"),
+            self.rel("r2", "composition", "b", "c"),
+            self.rel("r3", "composition", "a", "b"),
+        ))
+        self.assertEqual([r["id"] for r in report.pending], ["r3"])
+        self.assertIn("varias clases (A, B)", report.errores[0]["problema"])
+
+    def test_inheritance_cycle_marks_only_the_cycle(self):
+        report = validator.validate(self.uml(
+            self.rel("r1", "generalization", "a", "b"),
+            self.rel("r2", "generalization", "b", "c"),
+            self.rel("r3", "generalization", "c", "a"),
+            self.rel("r4", "generalization", "d", "a"),
+            classes=("A", "B", "C", "D"),
+        ))
+        self.assertEqual([r["id"] for r in report.pending], ["r4"])
+        self.assertEqual({e["problema"] for e in report.errores}, {"La herencia forma un ciclo"})
+        self.assertEqual(len(report.errores), 3)
+
+    def test_names(self):
+        uml = self.uml(classes=("Venta", "venta", ""))
+        uml["classes"][0]["attributes"] = [{"name": "total"}, {"name": "Total"}]
+        problems = [e["problema"] for e in validator.validate(uml).errores]
+        self.assertEqual(problems, [
+            "Atributo duplicado: Total",
+            "Nombre de clase duplicado: venta",
+            "La clase no tiene nombre",
+        ])
+
+    def test_tolerates_malformed_input(self):
+        for uml in (None, [], {"classes": "x", "relationships": None}, {"classes": [1, None]}):
+            with self.subTest(uml=uml):
+                self.assertEqual(validator.validate(uml).errores, [])
+
+
+@override_settings(UML_RATE_REDIS=False, UML_RATE_GLOBAL=6000, UML_RATE_GLOBAL_BURST=100,
+                   UML_RATE_CLIENT=60, UML_RATE_CLIENT_BURST=2, UML_RATE_MAX_WAIT=0,
+                   UML_SHED_LATENCY=1.0, UML_SHED_PROBE_INTERVAL=60)
+class RateLimitTests(SimpleTestCase):
+    """Token bucket local, load-shedding y la IP de cada cliente."""
+
+    def setUp(self):
+        monitor = mock.patch.object(ratelimit, "_monitor", ratelimit.UpstreamMonitor())
+        monitor.start()
+        self.addCleanup(monitor.stop)
+
+    async def admit(self, limiter, client):
+        with ratelimit.rate_scope(client=client):
+            await limiter.admit()
+
+    async def test_bucket_per_client(self):
+        limiter = ratelimit.RateLimiter()
+        await self.admit(limiter, "1.1.1.1")
+        await self.admit(limiter, "1.1.1.1")
+        with self.assertRaises(ratelimit.RateLimited) as raised:
+            await self.admit(limiter, "1.1.1.1")
+        self.assertAlmostEqual(raised.exception.retry_after, 1.0, delta=0.05)
+        await self.admit(limiter, "2.2.2.2")  # otro cliente tiene su propio bucket
+        self.assertEqual((limiter.stats["admitted"], limiter.stats["rejected"]), (3, 1))
+
+    @override_settings(UML_RATE_CLIENT=1200, UML_RATE_CLIENT_BURST=1, UML_RATE_MAX_WAIT=1)
+    async def test_short_waits_are_absorbed(self):
+        limiter = ratelimit.RateLimiter()
+        await self.admit(limiter, "1.1.1.1")
+        await self.admit(limiter, "1.1.1.1")  # ~50 ms hasta la siguiente ficha
+        self.assertEqual(limiter.stats["waited"], 1)
+
+    async def test_sheds_while_upstream_is_slow(self):
+        monitor = ratelimit.get_monitor()
+        monitor.record_failure(30)  # sin historia: cuenta solo como el umbral
+        self.assertFalse(monitor.overloaded())
+        monitor.record_failure(30)
+        self.assertTrue(monitor.overloaded())
+
+        limiter = ratelimit.RateLimiter()
+        await self.admit(limiter, "1.1.1.1")  # la primera pasa como sonda
+        with self.assertRaises(ratelimit.RateLimited) as raised:
+            await self.admit(limiter, "1.1.1.1")
+        self.assertEqual(raised.exception.reason, "overloaded")
+        self.assertEqual((monitor.stats["probes"], limiter.stats["shed"]), (1, 1))
+
+    def test_forwarded_for_needs_a_trusted_proxy(self):
+        forwarded = "6.6.6.6, 1.2.3.4, 10.0.0.2"
+        self.assertEqual(ratelimit.client_address("10.0.0.1", forwarded), "10.0.0.1")
+        with override_settings(TRUSTED_PROXIES=["10.0.0.0/8"]):
+            self.assertEqual(ratelimit.client_address("10.0.0.1", forwarded), "1.2.3.4")
+            self.assertEqual(ratelimit.client_address("8.8.8.8", forwarded), "8.8.8.8")
+            self.assertEqual(ratelimit.client_address("10.0.0.1", None), "10.0.0.1")
+            scope = {"client": ["10.0.0.1", 5000], "headers": [(b"x-forwarded-for", b"1.2.3.4")]}
+            self.assertEqual(ratelimit.scope_client(scope), "1.2.3.4")
+
+
+@override_settings(LLM_EXPLORE=0, LLM_FAILURES_TO_COOLDOWN=2, LLM_COOLDOWN=60)
+class ProviderRouterTests(SimpleTestCase):
+    """Ruteo entre backends del LLM: failover, cooldown y hedging."""
+
+    def fake(self, name, **options):
+        return providers.FakeBackend(name, **options)
+
+    def test_parse_backend(self):
+        fake = providers.parse_backend("rapido=fake:?latency=0.3&error_rate=0.5")
+        self.assertEqual((fake.name, fake.latency, fake.error_rate), ("rapido", 0.3, 0.5))
+        gemini = providers.parse_backend("flash = gemini:gemini-2.0-flash")
+        self.assertTrue(gemini.url.endswith("/models/gemini-2.0-flash:generateContent"))
+        self.assertTrue(gemini.stream_url.endswith("/models/gemini-2.0-flash:streamGenerateContent"))
+        with self.assertRaises(ValueError):
+            providers.parse_backend("x=ftp://nada")
+
+    async def test_fails_over_and_cools_down(self):
+        broken = self.fake("roto", latency=0, error_rate=1)
+        good = self.fake("sano", latency=0)
+        router = providers.LLMRouter([broken, good])
+
+        for _ in range(2):
+            with self.assertLogs("uml_api.providers", "WARNING"):
+                backend, result = await router.generate({})
+            self.assertIs(backend, good)
+        self.assertEqual(result["modelVersion"], "sano")
+        self.assertEqual((router.stats["failovers"], broken.stats["errors"]), (2, 2))
+        # Dos fallas seguidas: en cooldown queda al final y ya no se prueba
+        self.assertFalse(broken.healthy())
+        self.assertEqual(router.ranked(), [good, broken])
+        await router.generate({})
+        self.assertEqual(broken.stats["requests"], 2)
+
+    async def test_all_backends_failing_raises_the_last_error(self):
+        router = providers.LLMRouter([self.fake("a", latency=0, error_rate=1), self.fake("b", latency=0, error_rate=1)])
+        with self.assertLogs("uml_api.providers", "WARNING") as logs, \
+                self.assertRaisesMessage(RuntimeError, "Error simulado en b"):
+            await router.generate({})
+        self.assertEqual(len(logs.records), 2)
+
+    @override_settings(LLM_HEDGE=True, LLM_HEDGE_MIN_DELAY=0.01, LLM_HEDGE_MAX_RATIO=1)
+    async def test_slow_request_is_hedged(self):
+        slow = self.fake("lento", latency=5)
+        fast = self.fake("rapido", latency=0)
+        for _ in range(20):
+            slow.record_success(0.01)  # p95 de 10 ms: lo que supere eso se cubre
+        fast.record_success(1.0)
+        router = providers.LLMRouter([slow, fast])
+
+        backend, _ = await router.generate({})
+        self.assertIs(backend, fast)
+        self.assertEqual((router.stats["hedges"], router.stats["hedge_wins"]), (1, 1))
+        self.assertEqual((slow.stats["cancelled"], slow.inflight), (1, 0))
+
+    async def test_hedging_needs_latency_history(self):
+        with override_settings(LLM_HEDGE=True):
+            router = providers.LLMRouter([self.fake("a"), self.fake("b")])
+        self.assertIsNone(router.hedge_delay(router.backends[0]))
+
+    async def test_stream_fails_over_before_the_first_event(self):
+        router = providers.LLMRouter([self.fake("roto", latency=0, error_rate=1), self.fake("sano", latency=0)])
+        with self.assertLogs("uml_api.providers", "WARNING"):
+            parts = [event["candidates"][0]["content"]["parts"][0]["text"] async for event in router.stream({})]
+        self.assertEqual("".join(parts), providers.FAKE_TEXT)
+        self.assertEqual(router.stats["failovers"], 1)
+
+
+class MergerTests(SimpleTestCase):
+    """Respuestas de edición/eliminación aplicadas como ops sobre el estado de la sala."""
+
+    def state(self):
+        return RoomState({
+            "classes": [
+                {"id": "v", "name": "Venta", "attributes": [{"name": "total", "type": "float"}], "methods": []},
+                {"id": "c", "name": "Cliente", "attributes": [], "methods": []},
+            ],
+            "relationships": [{"id": "r", "type": "association", "sourceId": "v", "targetId": "c"}],
+        })
+
+    def merge(self, state, result):
+        applied, unresolved = UMLMerger(state).merge(result)
+        return [delta["t"] for delta, _ in applied], unresolved
+
+    def test_edit_by_original_name(self):
+        state = self.state()
+        kinds, unresolved = self.merge(state, {"editado": {"classes": [{
+            "nombreOriginal": "venta", "name": "Compra",
+            "attributes": [{"nombreOriginal": "total", "name": "monto", "type": "float"},
+                           {"name": "fecha", "type": "Date"}],
+        }]}})
+        self.assertEqual((kinds, unresolved), (["update_class", "update_attribute", "add_attribute"], []))
+        self.assertEqual(state.classes["v"]["name"], "Compra")
+        self.assertEqual([a["name"] for a in state.classes["v"]["attributes"]], ["monto", "fecha"])
+
+    def test_legacy_format_aligns_members_with_original(self):
+        state = self.state()
+        self.merge(state, {
+            "original": {"classes": [{"id": "v", "name": "Venta", "attributes": [{"name": "total", "type": "float"}]}]},
+            "editado": {"classes": [{"id": "v", "name": "Venta", "attributes": [{"name": "importe", "type": "int"}]}]},
+        })
+        self.assertEqual(state.classes["v"]["attributes"], [{"name": "importe", "type": "int"}])
+
+    def test_delete_markers(self):
+        state = self.state()
+        kinds, unresolved = self.merge(state, {
+            "classes": [{"name": "Cliente", "eliminar": True}, {"name": "Pago", "eliminar": True}],
+            "relationships": [],
+        })
+        self.assertEqual(kinds, ["delete_class"])
+        self.assertEqual(unresolved[0]["reason"], "No existe la clase Pago")
+        self.assertEqual((list(state.classes), state.relationships), (["v"], {}))
+
+    def test_new_type_on_a_pair_adds_a_relationship(self):
+        state = self.state()
+        kinds, _ = self.merge(state, {"classes": [], "relationships": [
+            {"sourceId": "Venta", "targetId": "Cliente", "type": "dependency"}]})
+        self.assertEqual(kinds, ["add_relationship"])
+        self.assertEqual(sorted(r["type"] for r in state.relationships.values()), ["association", "dependency"])
+
+    def test_explicit_type_change(self):
+        for result in (
+            {"editado": {"relationships": [
+                {"sourceId": "Venta", "targetId": "Cliente", "type": "composition", "tipoOriginal": "association"}]}},
+            {"original": {"relationships": [{"sourceId": "v", "targetId": "c", "type": "association"}]},
+             "editado": {"relationships": [{"sourceId": "v", "targetId": "c", "type": "composition"}]}},
+        ):
+            with self.subTest(result=result):
+                state = self.state()
+                self.assertEqual(self.merge(state, result)[0], ["update_relationship"])
+                self.assertEqual(state.relationships, {
+                    "r": {"id": "r", "type": "composition", "sourceId": "v", "targetId": "c"}})
+
+    def test_indexes_follow_applied_ops(self):
+        state = self.state()
+        kinds, unresolved = self.merge(state, {"editado": {
+            "classes": [{"id": "c", "nombreOriginal": "Cliente", "name": "Comprador"},
+                        {"name": "Pago", "attributes": [{"name": "monto", "type": "float"}]}],
+            "relationships": [{"sourceId": "Comprador", "targetId": "Pago", "type": "association"},
+                              {"sourceId": "Cliente", "targetId": "Pago"}],
+        }})
+        self.assertEqual(kinds, ["update_class", "add_class", "add_relationship"])
+        self.assertEqual(unresolved[0]["reason"], "No existen las clases Cliente / Pago")
+
+    def test_malformed_result(self):
+        state = self.state()
+        self.assertEqual(self.merge(state, ["x"])[1][0]["reason"], "La respuesta no es un objeto")
+        kinds, _ = self.merge(state, {"classes": ["x", None], "relationships": "x"})
+        self.assertEqual((kinds, state.version), ([], 0))
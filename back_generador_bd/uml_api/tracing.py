@@ -0,0 +1,118 @@
+import contextvars
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import registry
+
+logger = logging.getLogger("uml.trace")
+
+# Spans por petición (opcional, METRICS_TRACING). Sin traza activa span()
+# no hace nada más que leer una ContextVar.
+_trace = contextvars.ContextVar("uml_trace", default=None)
+_parent = contextvars.ContextVar("uml_trace_parent", default=None)
+
+span_seconds = registry.histogram(
+    "uml_trace_span_seconds", "Duración de los spans de tracing por nombre", ("name",))
+
+
+class Trace:
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.spans = []
+        self._ids = 0
+
+    def next_id(self):
+        self._ids += 1
+        return self._ids
+
+    def as_dict(self):
+        return {"trace_id": self.id, "spans": self.spans}
+
+
+def current_trace_id():
+    trace = _trace.get()
+    return trace.id if trace is not None else None
+
+
+@contextmanager
+def span(name, **attrs):
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = trace.next_id()
+    token = _parent.set(span_id)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _parent.reset(token)
+        record = {"id": span_id, "parent": _parent.get(), "name": name, "ms": round(duration * 1000, 3)}
+        if attrs:
+            record["attrs"] = attrs
+        if error:
+            record["error"] = error
+        trace.spans.append(record)
+        span_seconds.observe(name, value=duration)
+
+
+@contextmanager
+def trace_request(request_id=None, name="request", **attrs):
+    trace = Trace(request_id or uuid.uuid4().hex)
+    token = _trace.set(trace)
+    try:
+        with span(name, **attrs):
+            yield trace
+    finally:
+        _trace.reset(token)
+        logger.info(json.dumps(trace.as_dict(), ensure_ascii=False))
+
+
+class TracingMiddleware:
+    """
+    Una traza por petición HTTP si METRICS_TRACING está activo; el id sale
+    de X-Request-ID (o se genera) y vuelve en la cabecera X-Trace-Id.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, "METRICS_TRACING", False)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        with trace_request(*self._trace_args(request)) as trace:
+            response = self.get_response(request)
+        response["X-Trace-Id"] = trace.id
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        with trace_request(*self._trace_args(request)) as trace:
+            response = await self.get_response(request)
+        response["X-Trace-Id"] = trace.id
+        return response
+
+    @staticmethod
+    def _trace_args(request):
+        return request.headers.get("X-Request-ID"), f"http {request.method} {request.path}"
@@ -1,9 +1,18 @@
 from django.urls import path
-from .views import GenerateUMLView, set_backupUML, get_backupUML
+from django.views.decorators.csrf import csrf_exempt
+from .views import GenerateUMLView, BatchGenerateView, JobStatusView, set_backupUML, get_backupUML, get_backupUML_history, cache_stats, backup_stats, presence_stats, shard_routes, metrics_view
 
 
 urlpatterns = [
-    path('chatbot/', GenerateUMLView.as_view(), name='generate-uml'),
+    path('chatbot/', csrf_exempt(GenerateUMLView.as_view()), name='generate-uml'),
+    path('chatbot/batch/', csrf_exempt(BatchGenerateView.as_view()), name='generate-uml-batch'),
+    path("chatbot/jobs/<str:job_id>/", JobStatusView.as_view(), name="chatbot-job"),
     path("set_backup_uml/<uuid:room_id>/", set_backupUML, name="backup_uml-id"),
     path("get_backup_uml/<uuid:room_id>/", get_backupUML, name="backup_uml-id"),
+    path("backup_uml_history/<uuid:room_id>/", get_backupUML_history, name="backup_uml-history"),
+    path("cache_stats/", cache_stats, name="cache-stats"),
+    path("backup_stats/", backup_stats, name="backup-stats"),
+    path("presence/", presence_stats, name="presence-stats"),
+    path("shards/", shard_routes, name="shard-routes"),
+    path("metrics/", metrics_view, name="metrics"),
 ]
@@ -0,0 +1,207 @@
+import re
+from collections import defaultdict
+
+# Validación estructural del UML en Python puro. Detecta los errores que
+# no necesitan criterio (ids colgantes, nombres duplicados, ciclos de
+# herencia, multiplicidades mal formadas, composiciones con varios
+# dueños) y deja para Gemini solo el análisis semántico del resto.
+
+RELATION_TYPES = ("association", "aggregation", "composition", "generalization", "dependency")
+
+TYPE_NAMES = {
+    "association": "Asociación",
+    "aggregation": "Agregación",
+    "composition": "Composición",
+    "generalization": "Generalización",
+    "dependency": "Dependencia",
+}
+
+# 1, *, n, 0..1, 1..*, 2..5, 0..n
+BOUND = r"(\d+|\*|[nNmM])"
+MULTIPLICITY_RE = re.compile(rf"^{BOUND}(?:\s*\.\.\s*{BOUND})?$")
+
+
+def _upper(bound):
+    return None if not bound.isdigit() else int(bound)
+
+
+def valid_multiplicity(label):
+    match = MULTIPLICITY_RE.match(label.strip())
+    if match is None:
+        return False
+    low, high = match.group(1), match.group(2)
+    if high is None:
+        return True
+    # El límite inferior tiene que ser un número y no superar al superior
+    if not low.isdigit():
+        return False
+    upper = _upper(high)
+    return upper is None or int(low) <= upper
+
+
+class UMLGraph:
+    """Índices de clases y relaciones para validar en tiempo lineal."""
+
+    def __init__(self, uml):
+        uml = uml if isinstance(uml, dict) else {}
+        self.classes = [c for c in uml.get("classes") or [] if isinstance(c, dict)]
+        self.relationships = [r for r in uml.get("relationships") or [] if isinstance(r, dict)]
+        self.by_id = {c.get("id"): c for c in self.classes if c.get("id")}
+        self.parents = defaultdict(list)
+        for rel in self.relationships:
+            if rel.get("type") == "generalization":
+                source, target = rel.get("sourceId"), rel.get("targetId")
+                if source in self.by_id and target in self.by_id:
+                    self.parents[source].append((target, rel))
+
+    def name(self, class_id):
+        cls = self.by_id.get(class_id)
+        if cls is None:
+            return f"<{class_id}>" if class_id else "<sin clase>"
+        return cls.get("name") or "<sin nombre>"
+
+    def describe(self, rel):
+        kind = TYPE_NAMES.get(rel.get("type"), rel.get("type") or "Relación")
+        return f"{kind} {self.name(rel.get('sourceId'))} -> {self.name(rel.get('targetId'))}"
+
+    def generalization_cycles(self):
+        """Relaciones de herencia que cierran un ciclo (DFS iterativo)."""
+        WHITE, GRAY, BLACK = 0, 1, 2
+        color = defaultdict(int)
+        in_cycle = {}
+        for start in self.parents:
+            if color[start] != WHITE:
+                continue
+            color[start] = GRAY
+            # (clase, hijos por recorrer, relación por la que se llegó)
+            stack = [(start, iter(self.parents[start]), None)]
+            while stack:
+                node, children, _ = stack[-1]
+                for parent, rel in children:
+                    if color[parent] == GRAY:
+                        # Arista de retorno: el ciclo son las relaciones
+                        # de la pila desde `parent` hasta aquí
+                        in_cycle[id(rel)] = rel
+                        for entry in reversed(stack):
+                            if entry[0] == parent:
+                                break
+                            in_cycle[id(entry[2])] = entry[2]
+                    elif color[parent] == WHITE:
+                        color[parent] = GRAY
+                        stack.append((parent, iter(self.parents.get(parent, ())), rel))
+                        break
+                else:
+                    color[node] = BLACK
+                    stack.pop()
+        return list(in_cycle.values())
+
+
+class ValidationReport:
+    def __init__(self, graph):
+        self.graph = graph
+        self.errores = []
+        self.broken = set()
+
+    def error(self, relacion, problema, sugerencia, rel=None):
+        self.errores.append({"relacion": relacion, "problema": problema, "sugerencia": sugerencia})
+        if rel is not None:
+            self.broken.add(id(rel))
+
+    @property
+    def pending(self):
+        """Relaciones sin errores estructurales: las que quedan para Gemini."""
+        return [r for r in self.graph.relationships if id(r) not in self.broken]
+
+    def remainder(self):
+        """UML reducido a las relaciones pendientes y sus clases."""
+        pending = self.pending
+        ids = set()
+        for rel in pending:
+            ids.add(rel.get("sourceId"))
+            ids.add(rel.get("targetId"))
+        classes = [c for c in self.graph.classes if c.get("id") in ids]
+        return {"classes": classes, "relationships": pending}
+
+    def as_analysis(self, validas=None):
+        return {"validas": list(validas or []), "errores": list(self.errores)}
+
+    def structural_validas(self):
+        return [
+            {"relacion": self.graph.describe(rel),
+             "razon": "Estructura correcta: extremos existentes y multiplicidades válidas"}
+            for rel in self.pending
+        ]
+
+
+def _check_names(graph, report):
+    seen = {}
+    for cls in graph.classes:
+        name = (cls.get("name") or "").strip()
+        if not name:
+            report.error(f"Clase {cls.get('id')}", "La clase no tiene nombre",
+                         "Asigna un nombre descriptivo a la clase")
+            continue
+        key = name.lower()
+        if key in seen:
+            report.error(f"Clase {name}", f"Nombre de clase duplicado: {name}",
+                         "Renombra una de las clases o fusiónalas")
+        else:
+            seen[key] = cls
+
+        attrs = set()
+        for attr in cls.get("attributes") or []:
+            attr_name = (attr.get("name") or "").strip().lower() if isinstance(attr, dict) else ""
+            if not attr_name:
+                continue
+            if attr_name in attrs:
+                report.error(f"Clase {name}", f"Atributo duplicado: {attr.get('name')}",
+                             "Elimina o renombra el atributo repetido")
+            attrs.add(attr_name)
+
+
+def _check_relationships(graph, report):
+    owners = defaultdict(list)
+    for rel in graph.relationships:
+        label = graph.describe(rel)
+        kind = rel.get("type")
+        if kind not in RELATION_TYPES:
+            report.error(label, f"Tipo de relación desconocido: {kind}",
+                         f"Usa uno de: {', '.join(RELATION_TYPES)}", rel)
+
+        missing = [end for end in ("sourceId", "targetId") if rel.get(end) not in graph.by_id]
+        if missing:
+            report.error(label, f"La relación apunta a una clase inexistente ({', '.join(missing)})",
+                         "Conecta la relación a clases existentes o elimínala", rel)
+            continue
+
+        labels = [l for l in rel.get("labels") or [] if isinstance(l, str) and l.strip()]
+        bad = [l for l in labels if not valid_multiplicity(l)]
+        if bad:
+            report.error(label, f"Multiplicidad mal formada: {', '.join(bad)}",
+                         "Usa multiplicidades como 1, *, 0..1 o 1..*", rel)
+
+        if kind == "composition":
+            # El rombo va en el origen: sourceId es el todo, targetId la parte
+            owners[rel["targetId"]].append(rel)
+
+    for part, rels in owners.items():
+        if len({r["sourceId"] for r in rels}) > 1:
+            names = ", ".join(sorted({graph.name(r["sourceId"]) for r in rels}))
+            for rel in rels:
+                report.error(graph.describe(rel),
+                             f"{graph.name(part)} es parte por composición de varias clases ({names})",
+                             "Una parte solo puede tener un dueño: usa agregación o asociación en las demás", rel)
+
+    for rel in graph.generalization_cycles():
+        report.error(graph.describe(rel), "La herencia forma un ciclo",
+                     "Elimina una de las generalizaciones del ciclo", rel)
+
+
+def validate(uml):
+    """Pasada local sobre el UML; devuelve el ValidationReport."""
+    graph = UMLGraph(uml)
+    report = ValidationReport(graph)
+    _check_names(graph, report)
+    _check_relationships(graph, report)
+    return report
+
@@ -1,35 +1,251 @@
-from rest_framework.views import APIView
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+from django.utils.dateparse import parse_datetime
+from django.views import View
 from rest_framework.response import Response
 from rest_framework import status
-from .models import BackupUML
-from .services import call_gemini
+from . import commands, metrics
+from .cache import get_cache
+from .incremental import get_validation_store
+from .jobs import allowed_priority, get_job_queue, public_job
+from .payload_cache import get_payload_cache
+from .providers import get_router
+from .ratelimit import RateLimited, get_limiter, get_monitor, rate_scope, request_client
+from .persistence import get_writer, load_backup, save_backup
+from .revisions import get_revision_store
+from .services import abatch_gemini, acall_gemini, astream_gemini, detect_mode, strip_markdown
+from .streaming import IncrementalJSONParser, ndjson_line, sse_event
+from .sharding import routing_table
+from .singleflight import get_singleflight
+from collab.merge import apply_to_room, merge_room, merge_target
+from collab.catchup import get_room_log
+from collab.presence import get_presence
+from collab.room_state import invalidate_room, room_key
 import json
-import re
+import math
+import time
 import uuid
 from rest_framework.decorators import api_view, parser_classes
 
-class GenerateUMLView(APIView):
-    def post(self, request):
-        prompt = request.data.get("prompt")
+class GenerateUMLView(View):
+    # Vista asíncrona: la llamada a Gemini no bloquea el event loop de Daphne
+    async def post(self, request):
+        try:
+            body = json.loads(request.body or b"{}")
+        except ValueError:
+            metrics.json_parse_failures.inc("request")
+            body = request.POST
+        prompt = body.get("prompt") if isinstance(body, dict) else None
         if not prompt:
-            return Response({"error": "El campo 'prompt' es requerido"}, status=status.HTTP_400_BAD_REQUEST)
+            return JsonResponse({"error": "El campo 'prompt' es requerido"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Modo trabajo: se responde el id al instante y el resultado llega
+        # a la sala por websocket (o por polling en chatbot/jobs/<id>/)
+        if body.get("async") or request.GET.get("async") in ("1", "true"):
+            job = await get_job_queue().submit(
+                prompt,
+                room_id=body.get("room_id"),
+                priority=allowed_priority(body.get("priority"), request.headers.get("X-Priority-Token")),
+                uml=body.get("uml"),
+                client=request_client(request),
+                merge=body.get("merge", True),
+            )
+            return JsonResponse({
+                "job_id": job["id"],
+                "status": job["status"],
+                "poll_url": f"/api/chatbot/jobs/{job['id']}/",
+            }, status=status.HTTP_202_ACCEPTED)
+
+        # UML actual (del cliente o del backup de la sala) para el motor local
+        uml = await self.current_uml(body)
+        scope = {"room": body.get("room_id"), "client": request_client(request)}
 
-        output = call_gemini(prompt)
+        # Modo streaming: SSE con fragmentos y cada clase/relación completa
+        if body.get("stream") or request.GET.get("stream") in ("1", "true"):
+            response = StreamingHttpResponse(self.stream_events(prompt, uml, scope), content_type="text/event-stream")
+            response["Cache-Control"] = "no-cache"
+            response["X-Accel-Buffering"] = "no"
+            return response
+
+        # Sin sala donde mergear se pide el par original/editado que aplica el frontend
+        mode = detect_mode(prompt)
+        server_merge = bool(body.get("merge", True)) and merge_target(mode, body.get("room_id")) is not None
+        try:
+            with rate_scope(**scope):
+                output = await acall_gemini(prompt, uml, server_merge=server_merge)
+        except RateLimited as e:
+            return rate_limited_response(e)
 
         # 🧹 Limpiar bloque de código Markdown si viene envuelto en ```json ... ```
-        if isinstance(output, str):
-            output = re.sub(r"^```json\s*|\s*```$", "", output.strip(), flags=re.MULTILINE)
+        output = strip_markdown(output)
 
         try:
             parsed_json = json.loads(output)
         except Exception as e:
-            return Response({
+            metrics.json_parse_failures.inc("gemini")
+            return JsonResponse({
                 "error": "Gemini devolvió un formato inválido",
                 "raw": output,
                 "exception": str(e)
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR, json_dumps_params={"ensure_ascii": False})
+
+        # Edición/eliminación con sala: el merge se hace en el servidor y a la
+        # sala solo le llegan los deltas ("merge": false mantiene lo anterior)
+        room = merge_room(mode, body.get("room_id"), parsed_json) if server_merge else None
+        if room is not None:
+            summary = await apply_to_room(room, parsed_json)
+            return JsonResponse({
+                "mode": mode,
+                "applied": True,
+                **summary,
+                "result": parsed_json,
+            }, status=status.HTTP_200_OK, json_dumps_params={"ensure_ascii": False})
+
+        return JsonResponse(parsed_json, status=status.HTTP_200_OK, safe=False, json_dumps_params={"ensure_ascii": False})
+
+    async def current_uml(self, body):
+        uml = body.get("uml")
+        if isinstance(uml, dict):
+            return uml
+        room_id = body.get("room_id")
+        if not room_id:
+            return None
+        try:
+            room_id = uuid.UUID(str(room_id))
+        except ValueError:
+            return None
+        return await sync_to_async(load_backup)(room_id)
+
+    async def stream_events(self, prompt, uml=None, scope=None):
+        parser = IncrementalJSONParser()
+        try:
+            with rate_scope(**(scope or {})):
+                async for chunk in astream_gemini(prompt, uml):
+                    yield sse_event("chunk", {"text": chunk})
+                    for path, item in parser.feed(chunk):
+                        yield sse_event("item", {"path": path, "item": item})
+        except RateLimited as e:
+            yield sse_event("error", rate_limited_payload(e))
+            return
+        except Exception as e:
+            yield sse_event("error", {"error": "Error llamando a Gemini", "exception": str(e)})
+            return
+
+        try:
+            yield sse_event("done", parser.result())
+        except Exception as e:
+            metrics.json_parse_failures.inc("gemini")
+            yield sse_event("error", {
+                "error": "Gemini devolvió un formato inválido",
+                "raw": parser.buffer,
+                "exception": str(e)
+            })
+
+class BatchGenerateView(View):
+    """
+    Lote de prompts: {"prompts": ["...", {"id": "a", "prompt": "...", "uml": {...}}]}.
+    Responde NDJSON con una línea por ítem a medida que termina (con su
+    error si falló, sin cortar el lote) y una última línea de resumen.
+    """
+
+    async def post(self, request):
+        try:
+            body = json.loads(request.body or b"{}")
+        except ValueError:
+            metrics.json_parse_failures.inc("request")
+            return JsonResponse({"error": "El cuerpo debe ser JSON"}, status=status.HTTP_400_BAD_REQUEST)
+        items = body.get("prompts") if isinstance(body, dict) else None
+        if not isinstance(items, list) or not items:
+            return JsonResponse({"error": "El campo 'prompts' debe ser una lista no vacía"}, status=status.HTTP_400_BAD_REQUEST)
+        max_items = getattr(settings, "UML_BATCH_MAX_ITEMS", 100)
+        if len(items) > max_items:
+            return JsonResponse({"error": f"A lo sumo {max_items} prompts por lote"}, status=status.HTTP_400_BAD_REQUEST)
+
+        entries = [self.entry(item) for item in items]
+        scope = {"room": body.get("room_id"), "client": request_client(request)}
+        response = StreamingHttpResponse(self.batch_lines(entries, scope), content_type="application/x-ndjson")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @staticmethod
+    def entry(item):
+        if isinstance(item, str):
+            return {"id": None, "prompt": item, "uml": None}
+        if not isinstance(item, dict):
+            return {"id": None, "prompt": None, "uml": None}
+        uml = item.get("uml")
+        return {"id": item.get("id"), "prompt": item.get("prompt"), "uml": uml if isinstance(uml, dict) else None}
+
+    async def batch_lines(self, entries, scope):
+        start = time.perf_counter()
+        summary = {"ok": 0, "errors": 0, "sources": {}}
 
-        return Response(parsed_json, status=status.HTTP_200_OK)
+        def line(index, data):
+            summary["ok" if data["status"] == "ok" else "errors"] += 1
+            if data.get("source"):
+                summary["sources"][data["source"]] = summary["sources"].get(data["source"], 0) + 1
+            return ndjson_line({"index": index, "id": entries[index]["id"], **data})
+
+        valid = []
+        for index, entry in enumerate(entries):
+            if isinstance(entry["prompt"], str) and entry["prompt"].strip():
+                valid.append(index)
+            else:
+                yield line(index, {"status": "error", "error": "El campo 'prompt' es requerido"})
+
+        with rate_scope(**scope):
+            batch = abatch_gemini([(entries[index]["prompt"], entries[index]["uml"]) for index in valid])
+            async for position, mode, source, output in batch:
+                yield line(valid[position], {"mode": mode, "source": source, **self.item_result(output)})
+
+        yield ndjson_line({
+            "done": True,
+            "total": len(entries),
+            **summary,
+            "ms": round((time.perf_counter() - start) * 1000, 1),
+        })
+
+    @staticmethod
+    def item_result(output):
+        if isinstance(output, RateLimited):
+            return {"status": "error", **rate_limited_payload(output)}
+        if isinstance(output, Exception):
+            return {"status": "error", "error": "Error llamando a Gemini", "exception": str(output)}
+        output = strip_markdown(output)
+        try:
+            return {"status": "ok", "result": json.loads(output)}
+        except Exception as e:
+            metrics.json_parse_failures.inc("gemini")
+            return {"status": "error", "error": "Gemini devolvió un formato inválido", "raw": output, "exception": str(e)}
+
+
+def rate_limited_payload(e):
+    if e.reason == "overloaded":
+        message = "Gemini está saturado, intenta de nuevo en unos segundos"
+    else:
+        message = "Demasiadas solicitudes, intenta de nuevo en unos segundos"
+    return {"error": message, "reason": e.reason, "retry_after": round(e.retry_after, 1)}
+
+
+def rate_limited_response(e):
+    # 429 si se superó el límite, 503 si es load-shedding
+    code = status.HTTP_503_SERVICE_UNAVAILABLE if e.reason == "overloaded" else status.HTTP_429_TOO_MANY_REQUESTS
+    response = JsonResponse(rate_limited_payload(e), status=code, json_dumps_params={"ensure_ascii": False})
+    response["Retry-After"] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+class JobStatusView(View):
+    async def get(self, request, job_id):
+        queue = get_job_queue()
+        # Los workers arrancan con el primer uso del event loop de este proceso
+        queue.ensure_workers()
+        job = await queue.get(job_id)
+        if job is None:
+            return JsonResponse({"error": "Trabajo no encontrado"}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse(public_job(job), json_dumps_params={"ensure_ascii": False})
 
 @api_view(['POST'])  
 def set_backupUML(request, room_id):
@@ -39,30 +255,114 @@ def set_backupUML(request, room_id):
     data = request.data
 
     try:
-        # Buscar si ya existe
-        uml_backup, created = BackupUML.objects.update_or_create(
-            room_id=room_id,
-            defaults={"data": data}
-        )
+        # Write-behind: se agrupan los guardados rápidos y se escriben por lotes
+        save_backup(room_id, data)
+        # El RoomState de la sala (si hay) se recarga desde este guardado
+        invalidate_room(room_id)
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
     return Response({
-        "message": "UML creado con éxito" if created else "UML actualizado con éxito",
-        "room_id": str(uml_backup.room_id),
-        "data": uml_backup.data
-    }, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+        "message": "UML guardado con éxito",
+        "room_id": str(room_id),
+        "data": data
+    }, status=status.HTTP_200_OK)
 
 @api_view(['GET'])  
 def get_backupUML(request, room_id):
     if not room_id:
         return Response({"error": "Se requiere el campo 'room_id'"}, status=status.HTTP_400_BAD_REQUEST)
 
+    # Historial: ?revision=N o ?at=<fecha ISO> reconstruyen una versión anterior
+    revision = request.query_params.get("revision")
+    at = request.query_params.get("at")
+    if revision or at:
+        return _get_backup_revision(room_id, revision, at)
+
+    cache = get_payload_cache()
+    entry = cache.get(room_id)
+    if entry is None:
+        data = load_backup(room_id)
+        if data is None:
+            return Response({"error": "No existe un diagrama con ese ID"}, status=status.HTTP_404_NOT_FOUND)
+        entry = cache.put(room_id, data)
+
+    # El cliente ya tiene la versión actual → 304 sin cuerpo
+    if entry.etag in parse_etags(request.headers.get("If-None-Match", "")):
+        cache.stats["not_modified"] += 1
+        response = HttpResponseNotModified()
+        response["ETag"] = entry.etag
+        return response
+
+    # ✅ Devolver el JSON guardado (bytes ya serializados, gzip si el cliente lo acepta)
+    response = HttpResponse(entry.body, content_type="application/json")
+    if entry.gzipped is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.content = entry.gzipped
+        response["Content-Encoding"] = "gzip"
+    response["ETag"] = entry.etag
+    response["Vary"] = "Accept-Encoding"
+    response["Cache-Control"] = "no-cache"
+    return response
+
+def _get_backup_revision(room_id, revision, at):
     try:
-        diagrama = BackupUML.objects.get(room_id=room_id)
-    except BackupUML.DoesNotExist:
-        return Response({"error": "No existe un diagrama con ese ID"}, status=status.HTTP_404_NOT_FOUND)
+        revision = int(revision) if revision else None
+    except ValueError:
+        return Response({"error": "'revision' debe ser un entero"}, status=status.HTTP_400_BAD_REQUEST)
+    at_dt = parse_datetime(at) if at else None
+    if at and at_dt is None:
+        return Response({"error": "'at' debe ser una fecha ISO 8601"}, status=status.HTTP_400_BAD_REQUEST)
+
+    store = get_revision_store()
+    target = store.resolve(room_id, revision=revision, at=at_dt)
+    if target is None:
+        return Response({"error": "No existe esa revisión del diagrama"}, status=status.HTTP_404_NOT_FOUND)
+
+    response = Response(store.reconstruct(room_id, target), status=status.HTTP_200_OK)
+    response["X-UML-Revision"] = str(target)
+    return response
+
+@api_view(['GET'])
+def get_backupUML_history(request, room_id):
+    return Response({
+        "room_id": str(room_id),
+        "revisions": get_revision_store().history(room_id)
+    }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def cache_stats(request):
+    # Contadores de hit/miss para dimensionar la caché del LLM
+    stats = get_cache().snapshot()
+    stats["singleflight"] = dict(get_singleflight().stats)
+    stats["local_engine"] = commands.stats.snapshot()
+    stats["validation"] = get_validation_store().snapshot()
+    stats["jobs"] = get_job_queue().snapshot()
+    stats["rate_limit"] = get_limiter().snapshot()
+    stats["upstream"] = get_monitor().snapshot()
+    stats["providers"] = get_router().snapshot()
+    return Response(stats, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def presence_stats(request):
+    # Salas y peers conectados (ZCOUNT en Redis); ?room=<id> para una sala
+    stats = get_presence().counts(request.query_params.get("room"))
+    stats["registry"] = get_presence().snapshot()
+    stats["catchup"] = get_room_log().snapshot()
+    return Response(stats, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def shard_routes(request):
+    # Tabla de ruteo para el proxy: ?room=<id> da el nodo/upstream de la sala
+    room = request.query_params.get("room")
+    return Response(routing_table(room_key(room) if room else None), status=status.HTTP_200_OK)
 
-    # ✅ Devolver el JSON guardado exactamente como está en la BD
-    return Response(diagrama.data, status=status.HTTP_200_OK)
+def metrics_view(request):
+    # Formato de exposición de Prometheus (text/plain 0.0.4)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
+@api_view(['GET'])
+def backup_stats(request):
+    # Estado del write-behind: pendientes y retraso de escritura (flush lag)
+    stats = get_writer().snapshot()
+    stats["payload_cache"] = get_payload_cache().snapshot()
+    return Response(stats, status=status.HTTP_200_OK)